@@ -1,150 +1,173 @@
 import controllers
-from mongoengine import DoesNotExist
-from Utils import JWT
+from Utils import JWT, config
 from sanic import Blueprint
+from sanic.response import text
+from Utils.Metrics import registry
+from Utils.RateLimit import login_limiter
 from Utils.RouteUtils import *
+import basicauth
 
 
 bp = Blueprint('auth_routes')
 
+trust_forwarded = config.get('rate_limit', {}).get('trust_forwarded', False)
+
+# error response of every exception a route may raise, rendered
+# once by create_app, route overrides are keyed by handler name
+errors = (ErrorResponses()
+          .register(TokenDoesNotExist, 400, "missing authorization header")
+          .register(InvalidMethod, 400, "invalid authorization method")
+          .register(InvalidValue, 400, "invalid authorization token")
+          .register(basicauth.DecodeError, 400, "invalid authorization token")
+          .register(SessionWasRevoked, 401, "revoked token")
+          .register(JWT.ExpiredSignatureError, 401, "expired signature")
+          .register(JWT.InvalidSignatureError, 401, "invalid signature")
+          .register(JWT.InvalidTokenError, 401, "invalid token")
+          .register(TooManyAttempts, 429, "too many attempts", render=too_many_attempts)
+          .register(UserAlreadyExist, 400, "user already exist")
+          .register(IncorrectCredentials, 401, "incorrect credentials")
+          .register(WrongPassword, 401, "incorrect credentials")
+          .register(UserWasNotFound, 404, "user was not found")
+          .register(UserWasNotFound, 404, "user does not exist", route='login')
+          .register(RefreshTokenIsNotValid, 404, "session does not exist"))
+
 
 @bp.post('/verify', version=1)
+@instrumented
+@errors.handle
 async def verify(request):
     """
     verify a user's jwt token
     """
-    try:
+    jwt_token = extract_bearer(request.headers.get('Authorization'))
+    _, payload_json = controllers.verify_jwt_token_raw(jwt_token)
 
-        jwt_token = extract_bearer(request.headers.get('Authorization'))
-        payload = controllers.verify_jwt_token(jwt_token)
+    return suc_resp({"valid": True}, serialized={"payload": payload_json})
 
-        return suc_resp({
-            "valid": True,
-            "payload": payload
-        })
-
-    except TokenDoesNotExist:
-        return err_resp(400, "missing authorization header")
-    except InvalidMethod:
-        return err_resp(400, "invalid authorization method")
-    except InvalidValue:
-        return err_resp(400, "invalid authorization token")
-    except JWT.ExpiredSignatureError:
-        return err_resp(401, "expired signature")
-    except JWT.InvalidSignatureError:
-        return err_resp(401, "invalid signature")
-    except JWT.InvalidTokenError:
-        return err_resp(401, "invalid token")
+
+@bp.post('/verify/batch', version=1)
+@instrumented
+async def verify_batch(request):
+    """
+    verify many jwt tokens at once
+    provide the tokens as a tokens list field in body
+    """
+    json_data = request.json or {}
+    tokens = json_data.get('tokens')
+
+    if not isinstance(tokens, list) or not tokens:
+        return err_resp(400, "missing tokens field")
+    if not all(isinstance(token, str) for token in tokens):
+        return err_resp(400, "invalid tokens field")
+    if len(tokens) > config.get('verify', {}).get('max_batch', 100):
+        return err_resp(400, "too many tokens")
+
+    results = controllers.verify_jwt_tokens_raw(tokens)
+    return suc_resp({}, serialized={
+        "results": b'[' + b','.join(
+            errors.lookup('verify', type(result)).result if isinstance(result, Exception)
+            else b'{"valid":true,"payload":%s}' % result[1]
+            for result in results) + b']'
+    })
+
+
+@bp.get('/.well-known/jwks.json')
+async def jwks(request):
+    """
+    public keys for verifying jwt tokens locally
+    """
+    return json_resp(JWT.jwks(), headers={"Cache-Control": "public, max-age=300"})
+
+
+@bp.get('/metrics')
+async def metrics(request):
+    """
+    metrics in the prometheus text format
+    """
+    return text(registry.expose(), content_type="text/plain; version=0.0.4")
 
 
 @bp.post('/register', version=1)
+@instrumented
+@errors.handle
 async def register(request):
     """
     register a new user
     provide user uid and password to register
     Authorization: Basic uid:password
     """
-    try:
-
-        uid, pswd = extract_basic(request.headers.get('Authorization'))
-        user = controllers.register(uid, pswd)
-        return suc_resp({
-            "uid": user.uid,
-            "reg_date": user.date_created
-        })
-
-    except TokenDoesNotExist:
-        return err_resp(400, "missing authorization header")
-    except UserAlreadyExist:
-        return err_resp(400, "user already exist")
+    uid, pswd = extract_basic(request.headers.get('Authorization'))
+    user = await controllers.register(uid, pswd)
+    return suc_resp({
+        "uid": user.uid,
+        "reg_date": user.date_created
+    })
 
 
 @bp.get('/login', version=1)
+@instrumented
+@errors.handle
 async def login(request):
     """
     login a user
     provide user uid and password as basic auth
     """
-    try:
-
-        uid, pswd = extract_basic(request.headers.get('Authorization'))
-        session = controllers.login(uid, pswd)
-        jwt_token, payload = session.gen_jwt(ttl=timedelta(days=7).total_seconds())
-
-        return suc_resp({
-            "jwt": {
-                "token": jwt_token,
-                "refresh_token": session.refresh_token,
-                "payload": payload
-            },
-            "uid": uid
-        })
-
-    except TokenDoesNotExist:
-        return err_resp(400, "missing authorization header")
-    except DoesNotExist:
-        return err_resp(404, "user does not exist")
-    except IncorrectCredentials:
-        return err_resp(401, "incorrect credentials")
+    uid, pswd = extract_basic(request.headers.get('Authorization'))
+    login_limiter.check(uid=uid, ip=client_ip(request, trust_forwarded))
+    session = await controllers.login(uid, pswd)
+    jwt_token, payload = session.gen_jwt(ttl=timedelta(days=7).total_seconds())
+
+    return suc_resp({
+        "jwt": {
+            "token": jwt_token,
+            "refresh_token": session.refresh_token,
+            "payload": payload
+        },
+        "uid": uid
+    })
 
 
 @bp.post('/logout', version=1)
+@instrumented
+@errors.handle
 async def logout(request):
     """
     provide refresh token as Bearer token
     """
-    try:
-
-        token = extract_bearer(request.headers.get("Authorization"))
-        session = controllers.logout(token)
-        return suc_resp({
-            "logged_out": True,
-            "token": token,
-            "uid": session.user.uid
-        })
-
-    except InvalidMethod:
-        err_resp(400, "invalid authorization method")
-    except InvalidValue:
-        err_resp(400, "invalid authorization token")
-    except TokenDoesNotExist:
-        return err_resp(400, "missing authorization header")
-    except DoesNotExist:
-        return err_resp(404, "session does not exist")
+    token = extract_bearer(request.headers.get("Authorization"))
+    session = await controllers.logout(token)
+    return suc_resp({
+        "logged_out": True,
+        "token": token,
+        "uid": session.user_id
+    })
 
 
 # @bp.route('/token/refresh', methods=['GET'])
 @bp.get('/token/refresh', version=1)
+@instrumented
+@errors.handle
 async def refresh_token(request):
     """
     refresh jwt token using refresh token
     Authorization: Bearer [Refresh Token]
     """
-    try:
-
-        token = extract_bearer(request.headers.get("Authorization"))
-        session = controllers.refresh_token(token)
-        jwt_token, payload = session.generate_jwt()
-        return suc_resp({
-            "jwt": {
-                "token": jwt_token,
-                "refresh_token": session.refresh_token,
-                "payload": payload
-            },
-            "uid": session.user.uid
-        })
-
-    except InvalidMethod:
-        return err_resp(400, "invalid authorization method")
-    except InvalidValue:
-        return err_resp(400, "invalid authorization token")
-    except TokenDoesNotExist:
-        return err_resp(400, "missing authorization header")
-    except DoesNotExist:
-        return err_resp(404, "session does not exist")
+    token = extract_bearer(request.headers.get("Authorization"))
+    session = await controllers.refresh_token(token)
+    jwt_token, payload = session.gen_jwt()
+    return suc_resp({
+        "jwt": {
+            "token": jwt_token,
+            "refresh_token": session.refresh_token,
+            "payload": payload
+        },
+        "uid": session.user_id
+    })
 
 
 @bp.post('/password/change', version=1)
+@instrumented
+@errors.handle
 async def change_password(request):
     """
     change user's password
@@ -153,36 +176,30 @@ async def change_password(request):
     optional kill_sessions boolean field to kill
     all the currently active sessions.
     """
-    try:
-
-        uid, old_pswd = extract_basic(request.headers.get('Authorization'))
-        json_data = request.json
-
-        if 'new_password' not in json_data:
-            return err_resp(400, 'missing new_password field')
-        new_password = json_data.get('new_password')
-        kill_sessions = json_data.get('kill_sessions', False)
-        controllers.change_password(uid, old_pswd, new_password, kill_sessions)
-        return suc_resp({
-            "changed_password": True,
-            "killed_sessions": kill_sessions,
-        })
+    uid, old_pswd = extract_basic(request.headers.get('Authorization'))
+    login_limiter.check(uid=uid, ip=client_ip(request, trust_forwarded))
+    json_data = request.json or {}
 
-    except TokenDoesNotExist:
-        return err_resp(400, "missing authorization header")
-    except UserWasNotFound:
-        return err_resp(404, "user was not found")
-    except WrongPassword:
-        return err_resp(401, "incorrect credentials")
+    if 'new_password' not in json_data:
+        return err_resp(400, 'missing new_password field')
+    new_password = json_data.get('new_password')
+    kill_sessions = json_data.get('kill_sessions', False)
+    await controllers.change_password(uid, old_pswd, new_password, kill_sessions)
+    return suc_resp({
+        "changed_password": True,
+        "killed_sessions": kill_sessions,
+    })
 
 
 @bp.post('/password/reset/request', version=1)
+@instrumented
 async def reset_password_request(request):
     # issue temp token for password reset
     pass
 
 
 @bp.post('/password/reset', version=1)
+@instrumented
 async def reset_password(request):
     # provide password token for reset
     pass
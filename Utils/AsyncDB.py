@@ -0,0 +1,81 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Barrier
+from .Metrics import stage_latency
+
+
+class AsyncDatabase:
+
+    def __init__(self, database, min_size=1, max_size=10):
+        """
+        initialize a new async access layer for a pooled peewee database
+        queries run in a thread pool with at most max_size threads,
+        so at most max_size connections are checked out at once
+        :param database: pooled peewee database
+        :param min_size: connections opened on start
+        :param max_size: maximum concurrent connections
+        """
+        self._database = database
+        self._min_size = min(min_size, max_size)
+        self._max_size = max_size
+        self._executor = None
+
+    def _get_executor(self):
+        """ get the query thread pool, created on first use """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_size, thread_name_prefix='db')
+        return self._executor
+
+    def _warm_connection(self, barrier):
+        """ open a pooled connection and hand it back once all are open """
+        self._database.connect(reuse_if_open=True)
+        try:
+            barrier.wait()
+        finally:
+            self._database.close()
+
+    def start(self):
+        """
+        start the query thread pool and open min_size connections
+        :return: True on success
+        """
+        executor = self._get_executor()
+        if self._min_size > 0:
+            barrier = Barrier(self._min_size, timeout=30)
+            futures = [executor.submit(self._warm_connection, barrier)
+                       for _ in range(self._min_size)]
+            for future in futures:
+                future.result()
+
+        return True
+
+    def stop(self):
+        """
+        stop the query thread pool and close pooled connections
+        :return: True on success
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        if hasattr(self._database, 'close_all'):
+            self._database.close_all()
+        return True
+
+    def _call(self, fn, *args, **kwargs):
+        """ run fn holding a pooled connection """
+        with self._database.connection_context():
+            return fn(*args, **kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        run a blocking database call without blocking the event loop
+        :param fn: callable issuing the queries
+        :return: fn's return value
+        """
+        loop = asyncio.get_event_loop()
+        with stage_latency.time('db.' + getattr(fn, '__name__', 'query')):
+            return await loop.run_in_executor(
+                self._get_executor(), partial(self._call, fn, *args, **kwargs))
@@ -1,33 +1,287 @@
-from Utils import redis
-import json
+from Utils import redis, config
+from Utils.Caching import VerifyCache
+from Utils.Metrics import registry, timed
+from Utils import Serializer
+from redis.exceptions import RedisError
+from time import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+local_cache = VerifyCache(
+    maxsize=config.get('cache', {}).get('local_size', 10000),
+    ttl=config.get('cache', {}).get('local_ttl', 5)
+)
 
 
 class Cache:
 
+    # payloads are cached serialized, as (sid, payload json bytes) entries,
+    # so a hit can be written into a response without decoding it.
+    # in redis an entry is stored as b"<exp> <sid> <payload json>"
+
+    counters = {
+        "local_hits": 0,
+        "local_misses": 0,
+        "redis_hits": 0,
+        "redis_misses": 0
+    }
+
     @staticmethod
-    def lookup_jwt(jwt_token: str):
+    def _remaining_ttl(exp: int, ttl: int):
+        """
+        cap a cache ttl at the token's expiration
+        :param exp: token expiration as epoch seconds, 0 if it never expires
+        :param ttl: requested time to live
+        :return: ttl in seconds
         """
-        lookup jwt payload
+        if not exp:
+            return int(ttl)
+
+        return int(min(ttl, exp - time()))
+
+    @classmethod
+    def _from_redis(cls, jwt_token, value: bytes):
+        """
+        parse a redis value into an entry and keep it in the process cache
+        :return: sid, payload json bytes, None if the value is not an entry
+        """
+        try:
+            exp, sid, payload_json = value.split(b' ', 2)
+            exp = int(exp)
+        except ValueError:
+            # written by a release that cached payloads as plain json
+            return None
+        entry = sid.decode(), payload_json
+        local_cache.set(jwt_token, entry,
+                        ttl=cls._remaining_ttl(exp, local_cache.ttl))
+        return entry
+
+    @classmethod
+    @timed('cache_lookup')
+    def lookup_jwt_raw(cls, jwt_token: str):
+        """
+        lookup a serialized jwt payload, in process cache first then redis
         :param jwt_token: targeted jwt token
-        :return: payload as json if found
+        :return: sid, payload json bytes if found
         """
 
-        payload_str = redis.get(jwt_token)
-        if not payload_str:
+        entry = local_cache.get(jwt_token)
+        if entry is not None:
+            cls.counters['local_hits'] += 1
+            return entry
+        cls.counters['local_misses'] += 1
+
+        value = redis.get(jwt_token)
+        entry = cls._from_redis(jwt_token, value) if value else None
+        if entry is None:
+            cls.counters['redis_misses'] += 1
             return None
+        cls.counters['redis_hits'] += 1
+        return entry
+
+    @classmethod
+    def lookup_jwt(cls, jwt_token: str):
+        """
+        lookup jwt payload, in process cache first then redis
+        :param jwt_token: targeted jwt token
+        :return: payload as json if found
+        """
+        entry = cls.lookup_jwt_raw(jwt_token)
+        return None if entry is None else Serializer.loads(entry[1])
+
+    @classmethod
+    @timed('cache_lookup_many')
+    def lookup_jwts_raw(cls, jwt_tokens: list):
+        """
+        lookup many serialized jwt payloads, in process cache first
+        then a single redis MGET for the rest
+        :param jwt_tokens: targeted jwt tokens
+        :return: {token: (sid, payload json bytes)} dict of the found tokens
+        """
+
+        found, missing = dict(), list()
+        for jwt_token in dict.fromkeys(jwt_tokens):
+            entry = local_cache.get(jwt_token)
+            if entry is not None:
+                found[jwt_token] = entry
+            else:
+                missing.append(jwt_token)
+        cls.counters['local_hits'] += len(found)
+        cls.counters['local_misses'] += len(missing)
 
-        return json.loads(payload_str)
+        if not missing:
+            return found
+
+        for jwt_token, value in zip(missing, redis.mget(missing)):
+            if not value:
+                cls.counters['redis_misses'] += 1
+                continue
+            entry = cls._from_redis(jwt_token, value)
+            if entry is None:
+                cls.counters['redis_misses'] += 1
+                continue
+            cls.counters['redis_hits'] += 1
+            found[jwt_token] = entry
+
+        return found
 
     @classmethod
+    def lookup_jwts(cls, jwt_tokens: list):
+        """
+        lookup many jwt payloads, in process cache first
+        then a single redis MGET for the rest
+        :param jwt_tokens: targeted jwt tokens
+        :return: {token: payload} dict of the found tokens
+        """
+        return {jwt_token: Serializer.loads(entry[1])
+                for jwt_token, entry in cls.lookup_jwts_raw(jwt_tokens).items()}
+
+    @staticmethod
+    def entry(payload: dict):
+        """
+        serialize a jwt payload into a cache entry
+        :param payload: payload
+        :return: sid, payload json bytes
+        """
+        return payload.get('sid', ''), Serializer.dumps(payload)
+
+    @classmethod
+    @timed('cache_set')
     def set_jwt(cls, jwt_token: str, payload: dict, ttl: int):
         """
         set a new jwt token and its corresponding payload
         :param jwt_token: targeted jwt_token
         :param payload: payload
-        :param ttl: time to live for the cache
-        :return: True on success
+        :param ttl: time to live for the cache, capped at the token's exp
+        :return: the serialized entry, sid and payload json bytes
+        """
+
+        entry = cls.entry(payload)
+        capped_ttl = cls._remaining_ttl(payload.get('exp', 0), ttl)
+        if capped_ttl > 0:
+            pipe = redis.pipeline(transaction=False)
+            cls._pipe_set_jwt(pipe, jwt_token, entry, payload.get('exp', 0), capped_ttl, ttl)
+            pipe.execute()
+        return entry
+
+    @classmethod
+    @timed('cache_set_many')
+    def set_jwts(cls, items: list, ttl: int):
+        """
+        set many jwt tokens and their payloads in a single redis round trip
+        :param items: list of (jwt_token, payload) tuples
+        :param ttl: time to live for the cache, capped at each token's exp
+        :return: {token: (sid, payload json bytes)} dict of the serialized entries
+        """
+
+        pipe = redis.pipeline(transaction=False)
+        entries = dict()
+        for jwt_token, payload in items:
+            entries[jwt_token] = entry = cls.entry(payload)
+            capped_ttl = cls._remaining_ttl(payload.get('exp', 0), ttl)
+            if capped_ttl > 0:
+                cls._pipe_set_jwt(pipe, jwt_token, entry, payload.get('exp', 0), capped_ttl, ttl)
+
+        if len(pipe):
+            pipe.execute()
+        return entries
+
+    @classmethod
+    def _pipe_set_jwt(cls, pipe, jwt_token, entry: tuple, exp: int, ttl: int, requested_ttl: int):
+        """
+        queue the commands caching a jwt payload on a redis pipeline
+        :param pipe: redis pipeline
+        :param jwt_token: targeted jwt token
+        :param entry: sid, payload json bytes
+        :param exp: token expiration as epoch seconds
+        :param ttl: capped time to live
+        :param requested_ttl: uncapped time to live
+        """
+
+        sid, payload_json = entry
+        pipe.set(jwt_token, b'%d %s %s' % (exp, sid.encode(), payload_json), ex=ttl)
+        if sid:
+            # index cached tokens by session so they can be evicted together,
+            # the index outlives every entry since it uses the uncapped ttl
+            session_key = cls._session_key(sid)
+            pipe.sadd(session_key, jwt_token)
+            pipe.expire(session_key, int(requested_ttl))
+
+        local_cache.set(jwt_token, entry, ttl=ttl)
+
+    @staticmethod
+    def _session_key(session_id: str):
         """
+        get the redis key indexing cached tokens of a session
+        :param session_id: targeted session id
+        :return: redis key
+        """
+        return f"sid:{session_id}"
+
+    @classmethod
+    @timed('cache_invalidate')
+    def invalidate_sessions(cls, session_ids: list):
+        """
+        evict every cached jwt payload of the given sessions
+        costs two redis round trips regardless of the number of sessions,
+        if redis is unavailable nothing is evicted and the revocation
+        list rejects the cached payloads instead
+        :param session_ids: targeted session ids
+        :return: number of evicted tokens
+        """
+        if not session_ids:
+            return 0
+
+        session_keys = [cls._session_key(sid) for sid in session_ids]
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for session_key in session_keys:
+                pipe.smembers(session_key)
+            tokens = set().union(*pipe.execute())
+            redis.delete(*tokens, *session_keys)
+        except RedisError:
+            logger.exception("evicting the tokens of %d sessions failed", len(session_ids))
+            return 0
+
+        for token in tokens:
+            local_cache.delete(token)
+            local_cache.delete(token.decode())
+
+        return len(tokens)
+
+    @classmethod
+    def stats(cls):
+        """
+        get hit/miss counters and hit ratios per cache tier
+        :return: dict of counters
+        """
+        stats = dict(cls.counters)
+        for tier in ('local', 'redis'):
+            hits, misses = stats[f'{tier}_hits'], stats[f'{tier}_misses']
+            total = hits + misses
+            stats[f'{tier}_hit_ratio'] = hits / total if total else 0.0
+
+        stats['local_size'] = len(local_cache)
+        return stats
+
+
+def _cache_lookups():
+    """ cache lookups per tier and result """
+    return {(tier, result): Cache.counters[f'{tier}_{counter}']
+            for tier in ('local', 'redis')
+            for result, counter in (('hit', 'hits'), ('miss', 'misses'))}
+
+
+def _cache_hit_ratios():
+    """ cache hit ratio per tier """
+    stats = Cache.stats()
+    return {(tier,): stats[f'{tier}_hit_ratio'] for tier in ('local', 'redis')}
+
 
-        payload_str = json.dumps(payload)
-        redis.set(jwt_token, payload_str, ex=ttl)
-        return True
+registry.counter('cherryauth_cache_lookups', 'verify cache lookups per tier',
+                 labels=('tier', 'result'), collect=_cache_lookups)
+registry.gauge('cherryauth_cache_hit_ratio', 'verify cache hit ratio per tier',
+               labels=('tier',), collect=_cache_hit_ratios)
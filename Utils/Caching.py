@@ -1,16 +1,90 @@
-from cachetools import TTLCache
-from datetime import timedelta
-
-
-# class VerifyCache(CacheEngine):
-#
-#     ttl_cache = TTLCache(maxsize=1000, ttl=timedelta(seconds=30).seconds)
-#
-#     async def get(self, request: Request):
-#         """ query cache for response """
-#         return self.ttl_cache.get(request.headers.get('Authorization'))
-#
-#     async def store(self, request: Request, response):
-#         """ if response code is 200, store response in cache """
-#         if response.status_code == 200:
-#             self.ttl_cache[request.headers.get('Authorization')] = response
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class VerifyCache:
+
+    def __init__(self, maxsize=10000, ttl=30):
+        """
+        initialize a new in-process lru cache with per item ttl,
+        safe to share between the event loop and worker threads
+        :param maxsize: maximum number of items to keep
+        :param ttl: maximum time to live for an item in seconds
+        """
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def ttl(self):
+        """maximum time to live for an item in seconds"""
+        return self._ttl
+
+    def __len__(self):
+        """get the number of cached items"""
+        return len(self._data)
+
+    def __contains__(self, key):
+        """check whether a live item exists for key"""
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """
+        get a cached value, expired items are evicted
+        :param key: targeted key
+        :param default: default value
+        :return: value or default value
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            value, expires_at = item
+            if expires_at <= monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        cache a value, least recently used items
+        are evicted once maxsize is reached
+        :param key: targeted key
+        :param value: associated value
+        :param ttl: time to live in seconds, capped at the cache ttl
+        :return: True if value was cached
+        """
+        ttl = self._ttl if ttl is None else min(ttl, self._ttl)
+        if ttl <= 0:
+            return False
+
+        with self._lock:
+            self._data[key] = (value, monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+        return True
+
+    def delete(self, key):
+        """
+        delete a cached value
+        :param key: targeted key
+        :return: True if value was cached
+        """
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        """
+        clear the entire cache
+        :return: True on success
+        """
+        with self._lock:
+            self._data.clear()
+        return True
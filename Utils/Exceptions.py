@@ -33,3 +33,14 @@ class UserWasNotFound(AuthExceptions):
 
 class RefreshTokenIsNotValid(AuthExceptions):
     pass
+
+
+class SessionWasRevoked(AuthExceptions):
+    pass
+
+
+class TooManyAttempts(AuthExceptions):
+
+    def __init__(self, retry_after=0):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
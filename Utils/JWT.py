@@ -1,23 +1,68 @@
 import jwt
 from jwt import *
-from datetime import datetime, timedelta
+from jwt.algorithms import Algorithm, get_default_algorithms
+from base64 import urlsafe_b64encode
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 from Utils import config
+from Utils.Metrics import timed
+from time import time
 import secrets
 
 
+class Ed25519Algorithm(Algorithm):
+    """ EdDSA over Ed25519, for PyJWT releases that do not ship it """
+
+    def prepare_key(self, key):
+        if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+            return key
+        raise InvalidKeyError('expected an Ed25519 key object')
+
+    def sign(self, msg, key):
+        return key.sign(msg)
+
+    def verify(self, msg, key, sig):
+        try:
+            key.verify(sig, msg)
+            return True
+        except InvalidSignature:
+            return False
+
+
+if 'EdDSA' not in get_default_algorithms():
+    jwt.register_algorithm('EdDSA', Ed25519Algorithm())
+
+
+# curve per EC algorithm, with its JWK name and coordinate size in bytes
+curves = {
+    'ES256': (ec.SECP256R1, 'P-256', 32),
+    'ES384': (ec.SECP384R1, 'P-384', 48),
+    'ES512': (ec.SECP521R1, 'P-521', 66)
+}
+
+# tokens issued before the keyring existed have no kid
+# and are verified with the legacy jwt secret under this kid
+LEGACY_KID = 'legacy'
+
+# kid -> (algorithm, signing key, verification key, retires_at)
+_key_cache = {}
+_jwks_cache = None
+
+
 def gen_secret():
     """
     generate a new jwt secret
     :return: True secret on success
     :raises: Exception if secret already exist
     """
-    if 'jwt' not in config:
-        config['jwt'] = {}
-    if 'secret' not in config['jwt']:
+    with config.transaction():
+        if 'jwt' not in config:
+            config['jwt'] = {}
+        if 'secret' in config['jwt']:
+            raise Exception('jwt secret already exists')
         config['jwt']['secret'] = secrets.token_hex(256)
-        config.dump()
-    else:
-        raise Exception('jwt secret already exists')
     return get_secret()
 
 
@@ -32,17 +77,268 @@ def get_secret():
     return config['jwt']['secret']
 
 
-def gen_jwt(sid: str, uid: str, ttl: int, algorithm='HS256'):
+def _gen_private_key(algorithm: str):
+    """
+    generate a new private key for an asymmetric algorithm
+    :param algorithm: jwt algorithm
+    :return: private key object
+    :raises: Exception if algorithm is not supported
+    """
+    if algorithm.startswith(('RS', 'PS')):
+        return rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+    if algorithm in curves:
+        return ec.generate_private_key(curves[algorithm][0](), default_backend())
+    if algorithm == 'EdDSA':
+        return ed25519.Ed25519PrivateKey.generate()
+
+    raise Exception(f'unsupported jwt algorithm {algorithm}')
+
+
+def _new_key_entry(algorithm: str):
+    """
+    generate a new keyring entry
+    :param algorithm: jwt algorithm
+    :return: keyring entry dict
+    """
+    if algorithm.startswith('HS'):
+        return {"alg": algorithm, "secret": secrets.token_hex(256),
+                "created_at": int(time()), "retires_at": None}
+
+    private_key = _gen_private_key(algorithm)
+    return {
+        "alg": algorithm,
+        "created_at": int(time()),
+        "retires_at": None,
+        "private": private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()).decode(),
+        "public": private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    }
+
+
+def gen_key(algorithm: str = None):
+    """
+    generate the jwt signing key
+    :param algorithm: jwt algorithm, defaults to config['jwt']['algorithm'] or HS256
+    :return: key id of the new key
+    :raises: Exception if a signing key or secret already exist
+    """
+    global _jwks_cache
+    with config.transaction():
+        if 'jwt' not in config:
+            config['jwt'] = {}
+        if 'active_kid' in config['jwt'] or 'secret' in config['jwt']:
+            raise Exception('jwt key already exists')
+
+        algorithm = algorithm or config['jwt'].get('algorithm', 'HS256')
+        kid = secrets.token_hex(8)
+        config['jwt'].setdefault('keys', {})[kid] = _new_key_entry(algorithm)
+        config['jwt']['active_kid'] = kid
+
+    _jwks_cache = None
+    return kid
+
+
+def rotate_key(algorithm: str = None, retire_after: int = None, keep: int = None):
+    """
+    make a new signing key active, the previous one keeps verifying
+    tokens until it retires, so no session is logged out by a rotation
+    :param algorithm: jwt algorithm, defaults to config['jwt']['algorithm'] or HS256
+    :param retire_after: seconds the previous key keeps verifying,
+                         defaults to config['jwt']['max_ttl'] or 7 days
+    :param keep: maximum number of previous keys kept,
+                 defaults to config['jwt']['max_previous_keys'] or 3
+    :return: key id of the new key
+    """
+    global _jwks_cache
+    with config.transaction():
+        if 'jwt' not in config:
+            config['jwt'] = {}
+        jwt_config = config['jwt']
+        keys = jwt_config.setdefault('keys', {})
+
+        now = int(time())
+        if retire_after is None:
+            retire_after = jwt_config.get('max_ttl', 7 * 24 * 3600)
+        if keep is None:
+            keep = jwt_config.get('max_previous_keys', 3)
+
+        if 'secret' in jwt_config and LEGACY_KID not in keys:
+            keys[LEGACY_KID] = {"alg": "HS256", "secret": jwt_config['secret'],
+                                "created_at": 0, "retires_at": now + retire_after}
+        previous_kid = jwt_config.get('active_kid')
+        if previous_kid in keys:
+            keys[previous_kid]['retires_at'] = now + retire_after
+
+        for kid in [kid for kid, entry in keys.items()
+                    if entry.get('retires_at') is not None and entry['retires_at'] <= now]:
+            del keys[kid]
+        previous = sorted((kid for kid in keys if kid != previous_kid),
+                          key=lambda kid: keys[kid]['created_at'], reverse=True)
+        for kid in previous[max(0, keep - 1):]:
+            del keys[kid]
+        if LEGACY_KID not in keys:
+            jwt_config.pop('secret', None)
+
+        kid = secrets.token_hex(8)
+        keys[kid] = _new_key_entry(algorithm or jwt_config.get('algorithm', 'HS256'))
+        jwt_config['active_kid'] = kid
+
+    _key_cache.clear()
+    _jwks_cache = None
+    return kid
+
+
+@config.on_change
+def _keyring_changed(changed: set):
+    """ drop the cached keys when another process changed the keyring """
+    global _jwks_cache
+    if 'jwt' in changed:
+        _key_cache.clear()
+        _jwks_cache = None
+
+
+def refresh_keyring():
+    """
+    reload the keyring now if the config file changed on disk,
+    running workers are otherwise updated by the config watcher
+    :return: True if the keyring was reloaded
+    """
+    changed = config.check()
+    return changed is not None and 'jwt' in changed
+
+
+def load_keys():
+    """
+    drop the cached keys and parse every key of the keyring,
+    so a new worker signs and verifies without parsing a key on its first requests
+    :return: number of keys loaded
     """
-    generate a new jwt token
+    global _jwks_cache
+    _key_cache.clear()
+    _jwks_cache = None
+    refresh_keyring()
+    for kid in config.get('jwt', {}).get('keys', {}):
+        get_key(kid)
+    return len(_key_cache)
+
+
+def _load_key(kid: str):
+    """
+    parse a keyring entry into key objects
+    :param kid: key id
+    :return: algorithm, signing key, verification key, retires_at
+    :raises InvalidTokenError: if key id is unknown
+    """
+    jwt_config = config.get('jwt', {})
+    entry = jwt_config.get('keys', {}).get(kid)
+    if entry is None and kid == LEGACY_KID and 'secret' in jwt_config:
+        entry = {"alg": "HS256", "secret": jwt_config['secret']}
+    if entry is None:
+        raise InvalidTokenError('unknown key id')
+
+    algorithm, retires_at = entry['alg'], entry.get('retires_at')
+    if 'secret' in entry:
+        return algorithm, entry['secret'], entry['secret'], retires_at
+
+    private_key = serialization.load_pem_private_key(
+        entry['private'].encode(), password=None, backend=default_backend())
+    public_key = serialization.load_pem_public_key(
+        entry['public'].encode(), backend=default_backend())
+    return algorithm, private_key, public_key, retires_at
+
+
+def get_key(kid: str):
+    """
+    get parsed key objects, cached per key id
+    an unknown kid reloads the keyring once, in case another process rotated it
+    :param kid: key id
+    :return: algorithm, signing key, verification key, retires_at
+    :raises InvalidTokenError: if key id is unknown
+    """
+    key = _key_cache.get(kid)
+    if key is None:
+        try:
+            key = _load_key(kid)
+        except InvalidTokenError:
+            if not refresh_keyring():
+                raise
+            key = _load_key(kid)
+        _key_cache[kid] = key
+    return key
+
+
+def _b64(value: bytes):
+    """ base64url without padding """
+    return urlsafe_b64encode(value).rstrip(b'=').decode()
+
+
+def _int_b64(value: int, length: int = None):
+    """ base64url of a big endian unsigned int """
+    length = length or (value.bit_length() + 7) // 8
+    return _b64(value.to_bytes(length, 'big'))
+
+
+def _to_jwk(kid: str, algorithm: str, public_key):
+    """
+    serialize a public key into a JWK
+    :param kid: key id
+    :param algorithm: jwt algorithm
+    :param public_key: public key object
+    :return: JWK dict
+    """
+    jwk = {"kid": kid, "alg": algorithm, "use": "sig"}
+    if isinstance(public_key, rsa.RSAPublicKey):
+        numbers = public_key.public_numbers()
+        jwk.update(kty="RSA", n=_int_b64(numbers.n), e=_int_b64(numbers.e))
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        numbers = public_key.public_numbers()
+        _, crv, size = curves[algorithm]
+        jwk.update(kty="EC", crv=crv,
+                   x=_int_b64(numbers.x, size), y=_int_b64(numbers.y, size))
+    else:
+        raw = public_key.public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw)
+        jwk.update(kty="OKP", crv="Ed25519", x=_b64(raw))
+    return jwk
+
+
+def jwks():
+    """
+    get the public verification keys as a JWK set,
+    symmetric keys are never published
+    :return: JWKS dict
+    """
+    global _jwks_cache
+    if _jwks_cache is None:
+        keys = list()
+        for kid, entry in config.get('jwt', {}).get('keys', {}).items():
+            if 'public' not in entry:
+                continue
+            algorithm, _, public_key, _ = get_key(kid)
+            keys.append(_to_jwk(kid, algorithm, public_key))
+        _jwks_cache = {"keys": keys}
+
+    return _jwks_cache
+
+
+@timed('jwt_encode')
+def gen_jwt(sid: str, uid: str, ttl: int):
+    """
+    generate a new jwt token, signed with the active key
+    or the legacy HS256 secret if no key was generated
     :param sid: session id
     :param uid: user_id as string
     :param ttl: time to live in seconds
-    :param algorithm: jwt algorithm used (defaults to HS256)
-    :return: jwt token (str), payload
+    :return: jwt token (str), payload with iat and exp as epoch seconds
     """
-    iat = datetime.utcnow()
-    exp = iat + timedelta(seconds=ttl)
+    iat = int(time())
+    exp = iat + int(ttl)
 
     payload = {
         "sid": sid,
@@ -51,18 +347,30 @@ def gen_jwt(sid: str, uid: str, ttl: int, algorithm='HS256'):
         "uid": uid
     }
 
-    return jwt.encode(payload, key=get_secret(),
-                      algorithm=algorithm), payload
+    kid = config.get('jwt', {}).get('active_kid')
+    if kid is None:
+        return jwt.encode(payload, key=get_secret(),
+                          algorithm='HS256'), payload
 
+    algorithm, signing_key, _, _ = get_key(kid)
+    return jwt.encode(payload, key=signing_key, algorithm=algorithm,
+                      headers={"kid": kid}), payload
 
-def verify_jwt(token: str, algorithm='HS256'):
+
+@timed('jwt_decode')
+def verify_jwt(token: str):
     """
-    verify a jwt token
+    verify a jwt token with the key named by its kid header
+    tokens without a kid are verified with the legacy HS256 secret
     :param token: jwt token (str)
-    :param algorithm: jwt algorithm used (defaults to HS256)
     :return: payload if jwt is valid
     :raises ExpiredSignatureError: if signature is expired
     :raises InvalidSignatureError: if signature is not valid
     :raises InvalidTokenError: for the rest of the token errors
     """
-    return jwt.decode(token, get_secret(), verify=True, algorithm=algorithm)
+    kid = jwt.get_unverified_header(token).get('kid', LEGACY_KID)
+    algorithm, _, verification_key, retires_at = get_key(kid)
+    if retires_at is not None and retires_at <= time():
+        raise InvalidTokenError('retired key id')
+
+    return jwt.decode(token, verification_key, verify=True, algorithms=[algorithm])
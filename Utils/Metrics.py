@@ -0,0 +1,249 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+import asyncio
+
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# error branch of the request being handled, set by err_resp
+error_branch = ContextVar('error_branch', default='ok')
+
+
+def _format_labels(names, values):
+    """ render a prometheus label set """
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=(), collect=None):
+        """
+        initialize a new counter, incremented with inc
+        or read from a callback at exposition time
+        :param name: metric name
+        :param description: metric help text
+        :param labels: label names
+        :param collect: callable returning {label values tuple: value},
+                        values must only grow until the process restarts
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._collect = collect
+        self._values = dict()
+        self._lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        """
+        increment the counter
+        :param label_values: label values, in the order of labels
+        :param amount: increment
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self):
+        """ :returns: exposition lines """
+        if self._collect is not None:
+            values = self._collect().items()
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+                for label_values, value in values]
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        initialize a new histogram
+        :param name: metric name
+        :param description: metric help text
+        :param labels: label names
+        :param buckets: upper bounds of the buckets in seconds
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., sum, count]
+        self._values = dict()
+        self._lock = Lock()
+
+    def observe(self, value, *label_values):
+        """
+        record an observation
+        :param value: observed value
+        :param label_values: label values, in the order of labels
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *label_values):
+        """
+        time a block of code
+        :param label_values: label values, in the order of labels
+        :returns: context manager
+        """
+        return _Timer(self, label_values)
+
+    def expose(self):
+        """ :returns: exposition lines """
+        with self._lock:
+            values = [(label_values, list(series)) for label_values, series in self._values.items()]
+
+        lines = list()
+        for label_values, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labels + ('le',), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels + ('le',), label_values + ('+Inf',))
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Gauge:
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), collect=None):
+        """
+        initialize a new gauge read from a callback at exposition time
+        :param name: metric name
+        :param description: metric help text
+        :param labels: label names
+        :param collect: callable returning {label values tuple: value}
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._collect = collect
+
+    def expose(self):
+        """ :returns: exposition lines """
+        return [f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+                for label_values, value in self._collect().items()]
+
+
+class _Timer:
+
+    def __init__(self, histogram, label_values):
+        self._histogram = histogram
+        self._label_values = label_values
+        self._start = None
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(perf_counter() - self._start, *self._label_values)
+        return False
+
+
+class Registry:
+
+    def __init__(self):
+        """ initialize a new metrics registry """
+        self._metrics = dict()
+
+    def register(self, metric):
+        """
+        register a metric, registering a name twice returns the first metric
+        :param metric: metric instance
+        :returns: registered metric
+        """
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labels=(), collect=None):
+        """ register a new counter, read from collect if given """
+        return self.register(Counter(name, description, labels, collect))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        """ register a new histogram """
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def gauge(self, name, description, labels=(), collect=None):
+        """ register a new callback gauge """
+        return self.register(Gauge(name, description, labels, collect))
+
+    def expose(self):
+        """
+        render every metric in the prometheus text format
+        :returns: exposition text
+        """
+        lines = list()
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_total = registry.counter(
+    'cherryauth_requests_total', 'handled requests',
+    labels=('route', 'status', 'branch'))
+request_latency = registry.histogram(
+    'cherryauth_request_duration_seconds', 'request latency per route',
+    labels=('route', 'branch'))
+stage_latency = registry.histogram(
+    'cherryauth_stage_duration_seconds', 'latency per request path stage',
+    labels=('stage',))
+
+
+def timed(stage):
+    """
+    decorator timing a function, sync or async, as a request path stage
+    :param stage: stage name
+    :returns: decorator
+    """
+    def decorator(fn):
+        observe = stage_latency.observe
+
+        if asyncio.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    observe(perf_counter() - start, stage)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(perf_counter() - start, stage)
+        return wrapper
+
+    return decorator
@@ -1,6 +1,131 @@
 import json
 import os
-from threading import Thread
+import stat
+import atexit
+import logging
+import mmap
+import struct
+import tempfile
+from hashlib import blake2b
+from functools import wraps
+from contextlib import contextmanager, nullcontext
+from collections.abc import MutableMapping
+from threading import Thread, Event, Lock, RLock, Condition, local, get_ident
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks, processes are not excluded
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class RWLock:
+
+    def __init__(self):
+        """
+        initialize a new readers-writer lock, held by many readers
+        or by one writer, waiting writers go before new readers,
+        both sides are reentrant and the writer may also read
+        """
+        self._condition = Condition(Lock())
+        self._readers = 0
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+        self._local = local()
+
+    @contextmanager
+    def read(self):
+        """ hold the lock shared with other readers """
+        reads = getattr(self._local, 'reads', 0)
+        if reads or self._writer == get_ident():
+            self._local.reads = reads + 1
+            try:
+                yield
+            finally:
+                self._local.reads = reads
+            return
+
+        with self._condition:
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        """ hold the lock exclusively """
+        me = get_ident()
+        with self._condition:
+            if self._writer != me:
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._condition.wait()
+                finally:
+                    self._waiting_writers -= 1
+                self._writer = me
+            self._writes += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writes -= 1
+                if not self._writes:
+                    self._writer = None
+                    self._condition.notify_all()
+
+
+def _updates(method):
+    """ run a method that updates the database holding its write lock """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _reads(method):
+    """ run a method that reads the database holding its read lock """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _signature(st):
+    """ identify a version of a file from its stat """
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _file_signature(path):
+    """ signature of the file at path, None if missing """
+    try:
+        return _signature(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+
+def _digest(data: bytes):
+    """ identify a version of a db file """
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+def _header(digest: str):
+    """ first line of a journal, naming the db file version it applies to """
+    return json.dumps({'snapshot': digest}).encode() + b'\n'
 
 
 class OrangeBase:
@@ -31,32 +156,33 @@ class OrangeBase:
 
     def get(self, key, default=None):
         """
-        get value assocaited with a key
+        get value assocaited with a key, a single
+        lookup that needs no lock under the GIL
         :param key: targeted key value
         :param default: default value
         :returns: value or default value
         """
-        if key not in self._db:
-            return default
-
-        return self._db[key]
+        return self._db.get(key, default)
 
+    @_updates
     def set(self, key, value, overwrite=True, dump=True):
         """
         set a new value for the given key
         :param key: targeted key
         :param value: associated value
         :param overwrite: would not overwrite if set to False
-        :param dump: would not dump if set to True, for bulk set
+        :param dump: would not dump if set to False, for bulk set
         :returns True: on success
         """
         if not overwrite and key in self._db:
             return False
 
         self._db[key] = value
-        self.dump(force=False)
+        if dump:
+            self._changed('set', key, value)
         return True
 
+    @_updates
     def setm(self, *args, overwrite=True):
         """
         set many new value and keys
@@ -64,12 +190,13 @@ class OrangeBase:
         :param overwrite: would not overwrite if set to False
         :returns: True on success
         """
-        for key, value in args:
-            self.set(key, value, overwrite, False)
+        items = [(key, value) for key, value in args
+                 if self.set(key, value, overwrite, False)]
 
-        self.dump(force=False)
+        self._changed('setm', items)
         return True
 
+    @_updates
     def delete(self, key):
         """
         delete the value associated with key
@@ -80,16 +207,17 @@ class OrangeBase:
             return False
 
         del self._db[key]
-        self.dump(force=False)
+        self._changed('delete', key)
         return True
 
+    @_updates
     def clear(self):
         """
         clear the entire database
         :returns: True on success
         """
         self._db.clear()
-        self.dump(force=False)
+        self._changed('clear')
         return True
 
     def has(self, key):
@@ -100,6 +228,7 @@ class OrangeBase:
         """
         return key in self._db
 
+    @_updates
     def pop(self, key, default=None):
         """
         pop an item from the database
@@ -107,10 +236,14 @@ class OrangeBase:
         :param default: default value
         :returns: value or default
         """
-        value = self._db.pop(key, default)
-        self.dump(force=False)
+        if key not in self._db:
+            return default
+
+        value = self._db.pop(key)
+        self._changed('delete', key)
         return value
 
+    @_updates
     def incrby(self, key, increment):
         """
         incremenet the interger value of the given field
@@ -130,6 +263,7 @@ class OrangeBase:
 
         return False
 
+    @_reads
     def getm(self, *args, default=None):
         """
         get the values of the given fields
@@ -140,6 +274,7 @@ class OrangeBase:
         """
         return [self.get(key, default) for key in args]
 
+    @_updates
     def setnx(self, key, value):
         """
         set the value for the given key only if the
@@ -195,6 +330,7 @@ class OrangeBase:
         """
         return len(self[key])
 
+    @_updates
     def lappend(self, key, value):
         """
         append a new value to a list
@@ -203,7 +339,7 @@ class OrangeBase:
         :returns: True on success
         """
         self._db[key].append(value)
-        self.dump(force=False)
+        self._changed('lappend', key, value)
         return True
 
     def ldellist(self, key):
@@ -216,6 +352,7 @@ class OrangeBase:
         del self[key]
         return length
 
+    @_updates
     def ldelvalue(self, key, value):
         """
         delete a value from list
@@ -224,9 +361,10 @@ class OrangeBase:
         :returns: True on success
         """
         self[key].remove(value)
-        self.dump(force=False)
+        self._changed('ldelvalue', key, value)
         return True
 
+    @_updates
     def ldelindex(self, key, index):
         """
         delete a value from list by its index
@@ -235,7 +373,7 @@ class OrangeBase:
         :returns: True on success
         """
         del self[key][index]
-        self.dump(force=False)
+        self._changed('ldelindex', key, index)
         return True
 
     def lhas(self, key, value):
@@ -247,6 +385,7 @@ class OrangeBase:
         """
         return value in self[key]
 
+    @_updates
     def lextend(self, key, sec):
         """
         extend the list with a sequence
@@ -254,10 +393,12 @@ class OrangeBase:
         :param sec: new sequence
         :returns: True on success
         """
+        sec = list(sec)
         self[key].extend(sec)
-        self.dump(force=False)
+        self._changed('lextend', key, sec)
         return True
 
+    @_updates
     def lpop(self, key):
         """
         pop the last value in the list
@@ -265,9 +406,19 @@ class OrangeBase:
         :returns: popped value from list
         """
         val = self[key].pop()
-        self.dump(force=False)
+        self._changed('lpop', key)
         return val
 
+    def _changed(self, op, *args):
+        """
+        store an update of this database, in the
+        journal if there is one, else with a dump
+        :param op: update name, see _ops
+        :param args: update arguments
+        """
+        return self._record([], op, args)
+
+    @_reads
     def copy(self):
         """make a copy of the database's dictionary"""
         return self._db.copy()
@@ -285,53 +436,506 @@ class OrangeBase:
         return self._db.items()
 
 
+def _path_db(db, path):
+    """ the dict at a child path, created if missing """
+    for div in path:
+        if div not in db:
+            db[div] = dict()
+        db = db[div]
+    return db
+
+
+# journaled updates, replayed on the dict at their path
+_ops = {
+    'set': lambda db, key, value: db.__setitem__(key, value),
+    'setm': lambda db, items: db.update(items),
+    'delete': lambda db, key: db.pop(key, None),
+    'clear': lambda db: db.clear(),
+    'lappend': lambda db, key, value: db[key].append(value),
+    'lextend': lambda db, key, values: db[key].extend(values),
+    'ldelvalue': lambda db, key, value: db[key].remove(value),
+    'ldelindex': lambda db, key, index: db[key].__delitem__(index),
+    'lpop': lambda db, key: db[key].pop()
+}
+
+
 class Orange(OrangeBase):
 
-    def __init__(self, file_path, auto_dump=True, load=True):
+    def __init__(self, file_path, auto_dump=True, load=True, debounce_ms=50,
+                 journal=False, compact_bytes=1 << 20):
         """
         initialize a new Orange database
         :param file_path: path to the db file
-        :param auto_dump: automatically store db on updates
+        :param auto_dump: automatically store db on updates, in the background
         :param load: will load database if is True
+        :param debounce_ms: updates within this many milliseconds
+                            are stored together with a single dump
+        :param journal: store updates by appending them to file_path + '.log'
+                        instead of dumping the whole database, processes sharing
+                        the file append to the same journal under its lock
+        :param compact_bytes: journal size over which it is folded into the db file
         """
+        self._lock = RWLock()
+        self._file_lock = RLock()
+        self._lock_file = None
+        self._threads_lock = Lock()
+        self._signature = None
+        self._journal_signature = None
+        self._callbacks = list()
+        self._watcher = None
+        self._unwatched = Event()
         self._file_path = os.path.expanduser(file_path)
         self._auto_dump = auto_dump
+        self._debounce = debounce_ms / 1000
+        self._journal_path = self._file_path + '.log' if journal else None
+        self._compact_bytes = compact_bytes
+        self._journal = None
+        self._journal_size = 0
         self._db = None
+        self._dirty = False
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = None
+        self.counters = {"dumps": 0, "deferred": 0, "dump_errors": 0,
+                         "journaled": 0, "compactions": 0}
         if load:
             self._load()
 
+    @property
+    def file_path(self):
+        """path to the db file"""
+        return self._file_path
+
+    def reload(self):
+        """
+        reload the database from local storage,
+        discarding changes that were not dumped
+        :returns: True on success
+        """
+        return self._load()
+
+    @_updates
     def _load(self):
         """
-        load the database from local storage
+        load the database from local storage,
+        replaying the journal over it if there is one,
+        under the file lock so no record is read half appended
         :returns: True on success
         """
-        if os.path.exists(self._file_path):
+        with self._locked_file() if self._journal_path else nullcontext():
+            data = b''
+            self._signature = None
+            if os.path.exists(self._file_path):
+                with open(self._file_path, "rb") as f:
+                    data = f.read()
+                    self._signature = _signature(os.fstat(f.fileno()))
             try:
-                self._db = json.load(open(self._file_path, "r"))
+                self._db = json.loads(data) if data else dict()
             except ValueError:
-                # in case the file is empty
                 self._db = dict()
-        else:
-            self._db = dict()
+
+            self._dirty = False
+            if self._journal_path:
+                self._replay(_digest(data))
+        return True
+
+    def _replay(self, digest):
+        """
+        apply the journal to the loaded database, a journal
+        started on another version of the db file is dropped,
+        a record torn by a crash is cut off with everything after it
+        :param digest: digest of the loaded db file
+        """
+        self._close_journal()
+        self._journal_size = 0
+        self._journal_signature = None
+        if not os.path.exists(self._journal_path):
+            return
+
+        with open(self._journal_path, "rb") as f:
+            lines = f.readlines()
+        try:
+            header = json.loads(lines[0]) if lines else None
+        except ValueError:
+            header = None
+        if header is None or header.get('snapshot') != digest:
+            logger.warning("dropping journal %s of another version of %s",
+                           self._journal_path, self._file_path)
+            os.unlink(self._journal_path)
+            return
+
+        offset = len(lines[0])
+        for line in lines[1:]:
+            try:
+                path, op, *args = json.loads(line)
+            except ValueError:
+                logger.warning("cutting torn journal record at %s:%d",
+                               self._journal_path, offset)
+                os.truncate(self._journal_path, offset)
+                break
+            _ops[op](_path_db(self._db, path), *args)
+            offset += len(line)
+        self._journal_size = offset
+        self._journal_signature = _file_signature(self._journal_path)
+
+    def _journal_replaced(self):
+        """ check whether another process compacted the open journal into the db file """
+        try:
+            return os.stat(self._journal_path).st_ino != os.fstat(self._journal.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _open_journal(self):
+        """
+        open the journal for appending, started on the current db file,
+        reopened if another process replaced it while compacting
+        """
+        if self._journal is not None:
+            if not self._journal_replaced():
+                return self._journal
+            self._close_journal()
+
+        if not os.path.exists(self._journal_path):
+            data = b''
+            if os.path.exists(self._file_path):
+                with open(self._file_path, "rb") as f:
+                    data = f.read()
+            self._write_file(self._journal_path, _header(_digest(data)))
+        self._journal = open(self._journal_path, "ab")
+        self._journal_size = self._journal.tell()
+        return self._journal
+
+    def _close_journal(self):
+        """ close the journal file """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _record(self, path, op, args):
+        """
+        store an update, appended to the journal in journal mode,
+        else by scheduling a dump
+        :param path: child path the update applies to
+        :param op: update name, see _ops
+        :param args: update arguments
+        :returns: True if the update will be stored
+        """
+        if not self._journal_path:
+            return self.dump(force=False)
+        if not self._auto_dump:
+            return False
+
+        record = json.dumps([path, op, *args], separators=(',', ':')).encode() + b'\n'
+        with self._locked_file():
+            # records other processes appended since the last load are left to check()
+            current = (_file_signature(self._file_path) == self._signature
+                       and _file_signature(self._journal_path) == self._journal_signature)
+            journal = self._open_journal()
+            journal.write(record)
+            journal.flush()
+            self._journal_size = journal.tell()
+            if current:
+                self._journal_signature = _signature(os.fstat(journal.fileno()))
+        self.counters["journaled"] += 1
+        if self._journal_size > self._compact_bytes:
+            self._start()
+            self._wakeup.set()
+        return True
+
+    @staticmethod
+    def _write_file(path, data):
+        """
+        atomically replace the file at path with data,
+        written to a temporary file in the same directory,
+        synced and renamed over it, so a crash leaves either
+        the previous or the new version, never a truncated one
+        :param path: destination path
+        :param data: file content as bytes, or an iterable of bytes chunks
+        :returns: signature of the new file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in ((data,) if isinstance(data, bytes) else data):
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+                if os.path.exists(path):
+                    os.fchmod(f.fileno(), stat.S_IMODE(os.stat(path).st_mode))
+                signature = _signature(os.fstat(f.fileno()))
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        return signature
+
+    @contextmanager
+    def _locked_file(self):
+        """
+        hold the advisory lock of the db file, excluding other
+        processes writing it, reentrant within a thread
+        """
+        with self._file_lock:
+            if self._lock_file is not None:
+                yield
+                return
+
+            lock_file = open(self._file_path + '.lock', 'a')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                self._lock_file = lock_file
+                yield
+            finally:
+                self._lock_file = None
+                lock_file.close()
+
+    def _write(self, path):
+        """
+        atomically write the database to path, see _write_file,
+        in journal mode the journal is folded into the new db file
+        and a new one is started on it, after reloading the records
+        other processes appended so the compaction keeps them
+        :param path: destination path
+        :returns: True on success
+        """
+        if path != self._file_path:
+            with self._lock.read():
+                self._write_file(path, json.dumps(self._db).encode())
+            return True
+
+        # without automatic dumps nothing was journaled, the database is written as it is
+        shared = self._journal_path and self._auto_dump
+        changed = None
+        with self._lock.write() if shared else self._lock.read(), self._locked_file():
+            if shared:
+                changed = self._reload_if_changed()
+            data = json.dumps(self._db).encode()
+            self._signature = self._write_file(path, data)
+            self.counters["dumps"] += 1
+            if self._journal_path:
+                self._close_journal()
+                self._journal_signature = self._write_file(self._journal_path, _header(_digest(data)))
+                self._journal_size = 0
+                self.counters["compactions"] += 1
+        self._notify(changed)
         return True
 
     def dump(self, force=True, path=None):
         """
-        dumps the current database into the file
+        dumps the current database into the file, a forced dump is
+        written before returning, an automatic one in the background
         :param force: if set to true would ignore _auto_dump value
         :param path: optional path could also be provided
         :returns: True on success
         """
-        if force or self._auto_dump:
-            path = os.path.expanduser(path) if path else self._file_path
-            thread = Thread(target=json.dump,
-                            args=(self._db, open(path, "w")))
-            thread.start()
-            thread.join()
+        if force:
+            if path:
+                return self._write(os.path.expanduser(path))
+            self._dirty = False
+            return self._write(self._file_path)
+
+        if self._auto_dump:
+            self._dirty = True
+            self.counters["deferred"] += 1
+            self._start()
+            self._wakeup.set()
             return True
 
         return False
 
+    def flush(self):
+        """
+        write pending automatic dumps now,
+        in journal mode sync the journal to disk
+        :returns: True if there was anything to write
+        """
+        if self._journal_path:
+            with self._lock.write():
+                if self._journal is None:
+                    return False
+                os.fsync(self._journal.fileno())
+                return True
+
+        if not self._dirty:
+            return False
+
+        self._dirty = False
+        return self._write(self._file_path)
+
+    def compact(self):
+        """
+        fold the journal into the db file and start a new one
+        :returns: True on success
+        """
+        return self.dump(force=True)
+
+    def _run(self):
+        """
+        dump in the background, once per burst of updates,
+        in journal mode compact the journal once it is too large
+        """
+        while not self._stopped.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # let the rest of the burst land before writing
+            self._stopped.wait(self._debounce)
+            try:
+                if not self._journal_path:
+                    self.flush()
+                elif self._journal_size > self._compact_bytes:
+                    self.compact()
+            except Exception:
+                self._dirty = True
+                self.counters["dump_errors"] += 1
+                logger.exception("background dump of %s failed", self._file_path)
+
+    def _start(self):
+        """ start the background writer, on first use """
+        if self._thread is not None:
+            return False
+
+        with self._threads_lock:
+            if self._thread is not None:
+                return False
+            self._stopped.clear()
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        atexit.register(self.close)
+        return True
+
+    def close(self):
+        """
+        stop the background writer and write pending dumps
+        :returns: True on success
+        """
+        self.unwatch()
+        thread = self._thread
+        if thread is not None:
+            self._stopped.set()
+            self._wakeup.set()
+            thread.join()
+            self._thread = None
+            atexit.unregister(self.close)
+
+        self.flush()
+        with self._lock.write():
+            self._close_journal()
+        return True
+
+    @contextmanager
+    def transaction(self):
+        """
+        update the database exclusively, across threads and processes,
+        it is reloaded first if another process changed it and dumped
+        once the block exits, or reloaded if the block raises, e.g.
+            with config.transaction():
+                if 'secret' not in config: config['secret'] = new_secret()
+        """
+        with self._lock.write(), self._locked_file():
+            changed = self._reload_if_changed()
+            try:
+                yield self
+            except BaseException:
+                self._load()
+                raise
+            self.dump()
+        self._notify(changed)
+
+    @staticmethod
+    def _changed_keys(old, new):
+        """ top level keys whose values differ between two loaded databases """
+        missing = object()
+        return {key for key in set(old) | set(new)
+                if old.get(key, missing) != new.get(key, missing)}
+
+    def _reload_if_changed(self):
+        """
+        reload the database if its file was replaced since it was loaded,
+        or in journal mode if another process appended to or replaced the journal
+        :returns: set of changed keys, None if the file did not change
+        """
+        if (_file_signature(self._file_path) == self._signature
+                and (not self._journal_path
+                     or _file_signature(self._journal_path) == self._journal_signature)):
+            return None
+
+        with self._lock.write():
+            old = self._db
+            self._load()
+            return self._changed_keys(old, self._db)
+
+    def _notify(self, changed):
+        """ call the change callbacks """
+        if changed is None:
+            return
+        for callback in list(self._callbacks):
+            try:
+                callback(changed)
+            except Exception:
+                logger.exception("change callback of %s failed", self._file_path)
+
+    def check(self):
+        """
+        reload the database if another process changed its file,
+        skipped while automatic dumps are pending, the file would be
+        overwritten by them anyway, changes are reported to on_change callbacks
+        :returns: set of changed top level keys, None if nothing changed
+        """
+        if self._dirty:
+            return None
+
+        changed = self._reload_if_changed()
+        self._notify(changed)
+        return changed
+
+    def on_change(self, callback):
+        """
+        register a callback for changes made by other processes,
+        called with the set of changed top level keys
+        :param callback: callable receiving the changed keys
+        :returns: callback, so it can be used as a decorator
+        """
+        self._callbacks.append(callback)
+        return callback
+
+    def _watch(self, interval):
+        """ check the file until unwatched """
+        while not self._unwatched.wait(interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("reloading %s failed", self._file_path)
+
+    def watch(self, interval=1.0):
+        """
+        check the file for changes made by other processes in the background,
+        a stat per interval, the file is only read when it changed
+        :param interval: seconds between checks
+        :returns: True if the watcher was started
+        """
+        with self._threads_lock:
+            if self._watcher is not None:
+                return False
+            self._unwatched.clear()
+            self._watcher = Thread(target=self._watch, args=(interval,), daemon=True)
+            self._watcher.start()
+        return True
+
+    def unwatch(self):
+        """
+        stop watching the file
+        :returns: True on success
+        """
+        watcher = self._watcher
+        if watcher is not None:
+            self._unwatched.set()
+            watcher.join()
+            self._watcher = None
+        return True
+
 
 class OrangeChild(OrangeBase):
 
@@ -346,6 +950,7 @@ class OrangeChild(OrangeBase):
             raise Exception("path is not valid")
 
         self._parent = parent
+        self._lock = parent._lock
         self._db = None
         self._load_child_db()
 
@@ -372,6 +977,15 @@ class OrangeChild(OrangeBase):
         """ dumpt the child database """
         return self._parent.dump(*args, **kwargs)
 
+    def flush(self):
+        """ write pending automatic dumps of the parent database """
+        return self._parent.flush()
+
+    def _record(self, path, op, args):
+        """ store an update under this child's path """
+        return self._parent._record(self._path + path, op, args)
+
+    @_updates
     def clear(self):
         """ clear child database """
         parent = self._parent._db
@@ -379,6 +993,301 @@ class OrangeChild(OrangeBase):
             parent = parent[div]
 
         parent[self._path[-1]] = dict()
-        self.dump(force=False)
         self._load_child_db()
-        return True
\ No newline at end of file
+        self._changed('clear')
+        return True
+
+
+# mapped file layout: magic, then records of key length, value length,
+# utf-8 key and json value, then the hash index, a bucket of key hash
+# and record offset per slot, offset 0 marking an empty slot, then the trailer
+_map_magic = b'ORNGMAP1'
+_record_header = struct.Struct('>II')
+_bucket = struct.Struct('>QQ')
+_trailer = struct.Struct('>QQQ8s')
+
+
+def _key_hash(key: bytes):
+    """ 64 bit hash of an encoded key """
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), 'big')
+
+
+class MappedFile:
+
+    def __init__(self, file_path):
+        """
+        open a mapped file read only, nothing but the trailer is read
+        :param file_path: path to a file written by MappedDict.encode
+        :raises ValueError: if the file is not a mapped file
+        """
+        with open(file_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if (len(self._mm) < len(_map_magic) + _trailer.size
+                or self._mm[:len(_map_magic)] != _map_magic):
+            raise ValueError(f'{file_path} is not a mapped orange file')
+
+        self._index_offset, self._buckets, self._count, magic = \
+            _trailer.unpack_from(self._mm, len(self._mm) - _trailer.size)
+        if magic != _map_magic:
+            raise ValueError(f'{file_path} is truncated')
+
+    def __len__(self):
+        return self._count
+
+    def find(self, key: bytes):
+        """
+        find a record through the hash index
+        :param key: encoded key
+        :return: record offset or None if missing
+        """
+        if not self._buckets:
+            return None
+
+        key_hash = _key_hash(key)
+        slot = key_hash & (self._buckets - 1)
+        while True:
+            stored_hash, offset = _bucket.unpack_from(
+                self._mm, self._index_offset + slot * _bucket.size)
+            if offset == 0:
+                return None
+            if stored_hash == key_hash:
+                key_length, _ = _record_header.unpack_from(self._mm, offset)
+                start = offset + _record_header.size
+                if self._mm[start:start + key_length] == key:
+                    return offset
+            slot = (slot + 1) & (self._buckets - 1)
+
+    def value(self, offset: int):
+        """ raw json value of the record at offset """
+        key_length, value_length = _record_header.unpack_from(self._mm, offset)
+        start = offset + _record_header.size + key_length
+        return self._mm[start:start + value_length]
+
+    def records(self):
+        """
+        stream the records in file order, no value is decoded
+        :return: generator of (key, offset, raw record)
+        """
+        offset = len(_map_magic)
+        while offset < self._index_offset:
+            key_length, value_length = _record_header.unpack_from(self._mm, offset)
+            start = offset + _record_header.size
+            end = start + key_length + value_length
+            yield self._mm[start:start + key_length].decode(), offset, self._mm[offset:end]
+            offset = end
+
+
+class MappedDict(MutableMapping):
+
+    def __init__(self, file_path):
+        """
+        initialize a dict backed by a mapped file, values are decoded
+        on first access and kept, since they may be changed in place,
+        updates are kept in memory until encoded into a new file
+        :param file_path: mapped file, or a json file to convert, or a missing path
+        """
+        self._file_path = file_path
+        self._loaded = dict()
+        self._deleted = set()
+        self._base = None
+        self._length = 0
+        self.decoded = 0
+        self.remap()
+
+    def remap(self):
+        """
+        map the file again, after it was replaced by an encoded copy,
+        values already decoded are kept
+        :return: True on success
+        """
+        self._deleted = set()
+        if not os.path.exists(self._file_path) or not os.path.getsize(self._file_path):
+            self._base = None
+        else:
+            try:
+                self._base = MappedFile(self._file_path)
+            except ValueError:
+                self._base = None
+                with open(self._file_path, "rb") as f:
+                    try:
+                        self._loaded = json.loads(f.read())
+                    except ValueError:
+                        self._loaded = dict()
+
+        self._length = len(self._base or ()) + sum(
+            1 for key in self._loaded if not self._in_base(key))
+        return True
+
+    def _in_base(self, key):
+        """ record offset of a key in the mapped file, None if missing """
+        if self._base is None or not isinstance(key, str) or key in self._deleted:
+            return None
+        return self._base.find(key.encode())
+
+    def __getitem__(self, key):
+        if key in self._loaded:
+            return self._loaded[key]
+
+        offset = self._in_base(key)
+        if offset is None:
+            raise KeyError(key)
+        value = self._loaded[key] = json.loads(self._base.value(offset))
+        self.decoded += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            raise TypeError('keys must be str')
+        if key not in self:
+            self._length += 1
+        self._loaded[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._loaded.pop(key, None)
+        if self._in_base(key) is not None:
+            self._deleted.add(key)
+        self._length -= 1
+
+    def __contains__(self, key):
+        return key in self._loaded or self._in_base(key) is not None
+
+    def __iter__(self):
+        yield from list(self._loaded)
+        base = self._base
+        if base is not None:
+            for key, _, _ in base.records():
+                if key not in self._loaded and key not in self._deleted:
+                    yield key
+
+    def __len__(self):
+        return self._length
+
+    def clear(self):
+        """ drop every item without decoding any """
+        self._loaded = dict()
+        self._deleted = set()
+        self._base = None
+        self._length = 0
+
+    def copy(self):
+        """ decode every item into a dict """
+        return dict(self.items())
+
+    def encode(self):
+        """
+        encode the dict into the mapped file layout, records that
+        were not decoded are copied from the current file as they are
+        :return: generator of bytes chunks
+        """
+        index = list()
+        offset = len(_map_magic)
+        yield _map_magic
+
+        def record(key: bytes, value: bytes):
+            nonlocal offset
+            index.append((_key_hash(key), offset))
+            chunk = _record_header.pack(len(key), len(value)) + key + value
+            offset += len(chunk)
+            return chunk
+
+        base = self._base
+        if base is not None:
+            for key, _, raw in base.records():
+                if key in self._deleted:
+                    continue
+                if key in self._loaded:
+                    yield record(key.encode(), json.dumps(self._loaded[key]).encode())
+                else:
+                    index.append((_key_hash(key.encode()), offset))
+                    offset += len(raw)
+                    yield raw
+
+        for key, value in list(self._loaded.items()):
+            if self._in_base(key) is None:
+                yield record(key.encode(), json.dumps(value).encode())
+
+        buckets = 1
+        while buckets < len(index) * 2:
+            buckets *= 2
+        slots = [(0, 0)] * buckets if index else []
+        for key_hash, record_offset in index:
+            slot = key_hash & (buckets - 1)
+            while slots[slot][1]:
+                slot = (slot + 1) & (buckets - 1)
+            slots[slot] = (key_hash, record_offset)
+
+        yield b''.join(_bucket.pack(*bucket) for bucket in slots)
+        yield _trailer.pack(offset, len(slots), len(index), _map_magic)
+
+
+class OrangeMap(Orange):
+
+    def __init__(self, file_path, auto_dump=True, load=True, debounce_ms=50):
+        """
+        initialize a new Orange database stored in a memory mapped file
+        with an on disk hash index, for stores too large to load whole,
+        opening reads nothing but the index trailer, values are decoded
+        on first access and iteration streams keys from the file
+        :param file_path: path to the db file, a json Orange file is converted on dump
+        :param auto_dump: automatically store db on updates, in the background
+        :param load: will load database if is True
+        :param debounce_ms: updates within this many milliseconds
+                            are stored together with a single dump
+        """
+        super().__init__(file_path, auto_dump=auto_dump, load=load, debounce_ms=debounce_ms)
+
+    @_updates
+    def _load(self):
+        """
+        map the database file
+        :returns: True on success
+        """
+        self._db = MappedDict(self._file_path)
+        self._signature = _file_signature(self._file_path)
+        self._dirty = False
+        return True
+
+    @_reads
+    def get(self, key, default=None):
+        """
+        get value associated with a key, decoded
+        under the read lock as a dump remaps the file
+        :param key: targeted key value
+        :param default: default value
+        :returns: value or default value
+        """
+        return super().get(key, default)
+
+    @_reads
+    def has(self, key):
+        """
+        check whether a value exists in database
+        :param key: targeted key
+        :returns: True if key exists
+        """
+        return super().has(key)
+
+    @staticmethod
+    def _changed_keys(old, new):
+        """ every key, which ones changed is not known without decoding every value """
+        return set(old) | set(new)
+
+    @_updates
+    def _write(self, path):
+        """
+        atomically write the database to path, see _write_file,
+        copying the records that were not decoded as they are
+        :param path: destination path
+        :returns: True on success
+        """
+        if path != self._file_path:
+            self._write_file(path, self._db.encode())
+            return True
+
+        with self._locked_file():
+            self._signature = self._write_file(path, self._db.encode())
+            self.counters["dumps"] += 1
+            self._db.remap()
+        return True
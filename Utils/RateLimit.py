@@ -0,0 +1,181 @@
+from Utils import redis, config
+from Utils.Exceptions import TooManyAttempts
+from Utils.Metrics import registry
+from redis.exceptions import RedisError
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# takes one token from every bucket or from none of them
+# KEYS: bucket keys
+# ARGV: now, then capacity and refill rate per second for each key
+# returns: 1 if allowed else 0, seconds until a token is available
+TOKEN_BUCKET = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    levels[i] = tokens
+end
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'ts', ARGV[1])
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return {1, '0'}
+"""
+
+
+class LocalBuckets:
+
+    def __init__(self, maxsize=100000):
+        """
+        initialize in-process token buckets, used while redis is down
+        each worker then enforces the limits on its own
+        :param maxsize: maximum number of tracked buckets
+        """
+        self._maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, buckets: list, now: float):
+        """
+        take one token from every bucket or from none of them
+        :param buckets: list of (key, capacity, rate per second)
+        :param now: current unix time
+        :return: allowed, seconds until a token is available
+        """
+        with self._lock:
+            levels = list()
+            wait = 0
+            for key, capacity, rate in buckets:
+                tokens, ts = self._buckets.get(key, (capacity, now))
+                tokens = min(capacity, tokens + max(0, now - ts) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                levels.append(tokens)
+
+            if wait > 0:
+                return False, wait
+
+            for (key, _, _), tokens in zip(buckets, levels):
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self._maxsize:
+                self._buckets.popitem(last=False)
+            return True, 0
+
+    def clear(self):
+        """ forget every bucket """
+        with self._lock:
+            self._buckets.clear()
+
+
+class RateLimiter:
+
+    def __init__(self, name: str, limits: dict, local_size=100000):
+        """
+        initialize a new token bucket rate limiter
+        :param name: limiter name, prefixes the redis keys
+        :param limits: {identity: (capacity, period in seconds)}, a bucket
+                       holds capacity attempts and refills fully every period
+        :param local_size: maximum buckets tracked by the local fallback
+        """
+        self.name = name
+        self._limits = {identity: (capacity, capacity / period)
+                        for identity, (capacity, period) in limits.items()}
+        self._script = redis.register_script(TOKEN_BUCKET)
+        self._local = LocalBuckets(local_size)
+        self.counters = {"allowed": 0, "limited": 0, "fallback": 0}
+
+    def _buckets(self, identities: dict):
+        """ bucket key, capacity and rate per limited identity """
+        return [(f"rl:{self.name}:{identity}:{value}", *self._limits[identity])
+                for identity, value in identities.items()
+                if value is not None and identity in self._limits]
+
+    def hit(self, **identities):
+        """
+        count an attempt against every identity's bucket in one round trip,
+        falls back to local buckets if redis is unavailable
+        :param identities: identity name to value, e.g. uid='sh4yy', ip='::1'
+        :return: allowed, seconds until the next attempt is allowed
+        """
+        buckets = self._buckets(identities)
+        if not buckets:
+            return True, 0
+
+        now = time()
+        try:
+            allowed, wait = self._script(
+                keys=[key for key, _, _ in buckets],
+                args=[now] + [value for _, capacity, rate in buckets
+                              for value in (capacity, rate)])
+            allowed, wait = bool(allowed), float(wait)
+        except RedisError:
+            logger.warning("rate limiter %s using local buckets", self.name)
+            self.counters['fallback'] += 1
+            allowed, wait = self._local.take(buckets, now)
+
+        self.counters['allowed' if allowed else 'limited'] += 1
+        return allowed, wait
+
+    def check(self, **identities):
+        """
+        count an attempt against every identity's bucket
+        :param identities: identity name to value, e.g. uid='sh4yy', ip='::1'
+        :return: True if allowed
+        :raises TooManyAttempts: if any bucket is empty
+        """
+        allowed, wait = self.hit(**identities)
+        if not allowed:
+            raise TooManyAttempts(wait)
+        return True
+
+    def reset(self, **identities):
+        """
+        refill the buckets of the given identities
+        :param identities: identity name to value
+        :return: True on success
+        """
+        keys = [key for key, _, _ in self._buckets(identities)]
+        if keys:
+            redis.delete(*keys)
+        self._local.clear()
+        return True
+
+
+login_limiter = RateLimiter(
+    'login',
+    limits={
+        "uid": (config.get('rate_limit', {}).get('uid_attempts', 10),
+                config.get('rate_limit', {}).get('uid_period', 60)),
+        "ip": (config.get('rate_limit', {}).get('ip_attempts', 100),
+               config.get('rate_limit', {}).get('ip_period', 60))
+    },
+    local_size=config.get('rate_limit', {}).get('local_size', 100000)
+)
+
+
+registry.counter(
+    'cherryauth_rate_limit_attempts', 'login attempts by rate limiter outcome',
+    labels=('limiter', 'result'),
+    collect=lambda: {(login_limiter.name, result): count
+                     for result, count in login_limiter.counters.items()})
@@ -0,0 +1,266 @@
+from Utils import redis, config
+from Utils import Serializer
+from Utils.Caching import VerifyCache
+from Utils.Metrics import registry
+from redis.exceptions import RedisError
+from peewee import DateTimeField
+from datetime import datetime
+from functools import wraps
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# cached in place of the row of a key that does not exist
+_MISSING = object()
+
+
+class ReadThrough:
+
+    # every cache, for the metrics
+    caches = list()
+
+    def __init__(self, name, field, ttl=5, negative=False, negative_ttl=2,
+                 maxsize=10000, redis_ttl=60, positive=True):
+        """
+        initialize a new read-through cache for a model finder
+        keyed on one column, rows are kept in an in-process lru
+        in front of redis, shared by every worker
+        :param name: cache name, part of the redis keys
+        :param field: name of the column the finder is keyed on,
+                      its value must never change once the row is written
+        :param ttl: seconds a row is kept in process
+        :param negative: also cache that a key does not exist
+        :param negative_ttl: seconds a missing key is kept, in process and in redis
+        :param maxsize: maximum number of rows kept in process
+        :param redis_ttl: seconds a row is kept in redis, 0 disables redis
+        :param positive: cache rows, when False only missing keys are cached
+        """
+        self.name = name
+        self.field = field
+        self._negative = negative
+        self._negative_ttl = negative_ttl
+        self._redis_ttl = redis_ttl
+        self._positive = positive
+        self._local = VerifyCache(maxsize=maxsize, ttl=max(ttl, negative_ttl))
+        self._ttl = ttl
+        self._finder = None
+        self.counters = {
+            "local_hits": 0,
+            "local_misses": 0,
+            "redis_hits": 0,
+            "redis_misses": 0,
+            "negative_hits": 0,
+            "invalidations": 0
+        }
+        ReadThrough.caches.append(self)
+
+    def _key(self, key):
+        """ redis key of a finder key """
+        return f"rt:{self.name}:{key}"
+
+    @staticmethod
+    def _to_json(row: dict):
+        """ encode a row for redis, keeping datetimes exact """
+        return Serializer.dumps({name: value.isoformat() if isinstance(value, datetime) else value
+                                 for name, value in row.items()})
+
+    @staticmethod
+    def _from_json(model, value: bytes):
+        """ decode a row read from redis """
+        row = Serializer.loads(value)
+        for name, field in model._meta.fields.items():
+            if isinstance(field, DateTimeField) and isinstance(row.get(name), str):
+                row[name] = datetime.fromisoformat(row[name])
+        return row
+
+    @staticmethod
+    def _instance(model, row):
+        """ build a fresh model instance from a cached row """
+        if row is _MISSING:
+            return None
+        instance = model(**row)
+        instance._dirty.clear()
+        return instance
+
+    def get(self, model, key):
+        """
+        look a key up in process, then in redis
+        :param model: model class the rows belong to
+        :param key: finder key
+        :return: hit, model instance or None if the key does not exist
+        """
+        row = self._local.get(key)
+        if row is not None:
+            self.counters["local_hits"] += 1
+            if row is _MISSING:
+                self.counters["negative_hits"] += 1
+            return True, self._instance(model, row)
+        self.counters["local_misses"] += 1
+
+        if not self._redis_ttl:
+            return False, None
+
+        try:
+            value = redis.get(self._key(key))
+        except RedisError:
+            logger.warning("read-through cache %s is unavailable", self.name)
+            return False, None
+        if value is None:
+            self.counters["redis_misses"] += 1
+            return False, None
+
+        self.counters["redis_hits"] += 1
+        if value == b'':
+            self.counters["negative_hits"] += 1
+            self._local.set(key, _MISSING, ttl=self._negative_ttl)
+            return True, None
+
+        row = self._from_json(model, value)
+        self._local.set(key, row, ttl=self._ttl)
+        return True, self._instance(model, row)
+
+    def put(self, key, instance):
+        """
+        cache the result of a finder
+        :param key: finder key
+        :param instance: model instance or None if the key does not exist
+        :return: True if it was cached
+        """
+        if instance is None:
+            if not self._negative:
+                return False
+            row, value, ttl = _MISSING, b'', self._negative_ttl
+        else:
+            if not self._positive:
+                return False
+            row = dict(instance.__data__)
+            value, ttl = self._to_json(row), self._redis_ttl
+
+        self._local.set(key, row, ttl=self._negative_ttl if row is _MISSING else self._ttl)
+        if self._redis_ttl and ttl > 0:
+            try:
+                redis.set(self._key(key), value, ex=ttl)
+            except RedisError:
+                logger.warning("read-through cache %s is unavailable", self.name)
+        return True
+
+    def invalidate(self, *keys):
+        """
+        evict keys from this worker and from redis,
+        other workers keep their rows for at most ttl seconds
+        :param keys: finder keys
+        :return: number of evicted keys
+        """
+        keys = [key for key in keys if key is not None]
+        if not keys:
+            return 0
+
+        for key in keys:
+            self._local.delete(key)
+        self.counters["invalidations"] += len(keys)
+        if self._redis_ttl:
+            try:
+                redis.delete(*(self._key(key) for key in keys))
+            except RedisError:
+                logger.warning("read-through cache %s is unavailable", self.name)
+        return len(keys)
+
+    def invalidate_instance(self, instance, inserted=False):
+        """
+        evict the row of a written model instance
+        :param instance: model instance
+        :param inserted: the row was just inserted, only a cached miss can be stale
+        :return: number of evicted keys
+        """
+        if inserted and not self._negative:
+            return 0
+        return self.invalidate(instance.__data__.get(self.field))
+
+    def __call__(self, finder):
+        """
+        decorate a finder, a classmethod taking a single key,
+        the decorated finder is then attached to the cache
+        :param finder: function of (model, key) returning an instance or None
+        :return: cached finder
+        """
+        @wraps(finder)
+        def wrapper(model, key):
+            hit, instance = self.get(model, key)
+            if hit:
+                return instance
+            instance = finder(model, key)
+            self.put(key, instance)
+            return instance
+
+        self._finder = finder
+        wrapper.cache = self
+        return wrapper
+
+    async def find_async(self, model, key, run):
+        """
+        run the decorated finder without blocking the event loop,
+        the query only goes to the thread pool on a cache miss
+        :param model: model class
+        :param key: finder key
+        :param run: coroutine function running a blocking call, e.g. async_db.run
+        :return: model instance or None
+        """
+        hit, instance = self.get(model, key)
+        if hit:
+            return instance
+        instance = await run(self._finder, model, key)
+        self.put(key, instance)
+        return instance
+
+    def stats(self):
+        """
+        get hit/miss counters and hit ratios per tier
+        :return: dict of counters
+        """
+        stats = dict(self.counters)
+        for tier in ('local', 'redis'):
+            hits, misses = stats[f'{tier}_hits'], stats[f'{tier}_misses']
+            total = hits + misses
+            stats[f'{tier}_hit_ratio'] = hits / total if total else 0.0
+
+        stats['local_size'] = len(self._local)
+        return stats
+
+
+def cache_options(**overrides):
+    """
+    read the model cache options from config['model_cache']
+    :param overrides: options of one cache taking precedence over the config
+    :return: ReadThrough keyword arguments
+    """
+    options = config.get('model_cache', {})
+    enabled = options.get('enabled', True)
+    return dict({
+        'ttl': options.get('ttl', 5) if enabled else 0,
+        'negative_ttl': options.get('negative_ttl', 2) if enabled else 0,
+        'maxsize': options.get('local_size', 10000),
+        'redis_ttl': options.get('redis_ttl', 60) if enabled else 0
+    }, **overrides)
+
+
+def _lookups():
+    """ model cache lookups per cache, tier and result """
+    return {(cache.name, tier, result): cache.counters[f'{tier}_{counter}']
+            for cache in ReadThrough.caches
+            for tier in ('local', 'redis')
+            for result, counter in (('hit', 'hits'), ('miss', 'misses'))}
+
+
+def _hit_ratios():
+    """ model cache hit ratio per cache and tier """
+    return {(cache.name, tier): stats[f'{tier}_hit_ratio']
+            for cache in ReadThrough.caches
+            for stats in (cache.stats(),)
+            for tier in ('local', 'redis')}
+
+
+registry.counter('cherryauth_model_cache_lookups', 'model lookups per cache and tier',
+                 labels=('cache', 'tier', 'result'), collect=_lookups)
+registry.gauge('cherryauth_model_cache_hit_ratio', 'model lookup hit ratio per cache and tier',
+               labels=('cache', 'tier'), collect=_hit_ratios)
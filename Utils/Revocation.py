@@ -0,0 +1,182 @@
+from Utils import redis, config
+from threading import Thread, Event
+from redis.exceptions import RedisError
+from hashlib import blake2b
+from time import time
+import math
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        """
+        initialize a new bloom filter
+        :param capacity: expected number of items
+        :param error_rate: false positive rate at capacity
+        """
+        self._size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, item: str):
+        """ bit positions of an item, double hashing over one digest """
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self._size for i in range(self._hashes))
+
+    def add(self, item: str):
+        """
+        add an item to the filter
+        :param item: targeted item
+        :return: True on success
+        """
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        return True
+
+    def __contains__(self, item: str):
+        """check whether an item may be in the filter"""
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class RevocationList:
+
+    key = "revoked_sids"
+
+    def __init__(self, ttl, sync_interval=5, rebuild_every=60,
+                 capacity=100000, error_rate=0.001):
+        """
+        initialize a new revoked session list
+        revoked session ids live in a redis sorted set scored by
+        revocation time and are replicated into a local bloom filter
+        :param ttl: how long a revocation is kept, the longest jwt lifetime
+        :param sync_interval: seconds between local filter syncs
+        :param rebuild_every: syncs between full filter rebuilds
+        :param capacity: expected number of live revocations
+        :param error_rate: local filter false positive rate
+        """
+        self._ttl = ttl
+        self._sync_interval = sync_interval
+        self._rebuild_every = rebuild_every
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._synced_at = 0
+        self._syncs = 0
+        self._stopped = Event()
+        self._thread = None
+
+    def revoke(self, session_ids: list):
+        """
+        revoke sessions, visible to this worker immediately
+        and to every other worker after their next sync,
+        if redis is unavailable only this worker rejects them,
+        as the local filter reports them and is_revoked fails closed
+        :param session_ids: targeted session ids
+        :return: True if every worker will reject them
+        """
+        if not session_ids:
+            return True
+
+        for sid in session_ids:
+            self._bloom.add(sid)
+        try:
+            redis.zadd(self.key, {sid: time() for sid in session_ids})
+        except RedisError:
+            logger.exception("revoking %d sessions failed", len(session_ids))
+            return False
+        return True
+
+    def is_revoked(self, session_id: str):
+        """
+        check whether a session was revoked, the local filter
+        answers for almost every live session and redis only
+        confirms the rare positive
+        :param session_id: targeted session id
+        :return: True if revoked
+        """
+        if session_id not in self._bloom:
+            return False
+
+        try:
+            return redis.zscore(self.key, session_id) is not None
+        except RedisError:
+            # fail closed, the filter already reported a likely revocation
+            return True
+
+    def sync(self):
+        """
+        prune expired revocations and replicate new ones locally,
+        rebuilding the local filter from scratch every rebuild_every syncs
+        :return: True on success
+        """
+        now = time()
+        redis.zremrangebyscore(self.key, "-inf", now - self._ttl)
+
+        if self._syncs % self._rebuild_every == 0:
+            bloom = BloomFilter(self._capacity, self._error_rate)
+            for sid in redis.zrange(self.key, 0, -1):
+                bloom.add(sid.decode())
+            self._bloom = bloom
+        else:
+            # overlap the previous sync to tolerate clock skew between workers
+            for sid in redis.zrangebyscore(self.key, self._synced_at - 60, "+inf"):
+                self._bloom.add(sid.decode())
+
+        self._synced_at = now
+        self._syncs += 1
+        return True
+
+    def _run(self):
+        """ sync periodically until stopped """
+        while not self._stopped.wait(self._sync_interval):
+            try:
+                self.sync()
+            except RedisError:
+                logger.exception("revocation list sync failed")
+
+    def start(self):
+        """
+        load the revocation list and start the background sync,
+        if redis is unavailable the worker starts anyway and
+        the background sync loads the list once redis is back
+        :return: True on success
+        """
+        if self._thread is not None:
+            return False
+
+        self._syncs = 0
+        try:
+            self.sync()
+        except RedisError:
+            logger.exception("revocation list sync failed, retrying in the background")
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """
+        stop the background sync
+        :return: True on success
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        return True
+
+
+revocations = RevocationList(
+    ttl=config.get('revocation', {}).get('ttl', 7 * 24 * 3600),
+    sync_interval=config.get('revocation', {}).get('sync_interval', 5),
+    rebuild_every=config.get('revocation', {}).get('rebuild_every', 60),
+    capacity=config.get('revocation', {}).get('capacity', 100000),
+    error_rate=config.get('revocation', {}).get('error_rate', 0.001)
+)
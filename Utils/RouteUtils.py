@@ -1,36 +1,223 @@
-from sanic.response import json
+from sanic.response import raw
 from time import time
+from . import Serializer
 import basicauth
 from .Exceptions import *
 from datetime import timedelta
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import namedtuple
+from time import perf_counter
+import math
+from .Metrics import error_branch, requests_total, request_latency, timed
 
 
-def err_resp(code: int, msg: str, err_subcode=None):
+def json_resp(body, status: int = 200, headers=None):
     """
-    generate error response
-    :param code: error code
-    :param msg: error msg
-    :param err_subcode: specific error details
-    :return: JsonResponse
+    generate a json response with the configured serializer
+    :param body: content, or json bytes sent as they are
+    :param status: http status
+    :param headers: extra response headers
+    :return: HTTPResponse
     """
-    return json({
+    if not isinstance(body, bytes):
+        body = Serializer.dumps(body)
+    return raw(body, status=status, headers=headers, content_type="application/json")
+
+
+@lru_cache(maxsize=1024)
+def _error_body(code: int, msg: str, err_subcode=None):
+    """ render an error body once per distinct error """
+    return Serializer.dumps({
         "ok": False,
         "code": code,
         "msg": msg,
         "error_subcode": err_subcode
-    }, status=code)
+    })
+
+
+@timed('serialize')
+def err_resp(code: int, msg: str, err_subcode=None, headers=None):
+    """
+    generate error response
+    :param code: error code
+    :param msg: error msg
+    :param err_subcode: specific error details, must be hashable
+    :param headers: extra response headers
+    :return: HTTPResponse
+    """
+    error_branch.set(msg)
+    return json_resp(_error_body(code, msg, err_subcode), status=code, headers=headers)
+
+
+ErrorTemplate = namedtuple('ErrorTemplate', ('code', 'msg', 'body', 'result', 'headers', 'render'))
+
+
+class ErrorResponses:
+
+    def __init__(self):
+        """
+        initialize a new registry of error responses keyed by exception type,
+        bodies are rendered once by compile instead of on every request
+        """
+        self._errors = dict()  # (route, exception type) -> (code, msg, headers, render)
+        self._templates = None
+        self._resolved = dict()
+
+    def register(self, exc_type, code: int, msg: str, route: str = None, headers=None, render=None):
+        """
+        map an exception type to an error response
+        :param exc_type: exception type, subclasses are matched too
+        :param code: http status
+        :param msg: error msg
+        :param route: only for this route handler's name, overrides the default
+        :param headers: extra response headers
+        :param render: callable(exception) building the response instead,
+                       for errors that carry per request details
+        :return: self
+        """
+        self._errors[(route, exc_type)] = (code, msg, headers, render)
+        self._templates = None
+        return self
+
+    def compile(self):
+        """
+        render the body of every registered error
+        :return: self
+        """
+        self._templates = {
+            key: ErrorTemplate(code, msg, _error_body(code, msg),
+                               Serializer.dumps({"valid": False, "code": code, "msg": msg}),
+                               dict(headers or {}), render)
+            for key, (code, msg, headers, render) in self._errors.items()}
+        self._resolved = dict()
+        return self
 
+    def lookup(self, route: str, exc_type):
+        """
+        find the template of an exception, the closest registered base class
+        wins and a route override wins over the default of the same class
+        :param route: route handler name
+        :param exc_type: exception type
+        :return: ErrorTemplate or None if not registered
+        """
+        key = (route, exc_type)
+        if key not in self._resolved:
+            if self._templates is None:
+                self.compile()
+            template = None
+            for base in exc_type.__mro__:
+                template = self._templates.get((route, base)) or self._templates.get((None, base))
+                if template is not None:
+                    break
+            self._resolved[key] = template
+        return self._resolved[key]
 
-def suc_resp(content):
+    def respond(self, template: ErrorTemplate, error):
+        """
+        build the response of a template
+        :param template: ErrorTemplate
+        :param error: exception instance
+        :return: HTTPResponse
+        """
+        if template.render is not None:
+            return template.render(error)
+        error_branch.set(template.msg)
+        return raw(template.body, status=template.code, headers=template.headers,
+                   content_type="application/json")
+
+    def handle(self, handler):
+        """
+        decorator answering the registered exceptions
+        a route handler raises with their error response
+        :param handler: route handler
+        :return: wrapped handler
+        """
+        route = handler.__name__
+
+        @wraps(handler)
+        async def wrapper(request, *args, **kwargs):
+            try:
+                return await handler(request, *args, **kwargs)
+            except Exception as error:
+                template = self.lookup(route, type(error))
+                if template is None:
+                    raise
+                return self.respond(template, error)
+
+        return wrapper
+
+
+@timed('serialize')
+def suc_resp(content, serialized=None):
     """
     generate success response
     :param content: resp content
-    :return: JsonResponse
+    :param serialized: {key: json bytes} added to the content as they are,
+                       e.g. cached payloads that need no re-encoding
+    :return: HTTPResponse
     """
     content['ok'] = True
     content['timestamp'] = time()
-    return json(content)
+    body = Serializer.dumps(content)
+    if serialized:
+        # content is never empty, so its closing brace can take more members
+        body = body[:-1] + b''.join(b',"%s":%s' % (key.encode(), value)
+                                    for key, value in serialized.items()) + b'}'
+    return json_resp(body)
+
+
+def instrumented(handler):
+    """
+    decorator recording request count and latency of a route
+    labeled by the error branch the handler responded with
+    :param handler: route handler
+    :return: wrapped handler
+    """
+    route = handler.__name__
+
+    @wraps(handler)
+    async def wrapper(request, *args, **kwargs):
+        error_branch.set('ok')
+        status = 500
+        start = perf_counter()
+        try:
+            response = await handler(request, *args, **kwargs)
+            if response is not None:
+                status = response.status
+            return response
+        except Exception:
+            error_branch.set('exception')
+            raise
+        finally:
+            branch = error_branch.get()
+            request_latency.observe(perf_counter() - start, route, branch)
+            requests_total.inc(route, str(status), branch)
+
+    return wrapper
+
+
+def too_many_attempts(error):
+    """
+    generate a rate limited response
+    :param error: TooManyAttempts instance
+    :return: HTTPResponse
+    """
+    retry_after = max(1, math.ceil(error.retry_after))
+    return err_resp(429, "too many attempts", retry_after,
+                    headers={"Retry-After": str(retry_after)})
+
+
+def client_ip(request, trust_forwarded=False):
+    """
+    get the address of the client behind a request
+    :param request: sanic request
+    :param trust_forwarded: use the X-Forwarded-For address, only
+                            safe behind a proxy that overwrites it
+    :return: client address as string
+    """
+    if trust_forwarded and request.remote_addr:
+        return request.remote_addr
+    return request.ip
 
 
 def extract_basic(authorization):
@@ -1,5 +1,19 @@
 import secrets
-import scrypt
+import hashlib
+import hmac
+import struct
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+from Utils import config
+from Utils.Metrics import timed
+
+try:
+    from argon2.low_level import hash_secret_raw, Type
+except ImportError:  # argon2id is optional
+    hash_secret_raw = None
 
 
 # references:
@@ -8,6 +22,26 @@ import scrypt
 # http://split.to/09tF8SB
 
 
+# a stored hash is self describing:
+# version, algorithm id, three algorithm parameters, salt length, salt, digest
+# scrypt parameters are N, r, p and argon2id's are time_cost, memory_cost (KiB), parallelism
+HASH_VERSION = 1
+DIGEST_LENGTH = 32
+_header = struct.Struct('>BBIIIB')
+
+algorithms = {'scrypt': 1, 'argon2id': 2}
+_algorithm_names = {number: name for name, number in algorithms.items()}
+
+default_params = {
+    'scrypt': (16384, 8, 1),
+    'argon2id': (3, 65536, 4)
+}
+
+# hashes written before the format existed are a bare scrypt digest
+# with the salt kept in its own column
+LEGACY_PARAMS = ('scrypt', (16384, 8, 1))
+
+
 def gen_salt(length=32) -> bytes:
     """
     generate a new random salt
@@ -17,32 +51,278 @@ def gen_salt(length=32) -> bytes:
     return secrets.token_bytes(length)
 
 
-def hash_pswd(password: str, salt: bytes) -> bytes:
+def current_params():
+    """
+    get the algorithm and parameters new hashes are made with,
+    from config['hashing']['algorithm'] and config['hashing'][algorithm]
+    :return: algorithm name, parameters tuple
+    :raises Exception: if the algorithm is not supported
+    """
+    hashing = config.get('hashing', {})
+    algorithm = hashing.get('algorithm', 'scrypt')
+    if algorithm not in algorithms:
+        raise Exception(f'unsupported hashing algorithm {algorithm}')
+
+    params = hashing.get(algorithm)
+    if params is None:
+        return algorithm, default_params[algorithm]
+    if algorithm == 'scrypt':
+        return algorithm, (params['n'], params['r'], params['p'])
+    return algorithm, (params['time_cost'], params['memory_cost'], params['parallelism'])
+
+
+def derive(password: str, salt: bytes, algorithm: str, params: tuple) -> bytes:
+    """
+    derive the raw digest of a password
+    :param password: password (str)
+    :param salt: salt, any bytes-like object such as a memoryview
+    :param algorithm: algorithm name
+    :param params: algorithm parameters
+    :return: digest bytes
+    :raises Exception: if argon2id is requested without argon2-cffi installed
+    """
+    if algorithm == 'scrypt':
+        n, r, p = params
+        # the work buffer is 128 * r * n bytes, plus the p blocks
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * r * (n + p + 2), dklen=DIGEST_LENGTH)
+
+    if hash_secret_raw is None:
+        raise Exception('argon2id requires the argon2-cffi package')
+    time_cost, memory_cost, parallelism = params
+    if not isinstance(salt, bytes):
+        salt = bytes(salt)  # argon2-cffi only takes bytes
+    return hash_secret_raw(password.encode(), salt, time_cost=time_cost,
+                           memory_cost=memory_cost, parallelism=parallelism,
+                           hash_len=DIGEST_LENGTH, type=Type.ID)
+
+
+def encode(algorithm: str, params: tuple, salt: bytes, digest: bytes) -> bytes:
+    """
+    pack a digest with everything needed to verify it
+    :return: stored hash bytes
+    """
+    return _header.pack(HASH_VERSION, algorithms[algorithm], *params, len(salt)) + salt + digest
+
+
+def decode(hashed_password: bytes, salt: bytes = None):
+    """
+    unpack a stored hash, bare legacy digests are
+    described with the legacy parameters and the given salt
+    salt and digest are views into hashed_password, never copies
+    :param hashed_password: stored hash, bytes or memoryview
+    :param salt: salt column of legacy hashes
+    :return: algorithm name, parameters tuple, salt, digest
+    """
+    if is_encoded(hashed_password):
+        view = memoryview(hashed_password)
+        version, number, a, b, c, salt_length = _header.unpack_from(view)
+        start = _header.size + salt_length
+        return _algorithm_names[number], (a, b, c), view[_header.size:start], view[start:]
+
+    algorithm, params = LEGACY_PARAMS
+    return algorithm, params, salt, hashed_password
+
+
+def is_encoded(hashed_password: bytes):
+    """
+    check whether a stored hash is in the self describing format,
+    a legacy digest is always shorter than any encoded hash
+    :param hashed_password: stored hash
+    :return: True if encoded
+    """
+    return (len(hashed_password) > _header.size
+            and hashed_password[0] == HASH_VERSION
+            and hashed_password[1] in _algorithm_names
+            and len(hashed_password) == _header.size + hashed_password[_header.size - 1] + DIGEST_LENGTH)
+
+
+def hash_pswd(password: str, salt: bytes = None, algorithm: str = None, params: tuple = None) -> bytes:
     """
     salt and hash a new password
     :param password: password to be salted (str)
-    :param salt: salt (bytes)
-    :return: hashed and salted password bytes
+    :param salt: salt (bytes), generated if not given
+    :param algorithm: algorithm name, defaults to current_params()
+    :param params: algorithm parameters, defaults to current_params()
+    :return: self describing hash bytes
     """
+    if algorithm is None:
+        algorithm, params = current_params()
+    elif params is None:
+        params = default_params[algorithm]
+    salt = salt or gen_salt()
 
-    return scrypt.hash(password, salt, N=16384, r=8, p=1, buflen=32)
+    return encode(algorithm, params, salt, derive(password, salt, algorithm, params))
 
 
 def validate_pswd(hashed_password: bytes, salt: bytes, password: str):
     """
     check whether a given password is valid
 
-    :param hashed_password: previously salted and hashed password
-    :param salt: previously used hash (for the salted password)
+    :param hashed_password: previously salted and hashed password, bytes or memoryview
+    :param salt: salt column, only used by legacy hashes
     :param password: new given password
     :return: True on success
     """
+    algorithm, params, salt, digest = decode(hashed_password, salt)
+    return hmac.compare_digest(derive(password, salt, algorithm, params), digest)
+
+
+def needs_rehash(hashed_password: bytes):
+    """
+    check whether a stored hash was made with outdated parameters
+    :param hashed_password: stored hash
+    :return: True if it should be rehashed
+    """
+    if not is_encoded(hashed_password):
+        return True
+    algorithm, params, _, _ = decode(hashed_password)
+    return (algorithm, params) != current_params()
+
+
+def _measure(algorithm: str, params: tuple, rounds: int = 3):
+    """ median seconds to derive one digest """
+    salt = gen_salt()
+    timings = list()
+    for _ in range(rounds):
+        start = perf_counter()
+        derive('calibration password', salt, algorithm, params)
+        timings.append(perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def calibrate(algorithm: str = 'scrypt', target_ms: float = 250):
+    """
+    pick the most expensive parameters that hash within a target latency on this machine,
+    scrypt grows N with r=8 and p=1, argon2id grows time_cost with 64 MiB
+    and falls back to less memory if a single pass is already too slow
+    :param algorithm: algorithm name
+    :param target_ms: target milliseconds per hash
+    :return: parameters tuple, measured milliseconds
+    """
+    target = target_ms / 1000
+
+    if algorithm == 'scrypt':
+        candidates = [(2 ** log_n, 8, 1) for log_n in range(10, 21)]
+    else:
+        candidates = [(1, 2 ** log_m, 4) for log_m in range(13, 17)]
+        candidates += [(time_cost, 65536, 4) for time_cost in range(2, 11)]
+
+    best, best_time = candidates[0], _measure(algorithm, candidates[0])
+    for params in candidates[1:]:
+        elapsed = _measure(algorithm, params)
+        if elapsed > target:
+            break
+        best, best_time = params, elapsed
+
+    return best, best_time * 1000
+
+
+_executor = None
+_server_workers = 1
+
+
+def pool_size(server_workers: int = 1):
+    """
+    get the number of hashing workers of one server worker,
+    config['hashing']['workers'] or the cpu cores shared between the server workers
+    :param server_workers: number of server worker processes
+    :return: number of hashing workers, 0 if hashing runs inline
+    """
+    workers = config.get('hashing', {}).get('workers')
+    if workers is not None:
+        return workers
+    return max(1, (os.cpu_count() or 1) // max(1, server_workers))
+
+
+def get_executor():
+    """
+    get the hashing pool, created on first use and sized by pool_size.
+    a process pool, or a thread pool inside a daemonic process such as
+    a sanic worker, which can not have children, hashlib.scrypt and
+    argon2-cffi release the GIL so the threads still hash in parallel
+    :return: ProcessPoolExecutor, ThreadPoolExecutor or None if hashing runs inline
+    """
+    global _executor
+    workers = pool_size(_server_workers)
+    if workers == 0:
+        return None
+
+    if _executor is None:
+        if multiprocessing.current_process().daemon:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hashing')
+        else:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def start_executor(server_workers: int = 1):
+    """
+    create the hashing pool and start its workers now, before the
+    server worker starts any thread, so processes are not forked later
+    from a process running the database, watcher and revocation threads
+    :param server_workers: number of server worker processes sharing the cpu cores
+    :return: the hashing pool or None if hashing runs inline
+    """
+    global _server_workers
+    _server_workers = server_workers
+    executor = get_executor()
+    if executor is not None:
+        for future in [executor.submit(int) for _ in range(pool_size(server_workers))]:
+            future.result()
+    return executor
+
+
+def shutdown_executor(wait=True):
+    """
+    shutdown the hashing pool
+    :param wait: wait for pending hashes to finish
+    :return: True on success
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+    return True
 
-    return hash_pswd(password, salt) == hashed_password
 
+@timed('scrypt')
+async def derive_async(password: str, salt: bytes, algorithm: str, params: tuple) -> bytes:
+    """
+    derive the raw digest of a password in the hashing pool
+    :return: digest bytes
+    """
+    executor = get_executor()
+    if executor is None:
+        return derive(password, salt, algorithm, params)
 
+    if isinstance(salt, memoryview) and isinstance(executor, ProcessPoolExecutor):
+        salt = salt.tobytes()  # memoryviews can not be sent to another process
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, derive, password, salt, algorithm, params)
 
 
+async def hash_pswd_async(password: str, salt: bytes = None) -> bytes:
+    """
+    salt and hash a new password in the hashing pool
+    :param password: password to be salted (str)
+    :param salt: salt (bytes), generated if not given
+    :return: self describing hash bytes
+    """
+    algorithm, params = current_params()
+    salt = salt or gen_salt()
+    return encode(algorithm, params, salt, await derive_async(password, salt, algorithm, params))
 
 
+async def validate_pswd_async(hashed_password: bytes, salt: bytes, password: str):
+    """
+    check whether a given password is valid
+    without blocking the event loop
 
+    :param hashed_password: previously salted and hashed password, bytes or memoryview
+    :param salt: salt column, only used by legacy hashes
+    :param password: new given password
+    :return: True on success
+    """
+    algorithm, params, salt, digest = decode(hashed_password, salt)
+    return hmac.compare_digest(await derive_async(password, salt, algorithm, params), digest)
@@ -0,0 +1,87 @@
+from datetime import datetime, timezone
+from Utils import config
+import json
+
+
+def _default(obj):
+    """ encode what json can not, datetimes as epoch seconds """
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=timezone.utc)
+        return int(obj.timestamp())
+    if isinstance(obj, (bytes, memoryview)):
+        return bytes(obj).decode()
+    raise TypeError(f'{type(obj).__name__} is not json serializable')
+
+
+class Serializer:
+
+    def __init__(self, name, dumps, loads):
+        """
+        initialize a new json serializer backend
+        :param name: backend name
+        :param dumps: callable encoding an object to bytes
+        :param loads: callable decoding bytes or str
+        """
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return f"<Serializer(name={self.name})>"
+
+
+def _orjson():
+    import orjson
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    return Serializer(
+        'orjson',
+        dumps=lambda obj: orjson.dumps(obj, default=_default, option=option),
+        loads=orjson.loads)
+
+
+def _ujson():
+    import ujson
+    try:
+        ujson.dumps(None, default=_default)
+    except TypeError:
+        raise ImportError('ujson 2.0 or later is required')
+    return Serializer(
+        'ujson',
+        dumps=lambda obj: ujson.dumps(obj, default=_default).encode(),
+        loads=ujson.loads)
+
+
+def _stdlib():
+    encoder = json.JSONEncoder(separators=(',', ':'), default=_default)
+    return Serializer(
+        'json',
+        dumps=lambda obj: encoder.encode(obj).encode(),
+        loads=json.loads)
+
+
+# fastest first
+backends = {'orjson': _orjson, 'ujson': _ujson, 'json': _stdlib}
+
+
+def get_serializer(name: str = None):
+    """
+    get a json serializer backend, the fastest installed one
+    if no name is given, the stdlib json is always available
+    :param name: backend name, orjson, ujson or json
+    :return: Serializer
+    :raises ImportError: if the named backend is not installed
+    """
+    if name is not None:
+        return backends[name]()
+
+    for factory in backends.values():
+        try:
+            return factory()
+        except ImportError:
+            continue
+
+
+serializer = get_serializer(config.get('serializer', {}).get('backend'))
+dumps = serializer.dumps
+loads = serializer.loads
@@ -0,0 +1,144 @@
+from threading import Thread, Event, Lock
+from time import perf_counter
+import atexit
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+
+    def __init__(self, flush, interval_ms=500, max_pending=10000):
+        """
+        initialize a new write-behind buffer
+        values are merged per key and handed to flush
+        as a single dict every interval_ms
+        :param flush: callable receiving a {key: value} dict
+        :param interval_ms: flush interval in milliseconds
+        :param max_pending: maximum number of pending keys
+        """
+        self._flush = flush
+        self._interval = interval_ms / 1000
+        self._max_pending = max_pending
+        self._pending = dict()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = None
+        self.counters = {
+            "enqueued": 0,
+            "merged": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "flushed_keys": 0,
+            "flush_errors": 0,
+            "last_flush_latency": 0.0,
+            "total_flush_latency": 0.0
+        }
+
+    def put(self, key, value):
+        """
+        buffer a value, replacing any pending value for key
+        :param key: targeted key
+        :param value: latest value
+        :return: True if buffered, False if dropped because buffer is full
+        """
+        with self._lock:
+            if key in self._pending:
+                self.counters['merged'] += 1
+            elif len(self._pending) >= self._max_pending:
+                self.counters['dropped'] += 1
+                self._wakeup.set()
+                return False
+            else:
+                self.counters['enqueued'] += 1
+            self._pending[key] = value
+
+        if self._thread is None:
+            self.start()
+        return True
+
+    def flush(self):
+        """
+        flush every pending value now
+        :return: number of keys flushed
+        """
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+
+        if not pending:
+            return 0
+
+        start = perf_counter()
+        try:
+            self._flush(pending)
+        except Exception:
+            logger.exception("write-behind flush of %d keys failed", len(pending))
+            self.counters['flush_errors'] += 1
+            with self._lock:
+                # newer values win over the ones that failed to flush
+                for key, value in pending.items():
+                    if len(self._pending) >= self._max_pending:
+                        break
+                    self._pending.setdefault(key, value)
+            return 0
+
+        latency = perf_counter() - start
+        self.counters['flushes'] += 1
+        self.counters['flushed_keys'] += len(pending)
+        self.counters['last_flush_latency'] = latency
+        self.counters['total_flush_latency'] += latency
+        return len(pending)
+
+    def _run(self):
+        """ flush periodically until stopped """
+        while not self._stopped.is_set():
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        """
+        start the background flusher
+        :return: True on success
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._stopped.clear()
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        atexit.register(self.stop)
+        return True
+
+    def stop(self, flush=True):
+        """
+        stop the background flusher
+        :param flush: flush pending values before returning
+        :return: True on success
+        """
+        thread = self._thread
+        if thread is not None:
+            self._stopped.set()
+            self._wakeup.set()
+            thread.join()
+            self._thread = None
+            atexit.unregister(self.stop)
+
+        if flush:
+            self.flush()
+        return True
+
+    def stats(self):
+        """
+        get queue depth and flush counters
+        :return: dict of counters
+        """
+        stats = dict(self.counters)
+        stats['queue_depth'] = len(self._pending)
+        flushes = stats['flushes']
+        stats['avg_flush_latency'] = (stats['total_flush_latency'] / flushes
+                                      if flushes else 0.0)
+        return stats
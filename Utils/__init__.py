@@ -1,21 +1,76 @@
 from .OrangeDB import Orange
-from peewee import PostgresqlDatabase
+from .AsyncDB import AsyncDatabase
+from playhouse.pool import PooledPostgresqlDatabase, PooledSqliteDatabase
+from peewee import DatabaseProxy
 from redis import Redis
+import os
 
-config = Orange(file_path='config.json', auto_dump=False, load=True)
-db = PostgresqlDatabase(
-    config['database']['name'],
-    user=config['database']['user'],
-    host=config['database']['host'],
-    port=config['database']['port'],
-    password=config['database'].get('password')
+config = Orange(file_path=os.environ.get('CHERRYAUTH_CONFIG', 'config.json'),
+                auto_dump=False, load=True)
+
+
+def create_database():
+    """
+    create a new connection pool for the configured database,
+    no connection is opened until the pool is first used
+    :return: pooled peewee database
+    """
+    if config['database'].get('engine', 'postgres') == 'sqlite':
+        return PooledSqliteDatabase(
+            config['database']['name'],
+            max_connections=config['database'].get('max_connections', 10),
+            stale_timeout=config['database'].get('stale_timeout', 300),
+            check_same_thread=False
+        )
+
+    return PooledPostgresqlDatabase(
+        config['database']['name'],
+        user=config['database']['user'],
+        host=config['database']['host'],
+        port=config['database']['port'],
+        password=config['database'].get('password'),
+        max_connections=config['database'].get('max_connections', 10),
+        stale_timeout=config['database'].get('stale_timeout', 300)
+    )
+
+
+# models are bound to the proxy, so every server worker
+# can swap in a pool of its own, see init_worker
+db = DatabaseProxy()
+db.initialize(create_database())
+
+async_db = AsyncDatabase(
+    db,
+    min_size=config['database'].get('min_connections', 1),
+    max_size=config['database'].get('max_connections', 10)
 )
 
 redis = Redis(
     host=config['redis']['host'],
     port=config['redis']['port'],
     db=config['redis']['db'],
-    password=config['redis'].get('password')
+    password=config['redis'].get('password'),
+    max_connections=config['redis'].get('max_connections')
 )
 
 
+def release_connections():
+    """
+    close every pooled database and redis connection,
+    run before forking so no worker inherits an open socket
+    :return: True on success
+    """
+    db.close_all()
+    redis.connection_pool.disconnect()
+    return True
+
+
+def init_worker():
+    """
+    give this process fresh database and redis connection pools,
+    the connections of the pools it was forked with are left untouched
+    :return: True on success
+    """
+    db.initialize(create_database())
+    redis.connection_pool.reset()
+    return True
@@ -1,6 +1,10 @@
 from sanic import Sanic
-from Routes import bp
+from Routes import bp, errors
 from models import *
+from Utils import async_db, init_worker, release_connections
+from Utils.CacheEngine import local_cache
+from Utils.Revocation import revocations
+import os
 
 
 def create_db():
@@ -8,29 +12,86 @@ def create_db():
     initialize and create db models
     :return: True on success
     """
-    db.create_tables([User, Session, Credentials])
+    with db.connection_context():
+        db.create_tables([User, Session, Credentials])
     return True
 
 
-def create_app():
+def create_app(workers: int = 1):
     """
-    initialize the web server
+    initialize the web server, every worker process
+    opens its own pools, executors and key caches when it starts
+    and watches the config for changes made by other processes
+    :param workers: number of server worker processes, sharing the cpu cores for hashing
     :return: app on success
     """
     app = Sanic(__name__)
     app.blueprint(bp)
+    errors.compile()
+
+    @app.listener('before_server_start')
+    async def start_worker(app, loop):
+        Salting.start_executor(workers)
+        init_worker()
+        config.watch(config.get('server', {}).get('watch_interval', 1))
+        async_db.start()
+        JWT.load_keys()
+        local_cache.clear()
+        revocations.start()
+
+    @app.listener('after_server_stop')
+    async def stop_worker(app, loop):
+        revocations.stop()
+        activity_buffer.stop()
+        Salting.shutdown_executor()
+        async_db.stop()
+        release_connections()
+        config.unwatch()
 
     return app
 
 
+def server_options(**overrides):
+    """
+    read the web server options from config['server'],
+    workers defaults to one per cpu core
+    :param overrides: options taking precedence over the config, None is ignored
+    :return: options dict for app.run
+    """
+    server = config.get('server', {})
+    options = {
+        'host': server.get('host', '0.0.0.0'),
+        'port': server.get('port', 5001),
+        'workers': server.get('workers') or os.cpu_count() or 1,
+        'access_log': server.get('access_log', False),
+        'backlog': server.get('backlog', 1024),
+        'debug': server.get('debug', False)
+    }
+    options.update({key: value for key, value in overrides.items() if value is not None})
+    return options
+
+
+def serve(**overrides):
+    """
+    run the web server with one process per worker, the
+    connections opened while setting up are closed before forking
+    :param overrides: options taking precedence over config['server']
+    :return: None once the server stopped
+    """
+    options = server_options(**overrides)
+    app = create_app(options['workers'])
+    release_connections()
+    app.run(**options)
+
+
 def create_secret():
     """
-    create jwt secret if doesnt exist
+    create jwt signing key if doesnt exist
     :return: True if created
     """
 
     try:
-        JWT.gen_secret()
+        JWT.gen_key()
     except Exception:
         return False
 
@@ -0,0 +1,34 @@
+import json
+import os
+import tempfile
+
+
+def setup_environment(workdir=None):
+    """
+    point the service at a throwaway sqlite database and an
+    in memory redis, must run before the service is imported,
+    every load test request comes from 127.0.0.1, so the
+    per address login limit is lifted
+    :param workdir: directory for the config and database files
+    :return: workdir
+    """
+    import fakeredis
+    import redis
+
+    workdir = workdir or tempfile.mkdtemp(prefix='cherryauth-bench-')
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump({
+            "database": {
+                "engine": "sqlite",
+                "name": os.path.join(workdir, 'bench.db'),
+                "max_connections": 8
+            },
+            "redis": {"host": "localhost", "port": 6379, "db": 0},
+            "jwt": {"algorithm": "HS256"},
+            "rate_limit": {"ip_attempts": 1000000000}
+        }, f)
+
+    os.environ['CHERRYAUTH_CONFIG'] = config_path
+    redis.Redis = fakeredis.FakeRedis
+    return workdir
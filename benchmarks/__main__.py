@@ -0,0 +1,48 @@
+import argparse
+import sys
+from benchmarks import setup_environment
+from benchmarks import report
+
+
+def main():
+    """
+    run the benchmark suite
+    python -m benchmarks [--micro|--load] [--save PATH] [--compare PATH]
+    """
+
+    parser = argparse.ArgumentParser(description="CherryAuth benchmarks")
+    parser.add_argument("--micro", action="store_true", help="only run micro benchmarks")
+    parser.add_argument("--load", action="store_true", help="only run the http load test")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiplier for micro benchmark iterations")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent connections")
+    parser.add_argument("--save", help="save results as a baseline json")
+    parser.add_argument("--compare", help="compare results against a baseline json")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+
+    setup_environment()
+    from benchmarks import micro, load
+
+    run_all = not (args.micro or args.load)
+    results = dict()
+    if args.micro or run_all:
+        results.update(micro.run(scale=args.scale))
+    if args.load or run_all:
+        results.update(load.run(requests=args.requests, concurrency=args.concurrency))
+
+    report.print_report(results)
+    if args.save:
+        report.save(results, args.save)
+    if args.compare:
+        regressions = report.compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
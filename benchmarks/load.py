@@ -0,0 +1,179 @@
+import asyncio
+import json
+import socket
+import threading
+from base64 import b64encode
+from time import perf_counter
+from uuid import uuid4
+from benchmarks.report import summarize
+
+
+class ServerThread(threading.Thread):
+
+    def __init__(self, app, port):
+        """
+        run a sanic app on a background thread
+        :param app: sanic app
+        :param port: port to listen on
+        """
+        super().__init__(daemon=True)
+        self._app = app
+        self._port = port
+        self._loop = None
+        self.started = threading.Event()
+
+        @app.listener('after_server_start')
+        async def server_started(app, loop):
+            self._loop = loop
+            self.started.set()
+
+    def run(self):
+        self._app.run(host="127.0.0.1", port=self._port,
+                      access_log=False, register_sys_signals=False)
+
+    def stop(self):
+        """ stop the server and wait for it to shut down """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self.join(timeout=30)
+
+
+def free_port():
+    """ get an unused local port """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def basic(uid, password):
+    """ basic authorization header value """
+    return "Basic " + b64encode(f"{uid}:{password}".encode()).decode()
+
+
+async def request(reader, writer, method, path, headers=None, body=None):
+    """
+    send a request over a keep-alive connection
+    :return: status code, response body bytes
+    """
+    body = json.dumps(body).encode() if body is not None else b""
+    lines = [f"{method} {path} HTTP/1.1", "Host: localhost",
+             f"Content-Length: {len(body)}"]
+    if body:
+        lines.append("Content-Type: application/json")
+    lines.extend(f"{key}: {value}" for key, value in (headers or {}).items())
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+
+    head = await reader.readuntil(b"\r\n\r\n")
+    status_line, *header_lines = head.decode().split("\r\n")
+    length = 0
+    for line in header_lines:
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":", 1)[1])
+    return int(status_line.split(" ")[1]), await reader.readexactly(length)
+
+
+async def drive(port, requests, concurrency):
+    """
+    send requests over concurrent keep-alive connections
+    :param port: server port
+    :param requests: list of (method, path, headers, body) tuples
+    :param concurrency: number of connections
+    :return: latencies, statuses, response bodies, elapsed seconds
+    """
+    latencies = [0.0] * len(requests)
+    statuses = [0] * len(requests)
+    bodies = [b""] * len(requests)
+
+    async def worker(indexes):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for index in indexes:
+            start = perf_counter()
+            statuses[index], bodies[index] = await request(reader, writer, *requests[index])
+            latencies[index] = perf_counter() - start
+        writer.close()
+
+    start = perf_counter()
+    await asyncio.gather(*[worker(range(i, len(requests), concurrency))
+                           for i in range(concurrency)])
+    return latencies, statuses, bodies, perf_counter() - start
+
+
+def scenario(results, name, port, requests, concurrency, expect=(200,)):
+    """
+    run one scenario and record its summary
+    :param expect: status codes every response must have
+    :return: response bodies
+    :raises Exception: if any response has another status, e.g. was rate limited
+    """
+    latencies, statuses, bodies, elapsed = asyncio.get_event_loop().run_until_complete(
+        drive(port, requests, concurrency))
+    unexpected = [(status, body) for status, body in zip(statuses, bodies) if status not in expect]
+    if unexpected:
+        status, body = unexpected[0]
+        raise Exception(f"{name}: {len(unexpected)} of {len(requests)} responses "
+                        f"were not {expect}, e.g. {status} {body[:200]!r}")
+
+    summary = summarize(latencies, elapsed)
+    summary["errors"] = sum(1 for status in statuses if status >= 400)
+    results[name] = summary
+    return bodies
+
+
+def run(requests=500, concurrency=16):
+    """
+    drive every route of create_app() end to end
+    :param requests: number of requests per scenario
+    :param concurrency: number of concurrent connections
+    :return: {name: summary} dict
+    """
+    from app import create_app, create_db, create_secret
+
+    create_db()
+    create_secret()
+    port = free_port()
+    server = ServerThread(create_app(), port)
+    server.start()
+    if not server.started.wait(timeout=30):
+        raise Exception("benchmark server did not start")
+
+    results = dict()
+    users = [(uuid4().hex, uuid4().hex) for _ in range(requests)]
+    try:
+        scenario(results, "POST /v1/register", port, [
+            ("POST", "/v1/register", {"Authorization": basic(uid, password)}, None)
+            for uid, password in users], concurrency)
+
+        bodies = scenario(results, "GET /v1/login", port, [
+            ("GET", "/v1/login", {"Authorization": basic(uid, password)}, None)
+            for uid, password in users], concurrency)
+        sessions = [json.loads(body)["jwt"] for body in bodies]
+
+        scenario(results, "POST /v1/verify", port, [
+            ("POST", "/v1/verify", {"Authorization": f"Bearer {session['token']}"}, None)
+            for session in sessions], concurrency)
+
+        scenario(results, "POST /v1/verify (malformed)", port, [
+            ("POST", "/v1/verify", {"Authorization": "Bearer not.a.token"}, None)
+            for _ in sessions], concurrency, expect=(401,))
+
+        scenario(results, "POST /v1/verify/batch (10)", port, [
+            ("POST", "/v1/verify/batch", None,
+             {"tokens": [s["token"] for s in sessions[i:i + 10]] or [sessions[0]["token"]]})
+            for i in range(len(sessions))], concurrency)
+
+        scenario(results, "GET /v1/token/refresh", port, [
+            ("GET", "/v1/token/refresh", {"Authorization": f"Bearer {session['refresh_token']}"}, None)
+            for session in sessions], concurrency)
+
+        scenario(results, "POST /v1/password/change", port, [
+            ("POST", "/v1/password/change", {"Authorization": basic(uid, password)},
+             {"new_password": password})
+            for uid, password in users], concurrency)
+
+        scenario(results, "POST /v1/logout", port, [
+            ("POST", "/v1/logout", {"Authorization": f"Bearer {session['refresh_token']}"}, None)
+            for session in sessions], concurrency)
+    finally:
+        server.stop()
+
+    return results
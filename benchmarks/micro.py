@@ -0,0 +1,149 @@
+from time import perf_counter
+from benchmarks.report import summarize
+import tempfile
+import tracemalloc
+import os
+
+
+def bench(fn, iterations, *args):
+    """
+    time a function call by call
+    :param fn: benchmarked function
+    :param iterations: number of calls
+    :return: summary dict
+    """
+    latencies = list()
+    start = perf_counter()
+    for _ in range(iterations):
+        call_start = perf_counter()
+        fn(*args)
+        latencies.append(perf_counter() - call_start)
+
+    return summarize(latencies, perf_counter() - start)
+
+
+def allocations(fn, iterations, *args):
+    """
+    measure the python heap a function call allocates,
+    cpython keeps no allocation counter, so this reports the
+    highest number of bytes tracemalloc sees in use during the call
+    :param fn: measured function
+    :param iterations: number of calls
+    :return: dict with peak bytes per call
+    """
+    fn(*args)
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            fn(*args)
+            peak += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+    return {"alloc_peak_bytes": peak / iterations}
+
+
+def run(scale=1.0):
+    """
+    run the micro benchmarks of the hot functions
+    :param scale: multiplier for the number of iterations
+    :return: {name: summary} dict
+    """
+    from models import db, User, Session, Credentials
+    from Utils import Salting, JWT
+    from Utils.CacheEngine import Cache, local_cache
+    from Utils.Revocation import revocations
+    from Utils.OrangeDB import Orange, OrangeMap
+    import controllers
+
+    # same as app.create_db and app.create_secret, without importing sanic
+    with db.connection_context():
+        db.create_tables([User, Session, Credentials])
+    if 'active_kid' not in JWT.config.get('jwt', {}):
+        JWT.gen_key()
+
+    def n(iterations):
+        return max(1, int(iterations * scale))
+
+    salt = Salting.gen_salt()
+    hashed = Salting.hash_pswd("password", salt)
+    token, _ = JWT.gen_jwt("sid", "uid", 3600)
+    tokens = [JWT.gen_jwt(f"sid{i}", "uid", 3600)[0] for i in range(10)]
+    controllers.verify_jwt_token(token)
+
+    # the buffers peewee returns for blob columns on postgres, sqlite returns bytes
+    stored, stored_salt = memoryview(hashed), memoryview(b'')
+
+    def redis_lookup():
+        local_cache.delete(token)
+        Cache.lookup_jwt(token)
+
+    def copying_validate():
+        # verification as it was done before, copying both blobs first
+        Salting.validate_pswd(stored.tobytes(), stored_salt.tobytes(), "password")
+
+    workdir = tempfile.mkdtemp(prefix='cherryauth-orange-')
+    orange = Orange(os.path.join(workdir, 'burst.json'), debounce_ms=1000)
+
+    def orange_burst():
+        # 10k updates of an auto dumped store, written once
+        for i in range(10000):
+            orange.set(str(i), i)
+        orange.flush()
+
+    # one update of a 10k keys store, dumped whole or journaled
+    journaled = Orange(os.path.join(workdir, 'journal.json'), journal=True)
+    journaled.setm(*[(str(i), i) for i in range(10000)])
+    journaled.compact()
+
+    def orange_dump_set():
+        orange.set("key", "value")
+        orange.flush()
+
+    def orange_journal_set():
+        journaled.set("key", "value")
+
+    # open a 10k keys store and read one value, loaded whole or mapped
+    mapped_path = os.path.join(workdir, 'mapped.db')
+    mapped = OrangeMap(mapped_path, auto_dump=False)
+    mapped.setm(*[(str(i), i) for i in range(10000)])
+    mapped.dump()
+
+    def orange_open_get():
+        Orange(journaled.file_path, auto_dump=False).get("5000")
+
+    def orange_map_open_get():
+        OrangeMap(mapped_path, auto_dump=False).get("5000")
+
+    user = User.find_with_uid("micro-benchmark")
+    if user is None:
+        user = User.register("micro-benchmark")
+    User.find_with_uid(user.uid)
+
+    validate = bench(Salting.validate_pswd, n(20), stored, stored_salt, "password")
+    validate.update(allocations(Salting.validate_pswd, n(5), stored, stored_salt, "password"))
+    copying = bench(copying_validate, n(20))
+    copying.update(allocations(copying_validate, n(5)))
+
+    return {
+        "Salting.hash_pswd": bench(Salting.hash_pswd, n(20), "password", salt),
+        "Salting.validate_pswd": validate,
+        "Salting.validate_pswd (copying)": copying,
+        "JWT.gen_jwt": bench(JWT.gen_jwt, n(5000), "sid", "uid", 3600),
+        "JWT.verify_jwt": bench(JWT.verify_jwt, n(5000), token),
+        "Cache.lookup_jwt (local)": bench(Cache.lookup_jwt, n(20000), token),
+        "Cache.lookup_jwt (redis)": bench(redis_lookup, n(5000)),
+        "revocations.is_revoked": bench(revocations.is_revoked, n(20000), "sid"),
+        "verify_jwt_token (cached)": bench(controllers.verify_jwt_token, n(20000), token),
+        "verify_jwt_token_raw (cached)": bench(controllers.verify_jwt_token_raw, n(20000), token),
+        "verify_jwt_tokens (10)": bench(controllers.verify_jwt_tokens, n(2000), tokens),
+        "Orange burst (10k sets)": bench(orange_burst, n(5)),
+        "Orange.set (10k keys, dump)": bench(orange_dump_set, n(50)),
+        "Orange.set (10k keys, journal)": bench(orange_journal_set, n(5000)),
+        "Orange open + get (10k keys)": bench(orange_open_get, n(50)),
+        "OrangeMap open + get (10k keys)": bench(orange_map_open_get, n(5000)),
+        "User.find_with_uid (cached)": bench(User.find_with_uid, n(20000), user.uid)
+    }
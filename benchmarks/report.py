@@ -0,0 +1,82 @@
+import json
+
+
+def percentile(samples, fraction):
+    """
+    get a percentile of sorted samples
+    :param samples: sorted list of samples
+    :param fraction: percentile as a fraction, e.g. 0.99
+    :return: sample at that percentile
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summarize(latencies, elapsed):
+    """
+    summarize latencies of a benchmark
+    :param latencies: per operation latencies in seconds
+    :param elapsed: wall time of the whole run in seconds
+    :return: dict with p50/p99 in milliseconds and ops per second
+    """
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0
+    }
+
+
+def print_report(results):
+    """
+    print a results table
+    :param results: {name: summary} dict
+    """
+    print(f"{'benchmark':<32}{'count':>8}{'p50 ms':>12}{'p99 ms':>12}{'ops/s':>12}")
+    for name, summary in results.items():
+        print(f"{name:<32}{summary['count']:>8}{summary['p50_ms']:>12.3f}"
+              f"{summary['p99_ms']:>12.3f}{summary['ops_per_sec']:>12.1f}")
+
+    allocating = {name: summary for name, summary in results.items() if 'alloc_peak_bytes' in summary}
+    if allocating:
+        print(f"\n{'allocations per call':<32}{'peak bytes':>12}")
+        for name, summary in allocating.items():
+            print(f"{name:<32}{summary['alloc_peak_bytes']:>12.0f}")
+
+
+def save(results, path):
+    """
+    save results as a baseline
+    :param results: {name: summary} dict
+    :param path: baseline json path
+    """
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare(results, path, tolerance=0.10):
+    """
+    compare results against a saved baseline
+    :param results: {name: summary} dict
+    :param path: baseline json path
+    :param tolerance: allowed relative slowdown
+    :return: list of regression descriptions
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+
+    regressions = list()
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if summary['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {base['p50_ms']:.3f}ms -> {summary['p50_ms']:.3f}ms")
+        if summary['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {base['p99_ms']:.3f}ms -> {summary['p99_ms']:.3f}ms")
+        if summary['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {base['ops_per_sec']:.1f} -> {summary['ops_per_sec']:.1f} ops/s")
+
+    return regressions
@@ -0,0 +1,277 @@
+from peewee import JOIN
+from models import db, User, Credentials, user_cache, credentials_cache
+from Utils import Salting
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from time import perf_counter
+import json
+import csv
+import os
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# columns of an exported or importable record, password is plaintext and
+# password_hash a hex encoded Salting hash, salt is only set for legacy hashes
+fields = ('uid', 'date_created', 'password', 'password_hash', 'salt')
+
+
+def _format(path: str, fmt: str = None):
+    """ record format of a file, from its extension unless given """
+    fmt = fmt or ('csv' if path.endswith('.csv') else 'jsonl')
+    if fmt not in ('jsonl', 'csv'):
+        raise Exception(f'unsupported format {fmt}')
+    return fmt
+
+
+def read_records(path: str, fmt: str = None):
+    """
+    stream user records from a jsonl or csv file
+    :param path: source file path
+    :param fmt: jsonl or csv, defaults to the file extension
+    :return: generator of record dicts
+    """
+    with open(path, newline='') as f:
+        if _format(path, fmt) == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _batches(iterable, size: int):
+    """ split an iterable into lists of at most size items """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def _hash_passwords(passwords: list, algorithm: str, params: tuple):
+    """ hash a chunk of plaintext passwords, runs in the process pool """
+    return [Salting.hash_pswd(password, algorithm=algorithm, params=params)
+            for password in passwords]
+
+
+def _parse_record(record: dict):
+    """
+    validate a record
+    :param record: record dict
+    :return: uid, date_created, plaintext password or None, stored hash or None, salt
+    :raises ValueError: if the record is not valid
+    """
+    uid = record.get('uid')
+    if not uid:
+        raise ValueError('missing uid')
+
+    date_created = record.get('date_created') or None
+    if date_created is not None:
+        date_created = (datetime.utcfromtimestamp(date_created)
+                        if isinstance(date_created, (int, float))
+                        else datetime.fromisoformat(date_created))
+
+    if record.get('password'):
+        return uid, date_created, record['password'], None, b''
+
+    if record.get('password_hash'):
+        hashed = bytes.fromhex(record['password_hash'])
+        salt = bytes.fromhex(record.get('salt') or '')
+        if not Salting.is_encoded(hashed) and not salt:
+            raise ValueError('password_hash is neither encoded nor salted')
+        return uid, date_created, None, hashed, salt
+
+    raise ValueError('missing password or password_hash')
+
+
+class _Batch:
+
+    def __init__(self, records: list, executor, chunk_size: int):
+        """
+        parse a batch and start hashing its plaintext passwords
+        :param records: list of (record number, record dict)
+        :param executor: hashing process pool or None to hash inline
+        :param chunk_size: passwords per process pool task
+        """
+        self.size = len(records)
+        self.invalid = 0
+        self.rows = list()
+        for number, record in records:
+            try:
+                self.rows.append(_parse_record(record))
+            except (ValueError, TypeError, AttributeError) as error:
+                logger.warning("skipping record %d: %s", number, error)
+                self.invalid += 1
+
+        plaintexts = [row[2] for row in self.rows if row[3] is None]
+        algorithm, params = Salting.current_params()
+        if executor is None:
+            self._hashes = [_hash_passwords(plaintexts, algorithm, params)]
+        else:
+            self._hashes = [executor.submit(_hash_passwords, chunk, algorithm, params)
+                            for chunk in _batches(plaintexts, chunk_size)]
+
+    def write(self):
+        """
+        insert the batch with one multi row insert per table in a single
+        transaction, users that already exist are left untouched
+        :return: number of users inserted
+        """
+        hashes = iter([hashed for chunk in self._hashes
+                       for hashed in (chunk if isinstance(chunk, list) else chunk.result())])
+        now = datetime.utcnow()
+        users, credentials = list(), list()
+        for uid, date_created, _, hashed, salt in self.rows:
+            users.append({'uid': uid, 'date_created': date_created or now})
+            credentials.append({'user': uid, 'password': hashed or next(hashes),
+                                'salt': salt, 'date_created': now})
+        if not users:
+            return 0
+
+        with db.connection_context(), db.atomic():
+            inserted = (User
+                        .insert_many(users)
+                        .on_conflict_ignore()
+                        .as_rowcount()
+                        .execute())
+            (Credentials
+             .insert_many(credentials)
+             .on_conflict_ignore()
+             .execute())
+
+        # unknown uids may be cached as missing
+        uids = [user['uid'] for user in users]
+        user_cache.invalidate(*uids)
+        credentials_cache.invalidate(*uids)
+        return inserted
+
+
+def _read_checkpoint(path: str):
+    """ number of records already imported """
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return json.load(f)['records']
+
+
+def _write_checkpoint(path: str, records: int):
+    """ atomically record the number of imported records """
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump({'records': records}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def import_users(path: str, fmt: str = None, batch_size: int = 1000,
+                 checkpoint: str = None, workers: int = None, chunk_size: int = 64):
+    """
+    bulk import users from a jsonl or csv file, with their plaintext password
+    hashed in a process pool or an already hashed password_hash,
+    the next batch hashes while the current one is written
+    :param path: source file path
+    :param fmt: jsonl or csv, defaults to the file extension
+    :param batch_size: records per insert
+    :param checkpoint: checkpoint file path, an interrupted import resumes
+                       after its last written batch, rewriting a batch is
+                       harmless since existing users are skipped
+    :param workers: hashing processes, 0 hashes inline, defaults to cpu count
+    :param chunk_size: passwords per process pool task
+    :return: stats dict
+    """
+    done = _read_checkpoint(checkpoint)
+    stats = {'resumed_at': done, 'read': 0, 'inserted': 0, 'existing': 0, 'invalid': 0}
+    start = perf_counter()
+
+    records = islice(enumerate(read_records(path, fmt), 1), done, None)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 0 else None
+    try:
+        pending = None
+        for records_batch in _batches(records, batch_size):
+            batch = _Batch(records_batch, executor, chunk_size)
+            if pending is not None:
+                done = _commit(pending, stats, done, checkpoint)
+            pending = batch
+        if pending is not None:
+            done = _commit(pending, stats, done, checkpoint)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    stats['elapsed'] = perf_counter() - start
+    return stats
+
+
+def _commit(batch: _Batch, stats: dict, done: int, checkpoint: str):
+    """ write a batch and move the checkpoint past it """
+    inserted = batch.write()
+    stats['read'] += batch.size
+    stats['invalid'] += batch.invalid
+    stats['inserted'] += inserted
+    stats['existing'] += batch.size - batch.invalid - inserted
+
+    done += batch.size
+    if checkpoint:
+        _write_checkpoint(checkpoint, done)
+    logger.info("imported %d records", done)
+    return done
+
+
+def _export_rows(batch_size: int):
+    """
+    stream users with their credentials in uid order,
+    paging on uid so memory stays flat on any table size
+    """
+    last_uid = None
+    while True:
+        query = (User
+                 .select(User.uid, User.date_created, Credentials.password, Credentials.salt)
+                 .join(Credentials, JOIN.LEFT_OUTER)
+                 .order_by(User.uid)
+                 .limit(batch_size)
+                 .tuples())
+        if last_uid is not None:
+            query = query.where(User.uid > last_uid)
+
+        with db.connection_context():
+            rows = list(query)
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last_uid = rows[-1][0]
+
+
+def export_users(path: str, fmt: str = None, batch_size: int = 1000):
+    """
+    stream every user and password hash to a jsonl or csv file,
+    the output can be imported again with import_users
+    :param path: destination file path
+    :param fmt: jsonl or csv, defaults to the file extension
+    :param batch_size: users per query
+    :return: number of exported users
+    """
+    fmt = _format(path, fmt)
+    exported = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writeheader()
+
+        for uid, date_created, password, salt in _export_rows(batch_size):
+            record = {'uid': uid, 'date_created': date_created.isoformat()}
+            if password is not None:
+                record['password_hash'] = bytes(password).hex()
+                if salt:
+                    record['salt'] = bytes(salt).hex()
+
+            if writer is not None:
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record) + '\n')
+            exported += 1
+
+    return exported
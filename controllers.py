@@ -1,10 +1,14 @@
 from models import User, Credentials, Session
+from peewee import IntegrityError
 from Utils.Exceptions import *
 from Utils.CacheEngine import Cache
-from Utils import JWT
+from Utils.Revocation import revocations
+from Utils import JWT, Salting, Serializer
+from Utils.Metrics import timed
 
 
-def register(uid, password):
+@timed('controllers.register')
+async def register(uid, password):
     """
     register a new user
     :param uid: user's global id
@@ -13,16 +17,15 @@ def register(uid, password):
     :raises UserAlreadyExist:
     """
 
-    if User.find_with_uid(uid) is not None:
+    hashed = await Salting.hash_pswd_async(password)
+    try:
+        return await User.register_with_credentials_async(uid, hashed)
+    except IntegrityError:
         raise UserAlreadyExist()
 
-    user = User.register(uid)
-    Credentials.init(user, password)
 
-    return user
-
-
-def login(uid, password):
+@timed('controllers.login')
+async def login(uid, password):
     """
     login a user
     :param uid: user's global id
@@ -32,19 +35,24 @@ def login(uid, password):
     :raises UserWasNotFound:
     """
 
-    user = User.find_with_uid(uid)
-    if not user:
+    credentials = await Credentials.find_with_uid_async(uid)
+    if not credentials:
         raise UserWasNotFound()
 
-    credentials = user.credentials.get()
-    if not credentials.does_match(password):
+    if not await credentials.does_match_async(password):
         raise IncorrectCredentials()
 
-    session = Session.init(user)
+    # the password is only known now, upgrade outdated hashes with it
+    if credentials.needs_rehash():
+        await (await credentials.change_async(password)).save_async(
+            only=[Credentials.password, Credentials.salt])
+
+    session = await Session.init_async(credentials.user)
     return session
 
 
-def logout(ref_token):
+@timed('controllers.logout')
+async def logout(ref_token):
     """
     logout a user from a session
     :param ref_token: user's refresh token
@@ -52,43 +60,71 @@ def logout(ref_token):
     :raises RefreshTokenIsNotValid
     """
 
-    session = Session.find_with_refresh_token(ref_token)
+    session = await Session.find_with_refresh_token_async(ref_token)
     if not session:
         raise RefreshTokenIsNotValid()
 
-    session.delete_instance()
+    await session.delete_instance_async()
+    revocations.revoke([session.session_id])
+    Cache.invalidate_sessions([session.session_id])
     return session
 
 
-def refresh_token(ref_token):
+@timed('controllers.refresh_token')
+async def refresh_token(ref_token):
     """
     create a new jwt token
     :param ref_token: user's refresh token
     :return: Session instance
+    :raises RefreshTokenIsNotValid
     """
 
-    return Session.find_with_refresh_token(ref_token)
+    session = await Session.find_with_refresh_token_async(ref_token)
+    # a session cached by this worker may have been logged out by another
+    if not session or revocations.is_revoked(session.session_id):
+        raise RefreshTokenIsNotValid()
+
+    return session
 
 
-def terminate_sessions(uid):
+@timed('controllers.terminate_sessions')
+async def terminate_sessions(uid):
     """
     terminate all sessions for a user
     :param uid: user's uid
     :return: True on success
-    :raises DoesNotExist: if user was not found
     """
 
-    user = User.find_with_uid(uid)
-    sessions = Session.find_with_user(user)
-    if not sessions:
-        return True
-
-    for session in sessions:
-        session.delete_instance()
+    session_ids = await Session.delete_with_user_async(uid, returning=True)
+    revocations.revoke(session_ids)
+    Cache.invalidate_sessions(session_ids)
 
     return True
 
 
+def verify_jwt_token_raw(jwt_token):
+    """
+    verify if a token is valid, returning its payload serialized
+    so a cache hit never decodes it
+    :param jwt_token: target jwt token
+    :return: sid, payload json bytes
+    :raises ExpiredSignatureError: if signature is expired
+    :raises InvalidSignatureError: if signature is not valid
+    :raises InvalidTokenError: for the rest of the token errors
+    :raises SessionWasRevoked: if the token's session was logged out
+    """
+
+    entry = Cache.lookup_jwt_raw(jwt_token)
+
+    if entry is None:
+        entry = Cache.set_jwt(jwt_token, JWT.verify_jwt(jwt_token), ttl=30)
+
+    if revocations.is_revoked(entry[0]):
+        raise SessionWasRevoked()
+
+    return entry
+
+
 def verify_jwt_token(jwt_token):
     """
     verify if a token is valid
@@ -97,18 +133,61 @@ def verify_jwt_token(jwt_token):
     :raises ExpiredSignatureError: if signature is expired
     :raises InvalidSignatureError: if signature is not valid
     :raises InvalidTokenError: for the rest of the token errors
+    :raises SessionWasRevoked: if the token's session was logged out
     """
 
-    payload = Cache.lookup_jwt(jwt_token)
+    return Serializer.loads(verify_jwt_token_raw(jwt_token)[1])
+
+
+def verify_jwt_tokens_raw(jwt_tokens):
+    """
+    verify many tokens with a single cache lookup
+    and a single cache write for the uncached ones
+    :param jwt_tokens: list of target jwt tokens
+    :return: list of (sid, payload json bytes) entries, InvalidTokenError
+             or SessionWasRevoked instances, in the same order as jwt_tokens
+    """
 
-    if payload is None:
-        payload = JWT.verify_jwt(jwt_token)
-        Cache.set_jwt(jwt_token, payload, ttl=30)
+    entries = Cache.lookup_jwts_raw(jwt_tokens)
+    verified, failed = list(), dict()
+
+    for jwt_token in dict.fromkeys(jwt_tokens):
+        if jwt_token in entries:
+            continue
+        try:
+            verified.append((jwt_token, JWT.verify_jwt(jwt_token)))
+        except JWT.InvalidTokenError as e:
+            failed[jwt_token] = e
+
+    entries.update(Cache.set_jwts(verified, ttl=30))
+
+    results = list()
+    for jwt_token in jwt_tokens:
+        entry = entries.get(jwt_token)
+        if entry is None:
+            results.append(failed[jwt_token])
+        elif revocations.is_revoked(entry[0]):
+            results.append(SessionWasRevoked())
+        else:
+            results.append(entry)
+    return results
+
+
+def verify_jwt_tokens(jwt_tokens):
+    """
+    verify many tokens with a single cache lookup
+    and a single cache write for the uncached ones
+    :param jwt_tokens: list of target jwt tokens
+    :return: list of payloads, InvalidTokenError or SessionWasRevoked
+             instances, in the same order as jwt_tokens
+    """
 
-    return payload
+    return [result if isinstance(result, Exception) else Serializer.loads(result[1])
+            for result in verify_jwt_tokens_raw(jwt_tokens)]
 
 
-def change_password(uid, old_password, new_password, kill_sessions=False):
+@timed('controllers.change_password')
+async def change_password(uid, old_password, new_password, kill_sessions=False):
     """
     change user's password
     :param uid: user's uid
@@ -120,17 +199,17 @@ def change_password(uid, old_password, new_password, kill_sessions=False):
     :raises WrongPassword: if old password is not valid
     """
 
-    user = User.find_with_uid(uid)
-    if not user:
+    credentials = await Credentials.find_with_uid_async(uid)
+    if not credentials:
         raise UserWasNotFound()
 
-    credentials = user.credentials.get()
-    if not credentials.does_match(old_password):
+    if not await credentials.does_match_async(old_password):
         raise WrongPassword()
 
-    credentials.change(new_password).save()
+    await (await credentials.change_async(new_password)).save_async(
+        only=[Credentials.password, Credentials.salt])
 
     if kill_sessions:
-        terminate_sessions(uid)
+        await terminate_sessions(uid)
 
     return True
@@ -1,17 +1,134 @@
-from app import create_app, create_secret, create_db
+from app import create_secret, create_db, serve as run_server
+from Utils import JWT, Salting, config
+import argparse
 
 
-def main():
+def serve(args):
     """
-    initialize mongodb
+    initialize the database
     create jwt secret if does not exist
-    run the webserver
+    run the webserver, options not given
+    on the command line are read from config['server']
     """
 
     create_db()
     create_secret()
-    (create_app()
-        .run(host="0.0.0.0", port=5001, debug=True))
+    run_server(host=getattr(args, "host", None), port=getattr(args, "port", None),
+               workers=getattr(args, "workers", None), debug=getattr(args, "debug", None))
+
+
+def rotate(args):
+    """
+    rotate the jwt signing key, previous keys
+    keep verifying tokens until they retire
+    """
+
+    kid = JWT.rotate_key(algorithm=args.algorithm,
+                         retire_after=args.retire_after,
+                         keep=args.keep)
+    print(f"active jwt key is now {kid}")
+
+
+def calibrate(args):
+    """
+    pick password hashing parameters for a target latency
+    on this machine, optionally saving them to the config,
+    existing hashes are upgraded on the next login
+    """
+
+    params, elapsed = Salting.calibrate(args.algorithm, args.target_ms)
+    names = ("n", "r", "p") if args.algorithm == "scrypt" else \
+        ("time_cost", "memory_cost", "parallelism")
+    params = dict(zip(names, params))
+    print(f"{args.algorithm} {params} hashes in {elapsed:.1f}ms")
+
+    if args.save:
+        with config.transaction():
+            hashing = config.get("hashing", {})
+            hashing["algorithm"] = args.algorithm
+            hashing[args.algorithm] = params
+            config["hashing"] = hashing
+        print("saved to config")
+
+
+def import_users(args):
+    """
+    bulk import users from a jsonl or csv file,
+    resumable with --checkpoint
+    """
+
+    import bulk
+    stats = bulk.import_users(args.path, fmt=args.format, batch_size=args.batch_size,
+                              checkpoint=args.checkpoint, workers=args.workers)
+    print(f"read {stats['read']} records from #{stats['resumed_at'] + 1}: "
+          f"{stats['inserted']} inserted, {stats['existing']} existing, "
+          f"{stats['invalid']} invalid in {stats['elapsed']:.1f}s")
+
+
+def export_users(args):
+    """
+    export every user and password hash to a jsonl or csv file
+    """
+
+    import bulk
+    exported = bulk.export_users(args.path, fmt=args.format, batch_size=args.batch_size)
+    print(f"exported {exported} users")
+
+
+def main():
+    """
+    parse the command line and run the requested command,
+    runs the webserver if no command is given
+    """
+
+    parser = argparse.ArgumentParser(description="central authentication microservice")
+    commands = parser.add_subparsers(dest="command")
+
+    serve_parser = commands.add_parser("serve", help="run the webserver")
+    serve_parser.add_argument("--host", help="address to listen on")
+    serve_parser.add_argument("--port", type=int, help="port to listen on")
+    serve_parser.add_argument("--workers", type=int,
+                              help="worker processes, defaults to cpu count")
+    serve_parser.add_argument("--debug", action="store_true", default=None,
+                              help="run in debug mode")
+    serve_parser.set_defaults(func=serve)
+
+    rotate_parser = commands.add_parser("rotate", help="rotate the jwt signing key")
+    rotate_parser.add_argument("--algorithm", help="algorithm of the new key, e.g. RS256")
+    rotate_parser.add_argument("--retire-after", type=int,
+                               help="seconds the previous key keeps verifying tokens")
+    rotate_parser.add_argument("--keep", type=int,
+                               help="maximum number of previous keys kept")
+    rotate_parser.set_defaults(func=rotate)
+
+    calibrate_parser = commands.add_parser("calibrate", help="tune password hashing cost")
+    calibrate_parser.add_argument("--algorithm", choices=sorted(Salting.algorithms),
+                                  default="scrypt", help="hashing algorithm")
+    calibrate_parser.add_argument("--target-ms", type=float, default=250,
+                                  help="target milliseconds per hash")
+    calibrate_parser.add_argument("--save", action="store_true",
+                                  help="make the parameters current in the config")
+    calibrate_parser.set_defaults(func=calibrate)
+
+    import_parser = commands.add_parser("import", help="bulk import users")
+    import_parser.add_argument("path", help="jsonl or csv file")
+    import_parser.add_argument("--format", choices=("jsonl", "csv"),
+                               help="file format, defaults to the file extension")
+    import_parser.add_argument("--batch-size", type=int, default=1000, help="records per insert")
+    import_parser.add_argument("--checkpoint", help="checkpoint file to resume from")
+    import_parser.add_argument("--workers", type=int,
+                               help="hashing processes, 0 hashes inline, defaults to cpu count")
+    import_parser.set_defaults(func=import_users)
+
+    export_parser = commands.add_parser("export", help="bulk export users")
+    export_parser.add_argument("path", help="jsonl or csv file")
+    export_parser.add_argument("--format", choices=("jsonl", "csv"),
+                               help="file format, defaults to the file extension")
+    export_parser.add_argument("--batch-size", type=int, default=1000, help="users per query")
+    export_parser.set_defaults(func=export_users)
+
+    args = parser.parse_args()
+    getattr(args, "func", serve)(args)
 
 
 if __name__ == '__main__':
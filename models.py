@@ -1,38 +1,140 @@
 from peewee import *
 from datetime import datetime
 from Utils.IDGenerator import gen_token
-from Utils import Salting, JWT, db
-from threading import Thread
+from Utils import Salting, JWT, db, async_db, config
+from Utils.WriteBehind import WriteBehindBuffer
+from Utils.ReadThrough import ReadThrough, cache_options
+from Utils.Metrics import registry
+
+
+# read-through caches of the finders, see Utils.ReadThrough
+user_cache = ReadThrough('user', 'uid', negative=True, **cache_options())
+credentials_cache = ReadThrough('credentials', 'user', negative=True, positive=False,
+                                **cache_options())
+session_cache = ReadThrough('session', 'session_id', **cache_options())
+refresh_token_cache = ReadThrough('refresh_token', 'refresh_token', **cache_options())
 
 
 class BaseModel(Model):
 
+    # read-through caches holding rows of this model
+    caches = ()
+
     class Meta:
         database = db
 
+    def save(self, force_insert=False, only=None):
+        """
+        save the instance, evicting its cached rows
+        :return: number of rows modified
+        """
+        inserted = force_insert or self._pk is None
+        rows = super().save(force_insert=force_insert, only=only)
+        for cache in self.caches:
+            cache.invalidate_instance(self, inserted=inserted)
+        return rows
+
+    def delete_instance(self, *args, **kwargs):
+        """
+        delete the instance, evicting its cached rows,
+        rows of dependents deleted with recursive=True
+        are left in the caches until they expire
+        :return: number of rows deleted
+        """
+        rows = super().delete_instance(*args, **kwargs)
+        for cache in self.caches:
+            cache.invalidate_instance(self)
+        return rows
+
+    async def save_async(self, *args, **kwargs):
+        """
+        save the instance without blocking the event loop
+        :return: number of rows modified
+        """
+        return await async_db.run(self.save, *args, **kwargs)
+
+    async def delete_instance_async(self, *args, **kwargs):
+        """
+        delete the instance without blocking the event loop
+        :return: number of rows deleted
+        """
+        return await async_db.run(self.delete_instance, *args, **kwargs)
+
 
 class User(BaseModel):
 
+    caches = (user_cache,)
     uid = TextField(primary_key=True)
     date_created = DateTimeField(default=datetime.utcnow)
 
     @classmethod
     def register(cls, uid):
         """
-        register a new user
+        register a new user with a single insert
         :param uid: user's global unique id
         :return: User instance
         """
+        return cls.create(uid=uid)
 
-        obj = cls.create(uid=uid)
-        obj.save()
+    @classmethod
+    def register_many(cls, uids: list, batch_size: int = 1000):
+        """
+        register many users with one insert per batch, in a single transaction
+        :param uids: users' global unique ids
+        :param batch_size: users per insert
+        :return: list of User instances
+        :raises IntegrityError: if any user already exist, none is registered
+        """
+        users = [cls(uid=uid) for uid in uids]
+        with db.atomic():
+            cls.bulk_create(users, batch_size=batch_size)
+        user_cache.invalidate(*uids)
+        return users
 
-        return obj
+    @classmethod
+    async def register_async(cls, uid):
+        """
+        register a new user without blocking the event loop
+        :param uid: user's global unique id
+        :return: User instance
+        """
+        return await async_db.run(cls.register, uid)
+
+    @classmethod
+    def register_with_credentials(cls, uid, password: bytes, salt: bytes = b''):
+        """
+        register a new user together with their credentials,
+        one insert per table in a single transaction
+        :param uid: user's global unique id
+        :param password: password hash, see Salting.hash_pswd
+        :param salt: salt column, only set for legacy hashes
+        :return: User instance
+        :raises IntegrityError: if user already exist
+        """
+        with db.atomic():
+            user = cls.create(uid=uid)
+            Credentials.insert(user=uid, password=password, salt=salt).execute()
+        credentials_cache.invalidate(uid)
+        return user
+
+    @classmethod
+    async def register_with_credentials_async(cls, uid, password: bytes, salt: bytes = b''):
+        """
+        register a new user together with their credentials
+        without blocking the event loop
+        :param uid: user's global unique id
+        :param password: password hash, see Salting.hash_pswd
+        :param salt: salt column, only set for legacy hashes
+        :return: User instance
+        :raises IntegrityError: if user already exist
+        """
+        return await async_db.run(cls.register_with_credentials, uid, password, salt)
 
     @classmethod
+    @user_cache
     def find_with_uid(cls, uid):
         """
-        query user using their uid
+        query user using their uid, read through the user cache
         :param uid: targeted uid
         :return: User if found
         """
@@ -41,6 +143,16 @@ class User(BaseModel):
                 .where(cls.uid == uid)
                 .first())
 
+    @classmethod
+    async def find_with_uid_async(cls, uid):
+        """
+        query user using their uid without blocking the event loop,
+        only a cache miss is sent to the query thread pool
+        :param uid: targeted uid
+        :return: User if found
+        """
+        return await user_cache.find_async(cls, uid, async_db.run)
+
     def __str__(self):
         return f"<User(uid={self.uid})>"
 
@@ -70,9 +182,19 @@ class BelongsToUser:
         """
         return list(cls.select().where(cls.user == user.uid))
 
+    @classmethod
+    async def find_with_user_async(cls, user: User):
+        """
+        query item using user instance without blocking the event loop
+        :param user: user instance
+        :return: list of BelongsToUser if found
+        """
+        return await async_db.run(cls.find_with_user, user)
+
 
 class Session(BaseModel, BelongsToUser):
 
+    caches = (session_cache, refresh_token_cache)
     session_id = TextField(primary_key=True, default=lambda: gen_token(16))
     refresh_token = TextField(unique=True, default=lambda: gen_token(32))
     date_created = DateTimeField(default=datetime.utcnow)
@@ -82,13 +204,33 @@ class Session(BaseModel, BelongsToUser):
     @classmethod
     def init(cls, user):
         """
-        create a new Session
+        create a new Session with a single insert
         :param user: user's instance
         :return: Session
         """
-        obj = cls.create(user=user)
-        obj.save()
-        return obj
+        return cls.create(user=user)
+
+    @classmethod
+    def init_many(cls, users: list, batch_size: int = 1000):
+        """
+        create a session for each user with one insert per batch, in a single transaction
+        :param users: users' instances
+        :param batch_size: sessions per insert
+        :return: list of Session
+        """
+        sessions = [cls(user=user) for user in users]
+        with db.atomic():
+            cls.bulk_create(sessions, batch_size=batch_size)
+        return sessions
+
+    @classmethod
+    async def init_async(cls, user):
+        """
+        create a new Session without blocking the event loop
+        :param user: user's instance
+        :return: Session
+        """
+        return await async_db.run(cls.init, user)
 
     def gen_jwt(self, ttl: int = 3600):
         """
@@ -96,12 +238,13 @@ class Session(BaseModel, BelongsToUser):
         :param ttl: time to live in seconds
         :return: jwt token, payload
         """
-        return JWT.gen_jwt(self.session_id, self.user.uid, ttl)
+        return JWT.gen_jwt(self.session_id, self.user_id, ttl)
 
     @classmethod
+    @session_cache
     def find_with_session_id(cls, session_id: str):
         """
-        query session using session id
+        query session using session id, read through the session cache
         :param session_id: target session id
         :return: Session if found
         """
@@ -111,9 +254,20 @@ class Session(BaseModel, BelongsToUser):
                 .first())
 
     @classmethod
+    async def find_with_session_id_async(cls, session_id: str):
+        """
+        query session using session id without blocking the event loop,
+        only a cache miss is sent to the query thread pool
+        :param session_id: target session id
+        :return: Session if found
+        """
+        return await session_cache.find_async(cls, session_id, async_db.run)
+
+    @classmethod
+    @refresh_token_cache
     def find_with_refresh_token(cls, refresh_token: str):
         """
-        query session using refresh token
+        query session using refresh token, read through the refresh token cache
         :param refresh_token: target refresh token
         :return: Session if found
         """
@@ -122,6 +276,46 @@ class Session(BaseModel, BelongsToUser):
                 .where(cls.refresh_token == refresh_token)
                 .first())
 
+    @classmethod
+    async def find_with_refresh_token_async(cls, refresh_token: str):
+        """
+        query session using refresh token without blocking the event loop,
+        only a cache miss is sent to the query thread pool
+        :param refresh_token: target refresh token
+        :return: Session if found
+        """
+        return await refresh_token_cache.find_async(cls, refresh_token, async_db.run)
+
+    @classmethod
+    def delete_with_user(cls, uid: str, returning=False):
+        """
+        delete every session of a user in a single query
+        :param uid: user's uid
+        :param returning: return the deleted session ids
+        :return: list of deleted session ids if returning, else deleted rows count
+        """
+        deleted = list(cls
+                       .delete()
+                       .where(cls.user == uid)
+                       .returning(cls.session_id, cls.refresh_token)
+                       .execute())
+        session_cache.invalidate(*(row.session_id for row in deleted))
+        refresh_token_cache.invalidate(*(row.refresh_token for row in deleted))
+        if returning:
+            return [row.session_id for row in deleted]
+
+        return len(deleted)
+
+    @classmethod
+    async def delete_with_user_async(cls, uid: str, returning=False):
+        """
+        delete every session of a user without blocking the event loop
+        :param uid: user's uid
+        :param returning: return the deleted session ids
+        :return: list of deleted session ids if returning, else deleted rows count
+        """
+        return await async_db.run(cls.delete_with_user, uid, returning)
+
     def update_last_activity(self, background=True):
         """
         update last activity
@@ -131,11 +325,29 @@ class Session(BaseModel, BelongsToUser):
 
         self.last_activity = datetime.utcnow()
         if background:
-            Thread(target=self.save).start()
+            activity_buffer.put(self.session_id, self.last_activity)
         else:
-            self.save()
+            self.save(only=[Session.last_activity])
         return True
 
+    @classmethod
+    def bulk_update_last_activity(cls, activities: dict):
+        """
+        update last activity of many sessions in a single query
+        :param activities: {session_id: last_activity} dict
+        :return: number of rows updated
+        """
+        if not activities:
+            return 0
+
+        with db.connection_context():
+            rows = (cls
+                    .update(last_activity=Case(cls.session_id, list(activities.items())))
+                    .where(cls.session_id.in_(list(activities)))
+                    .execute())
+        session_cache.invalidate(*activities)
+        return rows
+
     def __str__(self):
         return f"<Session(session_id={self.session_id}, user={self.user.id})>"
 
@@ -143,11 +355,24 @@ class Session(BaseModel, BelongsToUser):
         return self.__str__()
 
 
+activity_buffer = WriteBehindBuffer(
+    flush=Session.bulk_update_last_activity,
+    interval_ms=config.get('activity', {}).get('flush_interval_ms', 500),
+    max_pending=config.get('activity', {}).get('max_pending', 10000)
+)
+
+registry.gauge('cherryauth_activity_queue_depth', 'pending last activity updates',
+               collect=lambda: {(): activity_buffer.stats()['queue_depth']})
+registry.gauge('cherryauth_activity_flush_seconds', 'average last activity flush latency',
+               collect=lambda: {(): activity_buffer.stats()['avg_flush_latency']})
+
+
 class Credentials(BaseModel, BelongsToUser):
 
+    caches = (credentials_cache,)
     user = ForeignKeyField(User, primary_key=True, backref='credentials')
-    password = BlobField()  # of course it is hashed
-    salt = BlobField()
+    password = BlobField()  # self describing hash, see Salting.encode
+    salt = BlobField()  # only set for legacy hashes
     date_created = DateTimeField(default=datetime.utcnow)
 
     @classmethod
@@ -161,20 +386,85 @@ class Credentials(BaseModel, BelongsToUser):
         """
 
         password, salt = cls._create_salt_password(password)
-        obj = cls.create(user=user, password=password, salt=salt)
-        obj.save()
-        return obj
+        return cls.create(user=user, password=password, salt=salt)
+
+    @classmethod
+    async def init_async(cls, user: User, password: str):
+        """
+        initialize a new Credentials instance for user,
+        hashing in the hashing process pool
+        :param user: target user
+        :param password: user's password
+        :return: Credentials on success
+        :raises IntegrityError: if credentials already exist
+        """
+
+        password, salt = await cls._create_salt_password_async(password)
+        return await async_db.run(cls.create, user=user, password=password, salt=salt)
+
+    @classmethod
+    def find_for_user(cls, user: User):
+        """
+        query credentials of a user
+        :param user: user instance
+        :return: Credentials
+        :raises DoesNotExist: if user has no credentials
+        """
+        return cls.get(cls.user == user.uid)
+
+    @classmethod
+    async def find_for_user_async(cls, user: User):
+        """
+        query credentials of a user without blocking the event loop
+        :param user: user instance
+        :return: Credentials
+        :raises DoesNotExist: if user has no credentials
+        """
+        return await async_db.run(cls.find_for_user, user)
+
+    @classmethod
+    @credentials_cache
+    def find_with_uid(cls, uid: str):
+        """
+        query credentials together with their user in a single joined query,
+        unknown uids are cached so credential stuffing does not reach the database
+        :param uid: targeted uid
+        :return: Credentials with user loaded, None if user was not found
+        """
+        return (cls
+                .select(cls, User)
+                .join(User)
+                .where(cls.user == uid)
+                .first())
+
+    @classmethod
+    async def find_with_uid_async(cls, uid: str):
+        """
+        query credentials together with their user without blocking the event loop,
+        only a cache miss is sent to the query thread pool
+        :param uid: targeted uid
+        :return: Credentials with user loaded, None if user was not found
+        """
+        return await credentials_cache.find_async(cls, uid, async_db.run)
 
     @staticmethod
     def _create_salt_password(new_password):
         """
-        create salt + hashed pass
+        create salt + hashed pass, the salt is kept
+        inside the hash so the salt column is left empty
         :param new_password: new password as str
         :return: password, salt
         """
-        salt = Salting.gen_salt()
-        password = Salting.hash_pswd(new_password, salt)
-        return password, salt
+        return Salting.hash_pswd(new_password), b''
+
+    @staticmethod
+    async def _create_salt_password_async(new_password):
+        """
+        create salt + hashed pass in the hashing process pool
+        :param new_password: new password as str
+        :return: password, salt
+        """
+        return await Salting.hash_pswd_async(new_password), b''
 
     def change(self, new_password: str):
         """
@@ -185,15 +475,45 @@ class Credentials(BaseModel, BelongsToUser):
         self.password, self.salt = self._create_salt_password(new_password)
         return self
 
+    async def change_async(self, new_password: str):
+        """
+        change the current password to a new one
+        hashing in the hashing process pool
+        :param new_password: new password
+        :return: self
+        """
+        self.password, self.salt = await self._create_salt_password_async(new_password)
+        return self
+
     def does_match(self, password: str):
         """
-        check whether a given password matches
+        check whether a given password matches,
+        in constant time and without copying the stored blobs
         :param password: given password
         :return: True if matches
         """
         return Salting.validate_pswd(
-            hashed_password=self.password.tobytes(),
-            salt=self.salt.tobytes(),
+            hashed_password=self.password,
+            salt=self.salt,
+            password=password)
+
+    def needs_rehash(self):
+        """
+        check whether the password hash was made with outdated parameters
+        :return: True if it should be rehashed
+        """
+        return Salting.needs_rehash(self.password)
+
+    async def does_match_async(self, password: str):
+        """
+        check whether a given password matches
+        hashing in the hashing process pool
+        :param password: given password
+        :return: True if matches
+        """
+        return await Salting.validate_pswd_async(
+            hashed_password=self.password,
+            salt=self.salt,
             password=password)
 
     def __str__(self):
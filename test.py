@@ -1,12 +1,187 @@
-from unittest import TestCase, main
-from app import create_db, create_secret
+from unittest import TestCase, main, skipIf
+from asyncio import get_event_loop
+from app import create_db, create_secret, server_options
 from controllers import *
+from peewee import IntegrityError
 from uuid import uuid4
 from random import choices, randint, choice
-from datetime import timedelta
-from Utils import JWT
-from time import sleep
+from datetime import timedelta, datetime
+from Utils import JWT, Salting, Serializer, config, db, init_worker, release_connections
+from time import sleep, time
 from string import ascii_letters
+from Utils.Caching import VerifyCache
+from Utils.CacheEngine import Cache
+from models import activity_buffer, user_cache
+from Utils.Metrics import Counter, Histogram, registry
+from Utils.RateLimit import RateLimiter, LocalBuckets
+from Utils.RouteUtils import ErrorResponses
+from Utils.OrangeDB import Orange, OrangeMap, RWLock
+from Utils.Revocation import RevocationList
+from Utils.ReadThrough import ReadThrough
+from redis.exceptions import RedisError
+import Utils.Revocation
+import Utils.CacheEngine
+import Utils.ReadThrough
+from threading import Thread
+from collections import OrderedDict
+from multiprocessing import get_context
+from tempfile import TemporaryDirectory
+import bulk
+import json
+import os
+
+
+def run(coro):
+    """ run a coroutine to completion """
+    return get_event_loop().run_until_complete(coro)
+
+
+def hash_in_daemon(results):
+    """ hash a password as a daemonic sanic worker would """
+    Salting._executor = None  # the parent's pool does not survive the fork
+    executor = Salting.start_executor(server_workers=4)
+    hashed = get_event_loop().run_until_complete(Salting.hash_pswd_async('password'))
+    results.put((type(executor).__name__, Salting.validate_pswd(hashed, b'', 'password')))
+    Salting.shutdown_executor()
+
+
+def increment(path, times):
+    """ increment a counter of an Orange file, one transaction at a time """
+    db = Orange(path, auto_dump=False)
+    for _ in range(times):
+        with db.transaction():
+            db.set('count', db.get('count', 0) + 1)
+
+
+def keep_keyring(test):
+    """ restore the signing keys of config.json once a test that rotates them ends """
+    keyring = json.loads(json.dumps(config.get('jwt', {})))
+
+    def restore():
+        with config.transaction():
+            config['jwt'] = keyring
+        JWT.load_keys()
+
+    test.addCleanup(restore)
+
+
+def journal(path, name, times):
+    """ set keys of a journaled Orange file, compacting it every few records """
+    db = Orange(path, journal=True, compact_bytes=256, debounce_ms=0)
+    for i in range(times):
+        db.set(f'{name}{i}', i)
+    db.close()
+
+
+class Unavailable:
+    """ a redis client whose server is down """
+
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise RedisError('connection refused')
+        return fail
+
+
+class count_queries:
+    """
+    count the sql statements sent to the database,
+    from any thread, while the context is open
+    """
+
+    def __init__(self):
+        self.statements = list()
+
+    def __enter__(self):
+        self._database = db.obj
+        execute_sql = self._database.execute_sql
+
+        def counting_execute_sql(sql, *args, **kwargs):
+            self.statements.append(sql)
+            return execute_sql(sql, *args, **kwargs)
+
+        self._database.execute_sql = counting_execute_sql
+        return self
+
+    def __exit__(self, *exc_info):
+        del self._database.execute_sql
+        return False
+
+    def __len__(self):
+        return len(self.statements)
+
+
+class QueryBudget:
+
+    def assertQueries(self, budget, coro):
+        """
+        run a coroutine and fail if it sends more than budget statements
+        :return: the coroutine's result
+        """
+        with count_queries() as queries:
+            result = run(coro)
+        self.assertLessEqual(len(queries), budget, '\n'.join(queries.statements))
+        return result
+
+
+class TestQueryBudget(TestCase, QueryBudget):
+
+    def test_register(self):
+
+        self.assertQueries(2, register(uuid4().hex, uuid4().hex))
+
+    def test_login(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+
+        session = self.assertQueries(2, login(uid, password))
+        self.assertEqual(session.user.uid, uid)
+
+    def test_change_password(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+
+        self.assertQueries(2, change_password(uid, password, uuid4().hex))
+
+
+class TestSingleWrite(TestCase):
+
+    def test_factories(self):
+
+        with count_queries() as queries:
+            user = User.register(uuid4().hex)
+        self.assertEqual(len(queries), 1)
+
+        with count_queries() as queries:
+            Credentials.init(user, uuid4().hex)
+        self.assertEqual(len(queries), 1)
+
+        with count_queries() as queries:
+            Session.init(user)
+        self.assertEqual(len(queries), 1)
+
+    def test_bulk_factories(self):
+
+        with count_queries() as queries:
+            users = User.register_many([uuid4().hex for _ in range(20)], batch_size=10)
+        self.assertEqual(len(queries), 2)
+
+        with count_queries() as queries:
+            sessions = Session.init_many(users)
+        self.assertEqual(len(queries), 1)
+
+        stored = Session.find_with_session_id(sessions[5].session_id)
+        self.assertEqual(stored.user_id, users[5].uid)
+
+    def test_register_many_is_atomic(self):
+
+        uid = uuid4().hex
+        User.register(uid)
+        new_uid = uuid4().hex
+
+        self.assertRaises(IntegrityError, User.register_many, [new_uid, uid])
+        self.assertIsNone(User.find_with_uid(new_uid))
 
 
 class TestRegistration(TestCase):
@@ -16,7 +191,7 @@ class TestRegistration(TestCase):
         uid = uuid4().hex
         password = uuid4().hex
 
-        user = register(uid=uid, password=password)
+        user = run(register(uid=uid, password=password))
         self.assertEqual(user.uid, uid)
 
     def test_user_query(self):
@@ -25,7 +200,7 @@ class TestRegistration(TestCase):
         for _ in range(100):
             uid, password = uuid4().hex, uuid4().hex
             uid_list.append((uid, password))
-            register(uid=uid, password=password)
+            run(register(uid=uid, password=password))
 
         for (uid, password) in choices(uid_list, k=10):
             user = User.find_with_uid(uid)
@@ -34,14 +209,14 @@ class TestRegistration(TestCase):
     def test_duplicate_user_registration(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        register(uid=uid, password=password)
+        run(register(uid=uid, password=password))
 
-        self.assertRaises(UserAlreadyExist, register, uid, password)
+        self.assertRaises(UserAlreadyExist, run, register(uid, password))
 
     def test_user_delete(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        user1 = register(uid=uid, password=password)
+        user1 = run(register(uid=uid, password=password))
         user1.save()
 
         user2 = User.find_with_uid(uid)
@@ -54,18 +229,18 @@ class TestRegistration(TestCase):
     def test_login(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        user = register(uid=uid, password=password)
-        session = login(uid, password)
+        user = run(register(uid=uid, password=password))
+        session = run(login(uid, password))
         self.assertTrue(session.belongs_to(user))
 
-        self.assertRaises(UserWasNotFound, login, uuid4().hex, password)
-        self.assertRaises(IncorrectCredentials, login, uid, password + "1")
+        self.assertRaises(UserWasNotFound, run, login(uuid4().hex, password))
+        self.assertRaises(IncorrectCredentials, run, login(uid, password + "1"))
 
     def test_session_query(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        user = register(uid=uid, password=password)
-        session = login(uid, password)
+        user = run(register(uid=uid, password=password))
+        session = run(login(uid, password))
 
         session1 = Session.find_with_refresh_token(session.refresh_token)
         self.assertEqual(session, session1)
@@ -79,7 +254,7 @@ class TestPasswordEncryption(TestCase):
     def test_correct_password(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        user = register(uid, password)
+        user = run(register(uid, password))
 
         credentials = user.credentials.get()
         self.assertTrue(credentials.belongs_to(user))
@@ -92,24 +267,93 @@ class TestPasswordEncryption(TestCase):
     def test_change_password(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        user = register(uid, password)
+        user = run(register(uid, password))
 
         new_password = uuid4().hex
 
-        self.assertTrue(change_password(uid, password, new_password))
+        self.assertTrue(run(change_password(uid, password, new_password)))
         credentials = user.credentials.get()
 
         self.assertTrue(credentials.does_match(new_password))
         self.assertFalse(credentials.does_match(password))
 
+    def test_blob_buffers(self):
+
+        # sqlite returns blob columns as bytes, postgres as memoryviews
+        salt = Salting.gen_salt()
+        hashed = Salting.hash_pswd("password")
+        legacy = Salting.derive("password", salt, *Salting.LEGACY_PARAMS)
+
+        for buffer in (bytes, memoryview):
+            for password, password_salt in ((hashed, b''), (legacy, salt)):
+                credentials = Credentials(password=buffer(password), salt=buffer(password_salt))
+                self.assertTrue(credentials.does_match("password"))
+                self.assertFalse(credentials.does_match("wrong"))
+                self.assertTrue(run(credentials.does_match_async("password")))
+                self.assertEqual(credentials.needs_rehash(), password is legacy)
+
+    def test_async_hashing(self):
+
+        salt = Salting.gen_salt()
+        hashed = run(Salting.hash_pswd_async("password", salt))
+
+        self.assertEqual(hashed, Salting.hash_pswd("password", salt))
+        self.assertTrue(run(Salting.validate_pswd_async(hashed, salt, "password")))
+        self.assertFalse(run(Salting.validate_pswd_async(hashed, salt, "wrong")))
+
+    def test_hash_format(self):
+
+        salt = Salting.gen_salt(16)
+        hashed = Salting.hash_pswd("password", salt, 'scrypt', (1024, 8, 1))
+
+        self.assertTrue(Salting.is_encoded(hashed))
+        self.assertEqual(Salting.decode(hashed)[:3], ('scrypt', (1024, 8, 1), salt))
+        self.assertTrue(Salting.validate_pswd(hashed, b'', "password"))
+        self.assertTrue(Salting.needs_rehash(hashed))
+
+    def test_validate_on_buffers(self):
+
+        hashed = Salting.hash_pswd("password")
+        salt, digest = Salting.decode(hashed)[2:]
+
+        # peewee returns blob columns as memoryviews, decode only slices them
+        self.assertIsInstance(digest, memoryview)
+        self.assertTrue(Salting.validate_pswd(memoryview(hashed), memoryview(b''), "password"))
+        self.assertFalse(Salting.validate_pswd(memoryview(hashed), memoryview(b''), "wrong"))
+
+    @skipIf(Salting.hash_secret_raw is None, "argon2-cffi is not installed")
+    def test_argon2id(self):
+
+        hashed = Salting.hash_pswd("password", algorithm='argon2id', params=(1, 8192, 1))
+
+        self.assertEqual(Salting.decode(hashed)[0], 'argon2id')
+        self.assertTrue(Salting.validate_pswd(hashed, b'', "password"))
+        self.assertFalse(Salting.validate_pswd(hashed, b'', "wrong"))
+
+    def test_legacy_hash_upgraded_on_login(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        user = run(register(uid, password))
+
+        salt = Salting.gen_salt()
+        legacy = Salting.derive(password, salt, *Salting.LEGACY_PARAMS)
+        Credentials.update(password=legacy, salt=salt).where(Credentials.user == user).execute()
+        self.assertTrue(user.credentials.get().needs_rehash())
+
+        run(login(uid, password))
+        credentials = user.credentials.get()
+
+        self.assertFalse(credentials.needs_rehash())
+        self.assertTrue(credentials.does_match(password))
+
     def test_change_password_exceptions(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        register(uid, password)
+        run(register(uid, password))
 
         wrong_password = uuid4().hex
-        self.assertRaises(WrongPassword, change_password, uid, wrong_password, uuid4().hex)
-        self.assertRaises(UserWasNotFound, change_password, uuid4().hex, wrong_password, uuid4().hex)
+        self.assertRaises(WrongPassword, run, change_password(uid, wrong_password, uuid4().hex))
+        self.assertRaises(UserWasNotFound, run, change_password(uuid4().hex, wrong_password, uuid4().hex))
 
 
 class TestAuthTokens(TestCase):
@@ -117,9 +361,9 @@ class TestAuthTokens(TestCase):
     def test_jwt_token_validation(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        register(uid, password)
+        run(register(uid, password))
 
-        session = login(uid, password)
+        session = run(login(uid, password))
         jwt_token, payload1 = session.gen_jwt(ttl=timedelta(minutes=5).total_seconds())
 
         payload2 = verify_jwt_token(jwt_token)
@@ -129,9 +373,9 @@ class TestAuthTokens(TestCase):
     def test_jwt_token_expiration(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        register(uid, password)
+        run(register(uid, password))
 
-        session = login(uid, password)
+        session = run(login(uid, password))
         jwt_token, payload1 = session.gen_jwt(ttl=timedelta(seconds=5).total_seconds())
 
         sleep(6)
@@ -140,8 +384,8 @@ class TestAuthTokens(TestCase):
     def test_jwt_cache(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        user = register(uid, password)
-        token, payload = login(uid, password).gen_jwt(ttl=3600)
+        user = run(register(uid, password))
+        token, payload = run(login(uid, password)).gen_jwt(ttl=3600)
 
         # perform jwt verification
         self.assertEqual(verify_jwt_token(token)['uid'], user.uid)
@@ -153,8 +397,8 @@ class TestAuthTokens(TestCase):
     def test_jwt_invalid_signature(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        register(uid, password)
-        session = login(uid, password)
+        run(register(uid, password))
+        session = run(login(uid, password))
         jwt_token, payload = session.gen_jwt(ttl=100)
         header, payload, signature = jwt_token.decode().split('.')
         sign_list = list(signature)
@@ -167,47 +411,823 @@ class TestAuthTokens(TestCase):
     def test_refresh_token_jwt_request(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        register(uid, password)
-        session = login(uid, password)
+        run(register(uid, password))
+        session = run(login(uid, password))
         jwt_token, payload = session.gen_jwt(ttl=5)
         sleep(6)
 
-        session2 = refresh_token(session.refresh_token)
+        session2 = run(refresh_token(session.refresh_token))
         jwt_token, _ = session2.gen_jwt(ttl=5)
 
         payload1 = verify_jwt_token(jwt_token)
 
         self.assertEqual(payload['uid'], payload1['uid'])
 
+    def test_batch_jwt_token_validation(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        session = run(login(uid, password))
+        valid_token, payload = session.gen_jwt(ttl=3600)
+        expired_token, _ = session.gen_jwt(ttl=-10)
+
+        results = verify_jwt_tokens([valid_token, expired_token, b"garbage", valid_token])
+
+        self.assertEqual(results[0]['sid'], payload['sid'])
+        self.assertIsInstance(results[1], JWT.ExpiredSignatureError)
+        self.assertIsInstance(results[2], JWT.InvalidTokenError)
+        self.assertEqual(results[3]['sid'], payload['sid'])
+
+    def test_jwt_unknown_key_id(self):
+
+        token = JWT.jwt.encode({"uid": uuid4().hex}, key="secret",
+                               algorithm="HS256", headers={"kid": uuid4().hex})
+        self.assertRaises(JWT.InvalidTokenError, verify_jwt_token, token)
+
+    def test_jwt_key_rotation(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        session = run(login(uid, password))
+
+        keep_keyring(self)
+        old_token, _ = session.gen_jwt(ttl=3600)
+        new_kid = JWT.rotate_key()
+        new_token, _ = session.gen_jwt(ttl=3600)
+
+        self.assertEqual(JWT.get_unverified_header(new_token)['kid'], new_kid)
+        self.assertEqual(JWT.verify_jwt(old_token)['uid'], uid)
+        self.assertEqual(JWT.verify_jwt(new_token)['uid'], uid)
+
+    def test_jwks_has_no_private_material(self):
+
+        for jwk in JWT.jwks()['keys']:
+            self.assertIn('kid', jwk)
+            self.assertNotIn('d', jwk)
+
     def test_kill_sessions(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        user = register(uid, password)
+        user = run(register(uid, password))
 
         for _ in range(10):
-            session = login(uid, password)
-            logout(session.refresh_token)
+            session = run(login(uid, password))
+            run(logout(session.refresh_token))
 
         self.assertEqual(Session.find_with_user(user), [])
         for _ in range(10):
-            login(uid, password)
+            run(login(uid, password))
 
-        self.assertTrue(terminate_sessions(uid))
+        self.assertTrue(run(terminate_sessions(uid)))
         self.assertEqual(Session.find_with_user(user), [])
 
 
+class TestVerifyCache(TestCase):
+
+    def test_lru_eviction(self):
+
+        cache = VerifyCache(maxsize=2, ttl=30)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl_expiration(self):
+
+        cache = VerifyCache(maxsize=10, ttl=30)
+        self.assertFalse(cache.set('a', 1, ttl=0))
+        cache.set('b', 2, ttl=1)
+        sleep(1.1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_terminate_sessions_evicts_cache(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        tokens = [run(login(uid, password)).gen_jwt(ttl=3600)[0] for _ in range(3)]
+
+        for token in tokens:
+            verify_jwt_token(token)
+            self.assertIsNotNone(Cache.lookup_jwt(token))
+
+        self.assertTrue(run(terminate_sessions(uid)))
+        for token in tokens:
+            self.assertIsNone(Cache.lookup_jwt(token))
+
+    def test_two_tier_counters(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        token, _ = run(login(uid, password)).gen_jwt(ttl=3600)
+
+        before = Cache.stats()
+        verify_jwt_token(token)
+        verify_jwt_token(token)
+        after = Cache.stats()
+
+        self.assertEqual(after['local_hits'] - before['local_hits'], 1)
+        self.assertEqual(after['redis_misses'] - before['redis_misses'], 1)
+
+
+class TestSerializer(TestCase):
+
+    def test_backends_agree(self):
+
+        content = {"uid": "uid", "iat": datetime(2019, 7, 3), "token": b"token"}
+        for name in Serializer.backends:
+            try:
+                serializer = Serializer.get_serializer(name)
+            except ImportError:
+                continue
+            self.assertEqual(serializer.loads(serializer.dumps(content)),
+                             {"uid": "uid", "iat": 1562112000, "token": "token"})
+
+    def test_cached_payload_stays_serialized(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        session = run(login(uid, password))
+        token, payload = session.gen_jwt(ttl=3600)
+
+        sid, payload_json = verify_jwt_token_raw(token)
+        self.assertEqual(sid, session.session_id)
+        self.assertEqual(Serializer.loads(payload_json), payload)
+        self.assertIs(verify_jwt_token_raw(token)[1], payload_json)
+
+
+class TestErrorResponses(TestCase):
+
+    def test_lookup(self):
+
+        errors = (ErrorResponses()
+                  .register(JWT.InvalidTokenError, 401, "invalid token")
+                  .register(UserWasNotFound, 404, "user was not found")
+                  .register(UserWasNotFound, 404, "user does not exist", route='login')
+                  .compile())
+
+        # the closest registered base class answers
+        template = errors.lookup('verify', JWT.ExpiredSignatureError)
+        self.assertEqual((template.code, template.msg), (401, "invalid token"))
+        self.assertEqual(Serializer.loads(template.body)['msg'], "invalid token")
+
+        self.assertEqual(errors.lookup('login', UserWasNotFound).msg, "user does not exist")
+        self.assertEqual(errors.lookup('change_password', UserWasNotFound).msg, "user was not found")
+        self.assertIsNone(errors.lookup('login', KeyError))
+
+    def test_routes_table(self):
+
+        from Routes import errors
+
+        for error in (TokenDoesNotExist, InvalidValue, SessionWasRevoked, JWT.DecodeError,
+                      IncorrectCredentials, RefreshTokenIsNotValid, TooManyAttempts):
+            self.assertIsNotNone(errors.lookup('login', error))
+
+
+class TestActivityBuffer(TestCase):
+
+    def test_merged_flush(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        sessions = [run(login(uid, password)) for _ in range(3)]
+
+        for _ in range(5):
+            for session in sessions:
+                session.update_last_activity()
+
+        activity_buffer.flush()
+        self.assertEqual(activity_buffer.stats()['queue_depth'], 0)
+
+        for session in sessions:
+            stored = Session.find_with_session_id(session.session_id)
+            self.assertEqual(stored.last_activity, session.last_activity)
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram_exposition(self):
+
+        histogram = Histogram('test_seconds', 'test', labels=('stage',), buckets=(0.1, 1))
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        histogram.observe(5, 'a')
+        lines = histogram.expose()
+
+        self.assertIn('test_seconds_bucket{stage="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{stage="a"} 3', lines)
+
+    def test_stage_timing(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        run(login(uid, password))
+
+        exposition = registry.expose()
+        self.assertIn('stage="scrypt"', exposition)
+        self.assertIn('stage="controllers.login"', exposition)
+        self.assertIn('cherryauth_cache_hit_ratio{tier="local"}', exposition)
+
+    def test_callback_counters(self):
+
+        counts = {('local',): 3}
+        counter = Counter('test_lookups', 'test', labels=('tier',), collect=lambda: counts)
+        self.assertEqual(counter.expose(), ['test_lookups{tier="local"} 3'])
+
+        exposition = registry.expose()
+        self.assertIn('# TYPE cherryauth_cache_lookups counter', exposition)
+        self.assertIn('# TYPE cherryauth_model_cache_lookups counter', exposition)
+
+
+class TestRateLimit(TestCase):
+
+    def test_bucket_limits_uid(self):
+
+        limiter = RateLimiter('test', {"uid": (3, 60), "ip": (100, 60)})
+        uid, ip = uuid4().hex, uuid4().hex
+
+        for _ in range(3):
+            limiter.check(uid=uid, ip=ip)
+        self.assertRaises(TooManyAttempts, limiter.check, uid=uid, ip=ip)
+
+        # another user from the same address is unaffected
+        self.assertTrue(limiter.check(uid=uuid4().hex, ip=ip))
+
+        limiter.reset(uid=uid, ip=ip)
+        self.assertTrue(limiter.check(uid=uid, ip=ip))
+
+    def test_local_fallback(self):
+
+        buckets = [("uid", 2, 1.0), ("ip", 10, 1.0)]
+        local = LocalBuckets()
+
+        self.assertTrue(local.take(buckets, now=0)[0])
+        self.assertTrue(local.take(buckets, now=0)[0])
+        allowed, wait = local.take(buckets, now=0)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 1.0)
+
+        # a denied attempt takes no token from the other buckets
+        self.assertTrue(local.take(buckets, now=1)[0])
+
+
+class TestModelCache(TestCase):
+
+    def test_read_through(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        User.find_with_uid(uid)
+
+        with count_queries() as queries:
+            self.assertEqual(User.find_with_uid(uid).uid, uid)
+            self.assertEqual(run(User.find_with_uid_async(uid)).uid, uid)
+        self.assertEqual(len(queries), 0)
+
+        # from redis, as another worker would
+        user_cache._local.clear()
+        before = user_cache.stats()
+        with count_queries() as queries:
+            user = User.find_with_uid(uid)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(user_cache.stats()['redis_hits'] - before['redis_hits'], 1)
+        self.assertEqual(user.date_created, User.select().where(User.uid == uid).get().date_created)
+
+    def test_negative(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        self.assertRaises(UserWasNotFound, run, login(uid, password))
+        self.assertIsNone(User.find_with_uid(uid))
+
+        with count_queries() as queries:
+            self.assertRaises(UserWasNotFound, run, login(uid, password))
+            self.assertIsNone(User.find_with_uid(uid))
+        self.assertEqual(len(queries), 0)
+
+        run(register(uid, password))
+        self.assertEqual(User.find_with_uid(uid).uid, uid)
+        self.assertTrue(run(login(uid, password)))
+
+    def test_invalidation(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        session = run(login(uid, password))
+        cached = Session.find_with_session_id(session.session_id)
+        Session.find_with_refresh_token(session.refresh_token)
+
+        session.last_activity = datetime.utcnow() + timedelta(minutes=1)
+        session.update_last_activity(background=False)
+        self.assertEqual(Session.find_with_session_id(session.session_id).last_activity,
+                         session.last_activity)
+        self.assertNotEqual(cached.last_activity, session.last_activity)
+
+        run(logout(session.refresh_token))
+        self.assertIsNone(Session.find_with_session_id(session.session_id))
+        self.assertRaises(RefreshTokenIsNotValid, run, refresh_token(session.refresh_token))
+
+        sessions = [run(login(uid, password)) for _ in range(2)]
+        for other in sessions:
+            Session.find_with_refresh_token(other.refresh_token)
+        run(terminate_sessions(uid))
+        for other in sessions:
+            self.assertIsNone(Session.find_with_refresh_token(other.refresh_token))
+
+    def test_concurrent_invalidation(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        cache = ReadThrough('concurrent', 'uid', ttl=30, redis_ttl=0)
+        ReadThrough.caches.remove(cache)
+        cache.put(uid, User.find_with_uid(uid))
+        invalidations = list()
+
+        class Racing(OrderedDict):
+
+            def get(self, key, default=None):
+                item = super().get(key, default)
+                # a database thread saves the row right after the lookup read it
+                invalidation = Thread(target=cache.invalidate, args=(key,))
+                invalidation.start()
+                invalidation.join(0.1)
+                invalidations.append(invalidation)
+                return item
+
+        cache._local._data = Racing(cache._local._data)
+        hit, user = cache.get(User, uid)
+        for invalidation in invalidations:
+            invalidation.join()
+
+        self.assertTrue(hit)
+        self.assertEqual(user.uid, uid)
+        self.assertEqual(cache.get(User, uid), (False, None))
+
+    def test_hit_ratio_metrics(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+        for _ in range(3):
+            User.find_with_uid(uid)
+
+        self.assertGreater(user_cache.stats()['local_hit_ratio'], 0)
+        self.assertIn('cherryauth_model_cache_hit_ratio{cache="user",tier="local"}',
+                      registry.expose())
+
+
+class TestBulk(TestCase):
+
+    def test_import_export(self):
+
+        prefix = uuid4().hex
+        with TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'users.jsonl')
+            with open(source, 'w') as f:
+                for i in range(5):
+                    f.write(json.dumps({"uid": f"{prefix}{i}", "password": f"password{i}"}) + '\n')
+                f.write(json.dumps({"uid": f"{prefix}hashed",
+                                    "password_hash": Salting.hash_pswd("hashed").hex()}) + '\n')
+                f.write(json.dumps({"uid": f"{prefix}invalid"}) + '\n')
+
+            checkpoint = os.path.join(directory, 'checkpoint.json')
+            stats = bulk.import_users(source, batch_size=2, checkpoint=checkpoint, workers=0)
+            self.assertEqual((stats['inserted'], stats['invalid']), (6, 1))
+            self.assertTrue(User.find_with_uid(f"{prefix}3").credentials.get().does_match("password3"))
+            self.assertTrue(User.find_with_uid(f"{prefix}hashed").credentials.get().does_match("hashed"))
+
+            # a finished import resumes after its last record
+            self.assertEqual(bulk.import_users(source, checkpoint=checkpoint, workers=0)['read'], 0)
+
+            exported = os.path.join(directory, 'users.csv')
+            bulk.export_users(exported)
+            records = {record['uid']: record for record in bulk.read_records(exported)}
+            self.assertEqual(records[f"{prefix}hashed"]['password_hash'],
+                             User.find_with_uid(f"{prefix}hashed").credentials.get().password.hex())
+
+            # importing an export again skips every existing user
+            self.assertEqual(bulk.import_users(exported, workers=0)['inserted'], 0)
+
+
 class TestLogout(TestCase):
 
     def test_logout(self):
 
         uid, password = uuid4().hex, uuid4().hex
-        user = register(uid, password)
+        user = run(register(uid, password))
 
-        session = login(uid, password)
-        logout(session.refresh_token)
+        session = run(login(uid, password))
+        run(logout(session.refresh_token))
 
         self.assertEqual(Session.find_with_user(user), [])
 
+    def test_logout_revokes_jwt(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+
+        session = run(login(uid, password))
+        jwt_token, _ = session.gen_jwt(ttl=3600)
+        verify_jwt_token(jwt_token)
+
+        run(logout(session.refresh_token))
+        self.assertRaises(SessionWasRevoked, verify_jwt_token, jwt_token)
+
+    def test_logout_without_redis(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+
+        sessions = [run(login(uid, password)) for _ in range(2)]
+        tokens = [session.gen_jwt(ttl=3600)[0] for session in sessions]
+        for jwt_token in tokens:
+            verify_jwt_token(jwt_token)
+
+        modules = (Utils.Revocation, Utils.CacheEngine, Utils.ReadThrough)
+        clients = [module.redis for module in modules]
+        for module in modules:
+            module.redis = Unavailable()
+        try:
+            run(logout(sessions[0].refresh_token))
+            self.assertTrue(run(terminate_sessions(uid)))
+            for jwt_token in tokens:
+                self.assertRaises(SessionWasRevoked, verify_jwt_token, jwt_token)
+        finally:
+            for module, client in zip(modules, clients):
+                module.redis = client
+
+
+class TestWorker(TestCase):
+
+    def test_init_worker(self):
+
+        uid, password = uuid4().hex, uuid4().hex
+        run(register(uid, password))
+
+        database = db.obj
+        release_connections()
+        init_worker()
+        self.assertIsNot(db.obj, database)
+
+        session = run(login(uid, password))
+        self.assertIsNotNone(Session.find_with_session_id(session.session_id))
+
+    def test_server_options(self):
+
+        options = server_options(workers=3, port=None)
+        self.assertEqual(options['workers'], 3)
+        self.assertEqual(options['port'], config.get('server', {}).get('port', 5001))
+        self.assertGreaterEqual(server_options()['workers'], 1)
+        self.assertIn('backlog', options)
+        self.assertIn('access_log', options)
+
+    def test_start_without_redis(self):
+
+        revocation_list = RevocationList(ttl=60, sync_interval=0.05)
+        redis = Utils.Revocation.redis
+        Utils.Revocation.redis = Unavailable()
+        try:
+            self.assertTrue(revocation_list.start())
+        finally:
+            Utils.Revocation.redis = redis
+
+        try:
+            sid = uuid4().hex
+            redis.zadd(RevocationList.key, {sid: time()})
+            sleep(0.3)
+            self.assertTrue(revocation_list.is_revoked(sid))
+        finally:
+            revocation_list.stop()
+
+    def test_hashing_pool_size(self):
+
+        hashing = config.get('hashing', {})
+        if 'workers' in hashing:
+            self.assertEqual(Salting.pool_size(4), hashing['workers'])
+        else:
+            self.assertEqual(Salting.pool_size(os.cpu_count() or 1), 1)
+            self.assertEqual(Salting.pool_size(1), os.cpu_count() or 1)
+
+    def test_hash_in_daemon(self):
+
+        context = get_context('fork')
+        results = context.Queue()
+        worker = context.Process(target=hash_in_daemon, args=(results,), daemon=True)
+        worker.start()
+        pool, valid = results.get(timeout=30)
+        worker.join()
+
+        expected = 'NoneType' if config.get('hashing', {}).get('workers') == 0 else 'ThreadPoolExecutor'
+        self.assertEqual(pool, expected)
+        self.assertTrue(valid)
+
+
+class TestOrange(TestCase):
+
+    def test_atomic_dump(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            db = Orange(path, auto_dump=False)
+            db.setm(*[(str(i), i) for i in range(100)])
+            self.assertFalse(os.path.exists(path))
+
+            db.dump()
+            self.assertEqual(sorted(os.listdir(workdir)), ['db.json', 'db.json.lock'])
+            self.assertEqual(Orange(path)['99'], 99)
+
+    def test_burst_is_one_dump(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            db = Orange(path, debounce_ms=1000)
+            for i in range(1000):
+                db.set(str(i), i)
+            db.incrby('0', 5)
+            db.flush()
+            self.assertEqual(db.counters['dumps'], 1)
+            self.assertEqual(Orange(path).getm('0', '999'), [5, 999])
+
+            db.set('late', True)
+            db.close()
+            self.assertTrue(Orange(path)['late'])
+            self.assertFalse(db.flush())
+
+    def test_background_dump(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            db = Orange(path, debounce_ms=10)
+            db.child('a/b').set('key', 'value')
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                sleep(0.01)
+            self.assertEqual(Orange(path)['a'], {'b': {'key': 'value'}})
+            db.close()
+
+    def test_journal_replay(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            db = Orange(path, journal=True)
+            db.setm(('count', 1), ('gone', True))
+            db.incrby('count', 2)
+            db.delete('gone')
+            db.lcreate('list')
+            db.lextend('list', range(4))
+            db.lappend('list', 4)
+            db.ldelindex('list', 0)
+            db.lpop('list')
+            db.child('a/b').set('key', 'value')
+            db.close()
+
+            self.assertFalse(os.path.exists(path))
+            loaded = Orange(path, journal=True)
+            self.assertEqual(loaded.copy(), db.copy())
+            self.assertEqual(loaded['list'], [1, 2, 3])
+            self.assertEqual(loaded['count'], 3)
+
+    def test_journal_compaction(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            db = Orange(path, journal=True, compact_bytes=1000, debounce_ms=0)
+            for i in range(200):
+                db.set(str(i), i)
+            for _ in range(100):
+                if db.counters['compactions']:
+                    break
+                sleep(0.01)
+            db.close()
+
+            self.assertGreaterEqual(db.counters['compactions'], 1)
+            self.assertLess(os.path.getsize(path + '.log'), 1000 * 2)
+            self.assertEqual(len(Orange(path, journal=True)), 200)
+            Orange(path, journal=True).compact()
+            self.assertEqual(len(Orange(path)), 200)
+
+    def test_journal_recovery(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            db = Orange(path, journal=True)
+            db.set('kept', 1)
+            db.compact()
+            db.lcreate('list')
+            db.lappend('list', 1)
+            db.close()
+
+            # a record torn by a crash is dropped
+            with open(path + '.log', 'ab') as f:
+                f.write(b'[[],"lappend","li')
+            loaded = Orange(path, journal=True)
+            self.assertEqual(loaded['list'], [1])
+            loaded.lappend('list', 2)
+            loaded.close()
+            self.assertEqual(Orange(path, journal=True)['list'], [1, 2])
+
+            # a crash after folding the journal, before starting a new one,
+            # must not apply it twice
+            with open(path + '.log', 'rb') as f:
+                journal = f.read()
+            Orange(path, journal=True).compact()
+            with open(path + '.log', 'wb') as f:
+                f.write(journal)
+            self.assertEqual(Orange(path, journal=True)['list'], [1, 2])
+
+
+class TestOrangeConcurrency(TestCase):
+
+    def test_rw_lock(self):
+
+        lock, events = RWLock(), list()
+
+        def write():
+            with lock.write():
+                events.append('write')
+
+        with lock.read():
+            with lock.read():
+                writer = Thread(target=write)
+                writer.start()
+                sleep(0.05)
+                self.assertEqual(events, [])
+        writer.join()
+        self.assertEqual(events, ['write'])
+
+    def test_threads(self):
+
+        with TemporaryDirectory() as workdir:
+            db = Orange(os.path.join(workdir, 'db.json'), debounce_ms=1)
+            db.set('count', 0)
+
+            def work():
+                for i in range(200):
+                    db.incrby('count', 1)
+                    db.lcreate(f'list{i % 3}')
+                    db.copy()
+
+            threads = [Thread(target=work) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            db.close()
+            self.assertEqual(Orange(db.file_path)['count'], 800)
+
+    def test_processes(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            context = get_context('fork')
+            processes = [context.Process(target=increment, args=(path, 50)) for _ in range(4)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual(Orange(path)['count'], 200)
+
+    def test_journal_processes(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            context = get_context('fork')
+            processes = [context.Process(target=journal, args=(path, name, 100)) for name in 'abcd']
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+
+            db = Orange(path, journal=True)
+            self.assertEqual(len(db), 400)
+            self.assertEqual(db.getm('a99', 'd0'), [99, 0])
+
+    def test_journal_changes(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            worker, other = Orange(path, journal=True), Orange(path, journal=True)
+            worker.set('a', 1)
+            self.assertIsNone(worker.check())
+
+            other.set('b', 2)
+            self.assertEqual(worker.check(), {'b'})
+            other.compact()
+            worker.set('c', 3)
+            self.assertEqual(Orange(path, journal=True).getm('a', 'b', 'c'), [1, 2, 3])
+
+            worker.compact()
+            other.set('d', 4)
+            self.assertEqual(other.check(), {'c'})
+            self.assertEqual(Orange(path, journal=True).copy(), {'a': 1, 'b': 2, 'c': 3, 'd': 4})
+            worker.close()
+            other.close()
+
+    def test_change_notifications(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            worker = Orange(path, auto_dump=False)
+            other = Orange(path, auto_dump=False)
+            changes = list()
+            worker.on_change(changes.append)
+
+            other.setm(('a', 1), ('b', 2))
+            other.dump()
+            self.assertEqual(worker.check(), {'a', 'b'})
+            self.assertIsNone(worker.check())
+
+            worker.watch(interval=0.01)
+            other.set('b', 3)
+            other.dump()
+            for _ in range(100):
+                if len(changes) == 2:
+                    break
+                sleep(0.01)
+            worker.close()
+            self.assertEqual(changes, [{'a', 'b'}, {'b'}])
+            self.assertEqual(worker['b'], 3)
+
+    def test_transaction_reloads(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.json')
+            first, second = Orange(path, auto_dump=False), Orange(path, auto_dump=False)
+            with first.transaction():
+                first.setnx('secret', 'first')
+            with second.transaction():
+                second.setnx('secret', 'second')
+                second.set('other', True)
+            self.assertEqual(Orange(path).getm('secret', 'other'), ['first', True])
+
+            with self.assertRaises(KeyError):
+                with first.transaction():
+                    first.set('discarded', True)
+                    raise KeyError()
+            self.assertNotIn('discarded', first)
+            self.assertTrue(first['other'])
+
+    def test_keyring_reload(self):
+
+        keep_keyring(self)
+        token, _ = JWT.gen_jwt("sid", "uid", 3600)
+        kid = config['jwt']['active_kid']
+        rotation = get_context('fork').Process(target=JWT.rotate_key)
+        rotation.start()
+        rotation.join()
+
+        self.assertTrue(JWT.refresh_keyring())
+        self.assertNotEqual(config['jwt']['active_kid'], kid)
+        self.assertEqual(JWT.verify_jwt(token)['sid'], "sid")
+
+
+class TestOrangeMap(TestCase):
+
+    def test_lazy_decode(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.map')
+            db = OrangeMap(path, auto_dump=False)
+            db.setm(*[(str(i), {'value': i}) for i in range(1000)])
+            db.dump()
+
+            db = OrangeMap(path, auto_dump=False)
+            self.assertEqual(len(db), 1000)
+            self.assertIn('999', db)
+            self.assertNotIn('1000', db)
+            self.assertEqual(len(list(db)), 1000)
+            self.assertEqual(db._db.decoded, 0)
+            self.assertEqual(db['10'], {'value': 10})
+            self.assertEqual(db._db.decoded, 1)
+
+    def test_updates(self):
+
+        with TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'db.map')
+            with open(path, 'w') as f:
+                json.dump({'list': [1], 'count': 1, 'gone': True}, f)
+
+            db = OrangeMap(path, auto_dump=False)
+            db.lappend('list', 2)
+            db.incrby('count', 1)
+            db.delete('gone')
+            db.child('a/b').set('key', 'value')
+            db.dump()
+            db.set('gone', False)
+            db.delete('count')
+            db.dump()
+
+            loaded = OrangeMap(path)
+            self.assertEqual(loaded.copy(), {'list': [1, 2], 'gone': False,
+                                             'a': {'b': {'key': 'value'}}})
+            loaded.clear()
+            loaded.close()
+            self.assertEqual(len(OrangeMap(path)), 0)
+
 
 if __name__ == '__main__':
     create_db()